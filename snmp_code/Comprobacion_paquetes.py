@@ -18,6 +18,7 @@ LIBRERIAS_PYTHON = {
     "pysnmp": PYSNMP_VERSION_REQUERIDA,
     "psutil": None,  # None significa que solo comprobamos si existe
     "keyboard": None,
+    "cryptography": None,  # Cifrado AES/DES de SNMPv3 (authPriv)
 }
 
 # Lista de herramientas externas (del PATH) a comprobar
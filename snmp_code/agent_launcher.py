@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+agent_launcher.py - Arranque del agente real para test.py, loadtest.py y benchmark.py.
+Lanza el agente en un subproceso con las alertas apuntando a un puerto local cerrado (SMTP sin TLS ni usuario
+y un único destino de traps), de modo que si la CPU cruza el umbral durante las pruebas, la carga o los
+benchmarks no se envían traps ni emails de verdad.
+"""
+
+import importlib.util
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Configuración Global
+AGENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mini_agent(7.1.4).py")
+AGENT_IP = "127.0.0.1"
+AGENT_START_TIMEOUT = 30 # Segundos máximos para que el agente responda tras arrancarlo
+AGENT_STOP_TIMEOUT = 15 # Segundos de espera a la parada ordenada antes de matarlo
+READY_OID = (1, 3, 6, 1, 4, 1, 28308, 1, 1, 0) # manager: siempre existe
+
+# Agente con las notificaciones neutralizadas: se importa el agente, se cambia la configuración SMTP y se
+# ejecuta su main() con el resto de argumentos
+LAUNCH_CODE = """
+import importlib.util, os, sys
+sys.path.insert(0, os.path.dirname(sys.argv[1])) # Como al lanzar el script: sus módulos (shared_mib) se importan de su directorio
+spec = importlib.util.spec_from_file_location("mini_agent", sys.argv[1])
+agent = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(agent)
+agent.SMTP_HOST, agent.SMTP_PORT, agent.SMTP_TLS, agent.SMTP_USER = "127.0.0.1", int(sys.argv[2]), "none", None
+sys.argv = ["mini_agent"] + sys.argv[3:]
+agent.main()
+"""
+
+
+def load_agent(): # Importa el agente en este proceso (el nombre del fichero no es un identificador de Python válido)
+    spec = importlib.util.spec_from_file_location("mini_agent", AGENT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def free_port(): # Puerto UDP libre en localhost
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((AGENT_IP, 0))
+        return sock.getsockname()[1]
+
+
+def encode_get(oid): # Mensaje GET v2c (comunidad public) ya codificado, para no pagar pysnmp en el cliente
+    from pysnmp.proto import api
+    from pyasn1.codec.ber import encoder
+    pMod = api.PROTOCOL_MODULES[api.SNMP_VERSION_2C]
+    pdu = pMod.GetRequestPDU()
+    pMod.apiPDU.setDefaults(pdu)
+    pMod.apiPDU.setVarBinds(pdu, [(oid, pMod.Null(""))])
+    msg = pMod.Message()
+    pMod.apiMessage.setDefaults(msg)
+    pMod.apiMessage.setCommunity(msg, "public")
+    pMod.apiMessage.setPDU(msg, pdu)
+    return encoder.encode(msg)
+
+
+def launch_agent(directory, port, *args): # Lanza el agente en directory sin esperar a que responda
+    closed_port = free_port() # Nadie escucha en él: emails y traps fallan en local
+    command = [sys.executable, "-c", LAUNCH_CODE, AGENT_FILE, str(closed_port), "--quiet", "--port", str(port),
+               "--notify-target", f"trap:{AGENT_IP}:{closed_port}", *args]
+    return subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(port, process, timeout=AGENT_START_TIMEOUT): # Reintentar un GET corto hasta que el agente conteste
+    message = encode_get(READY_OID)
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while process.poll() is None and time.monotonic() < deadline:
+            try:
+                sock.sendto(message, (AGENT_IP, port))
+                sock.recv(2048)
+                return
+            except OSError:
+                pass
+    raise RuntimeError("el agente no responde")
+
+
+def start_agent(directory, port, *args): # Lanza el agente y espera a que responda (lo mata si no llega a hacerlo)
+    process = launch_agent(directory, port, *args)
+    try:
+        wait_ready(port, process)
+    except BaseException:
+        process.kill()
+        raise
+    return process
+
+
+def stop_agent(process, timeout=AGENT_STOP_TIMEOUT): # Parada ordenada (como Ctrl+C), para que guarde el estado y libere el puerto
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,833 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - Pruebas de rendimiento de las estructuras internas del mini agente SNMP.
+Mide JsonStore directamente, sin red ni net-snmp, con MIBs sintéticas de distintos tamaños.
+
+Uso: python benchmark.py [walk] [get] [stress] [table] [cpucache] [history] [notify] [v3] [workers] [mmap] [coldstart] [wal] [metrics]
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from agent_launcher import encode_get, free_port, launch_agent, load_agent, start_agent, stop_agent
+from shared_mib import MmapStore
+
+# Configuración Global
+BASE_OID = (1, 3, 6, 1, 4, 1, 28308)
+WALK_SIZES = [4, 100, 1000, 10000, 100000] # Tamaños de MIB a recorrer
+LINEAR_MAX_SIZE = 10000 # A partir de aquí el recorrido lineal antiguo (O(n²)) tarda demasiado
+GET_ITERATIONS = 200000 # Lecturas get_exact por medición
+STRESS_SECONDS = 3 # Duración de la prueba de concurrencia
+STRESS_READERS = 4 # Hilos lectores simultáneos
+STRESS_WALK_SIZE = 1000 # Objetos de la MIB durante la prueba de concurrencia
+TABLE_CORES = [8, 64, 128, 512] # Número de núcleos simulados en cpuCoreTable
+TABLE_TICKS = 200 # Muestras publicadas por medición
+CPUCACHE_SECONDS = 3 # Duración de la prueba de refresco bajo demanda
+CPUCACHE_READERS = 8 # Hilos que leen cpuUsage a la vez
+HISTORY_CAPACITIES = [1024, 16384, 262144] # Tamaños del búfer circular del histórico
+HISTORY_APPENDS = 300000 # Muestras añadidas por medición
+NOTIFY_RECEIVERS = [1, 4, 16] # Receptores INFORM simulados por medición
+NOTIFY_DELAY = 0.2 # Segundos que tarda cada receptor simulado en confirmar un INFORM
+NOTIFY_TIMEOUT = 0.5 # Timeout de INFORM de los destinos del benchmark
+V3_REQUESTS = 500 # Peticiones GET por nivel de seguridad
+V3_CONCURRENCY = 8 # Peticiones en vuelo a la vez
+V3_KEY_USERS = 16 # Usuarios USM para medir el coste de preparar las claves
+WORKER_COUNTS = [1, 2, 4] # Procesos del agente (--workers) por medición
+WORKER_CLIENTS = 4 # Procesos cliente que lanzan GET a la vez (cada uno con su puerto de origen)
+WORKER_WINDOW = 8 # Peticiones en vuelo por cliente
+WORKER_SECONDS = 3 # Duración de cada medición
+MMAP_SIZES = [100, 1000, 10000] # Objetos de la MIB compartida
+MMAP_READS = 200000 # Lecturas get_exact por medición
+MMAP_WRITES = 2000 # SETs por medición
+MMAP_SECONDS = 3 # Duración de la prueba entre procesos
+COLDSTART_SIZES = [10000, 100000] # Objetos de la MIB al arrancar
+COLDSTART_LOADS = 3 # Cargas por medición (se queda la mejor)
+WAL_SIZES = [100, 10000, 100000] # Objetos de la MIB
+WAL_SETS = 300 # SETs durables por medición
+WAL_CONCURRENCY = [1, 8, 64] # SETs simultáneos esperando al fsync compartido (group commit)
+WAL_REPLAY_RECORDS = 100000 # Cambios en el WAL para medir la recuperación
+METRICS_SIZE = 1000 # Objetos de la MIB al medir los manejadores
+METRICS_ITERATIONS = 20000 # PDUs por medición
+
+
+agent = load_agent()
+
+
+def print_header(title): # Imprime un encabezado de sección bonito
+    print(f"\n{'='*60}")
+    print(f" {title.upper()} ")
+    print(f"{'='*60}")
+
+
+def make_store(directory, size): # Crea un JsonStore con los 4 escalares originales más objetos sintéticos hasta `size`
+    store = agent.JsonStore(os.path.join(directory, "mib_state.json"))
+    store.add_objects([(f"benchObject{i}", {"oid": f"1.3.6.1.4.1.28308.1.100.{i}.0", "type": "Integer32",
+                                            "access": "read-only", "minval": 0, "maxval": 100, "value": i % 100})
+                       for i in range(size - len(store.oid_map))])
+    return store
+
+
+def walk_getnext(store): # Recorrido completo encadenando get_next como haría un snmpwalk
+    oid = BASE_OID
+    count = 0
+    while True:
+        ok, oid, _ = store.get_next(oid)
+        if not ok:
+            return count
+        count += 1
+
+
+def walk_subtree(store): # Recorrido completo usando el rango del subárbol del índice
+    return sum(1 for _ in store.walk(BASE_OID))
+
+
+def walk_linear(store): # Recorrido con el algoritmo anterior: búsqueda lineal desde el principio en cada GETNEXT
+    sorted_oids = list(store.index.oids)
+    oid = BASE_OID
+    count = 0
+    while True:
+        for candidate in sorted_oids:
+            if candidate > oid:
+                store.get_exact(candidate)
+                oid = candidate
+                count += 1
+                break
+        else:
+            return count
+
+
+def timed(func, *args): # Ejecuta func y devuelve (resultado, milisegundos)
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def bench_walk(): # Benchmark: tiempo de recorrido completo frente al tamaño de la MIB
+    print_header("Recorrido GETNEXT frente al tamaño de la MIB")
+    print(f"  {'Objetos':>8} | {'get_next (ms)':>14} | {'subárbol (ms)':>14} | {'lineal (ms)':>12} | {'µs/objeto':>10}")
+    print(f"  {'-'*8}-+-{'-'*14}-+-{'-'*14}-+-{'-'*12}-+-{'-'*10}")
+
+    for size in WALK_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            store = make_store(directory, size)
+            count, t_next = timed(walk_getnext, store)
+            _, t_subtree = timed(walk_subtree, store)
+            if size <= LINEAR_MAX_SIZE:
+                linear_count, t_linear = timed(walk_linear, store)
+                assert linear_count == count # Ambos recorridos deben visitar los mismos objetos
+                linear = f"{t_linear:12.2f}"
+            else:
+                linear = f"{'-':>12}"
+            print(f"  {count:>8} | {t_next:14.2f} | {t_subtree:14.2f} | {linear} | {t_next * 1000 / count:10.2f}")
+
+
+def bench_get(): # Benchmark: lecturas get_exact con y sin la caché de objetos pysnmp
+    print_header("GET con y sin caché de valores")
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(directory, 4)
+        oids = list(store.index.oids)
+        results = {}
+        for enabled in (False, True):
+            store.cache_enabled = enabled
+            store.value_cache.clear()
+            store.cache_stats = {"hits": 0, "misses": 0}
+            start = time.perf_counter()
+            for i in range(GET_ITERATIONS):
+                store.get_exact(oids[i % len(oids)])
+            elapsed = time.perf_counter() - start
+            results[enabled] = GET_ITERATIONS / elapsed
+            label = "con caché" if enabled else "sin caché"
+            print(f"  {label:<10}: {results[enabled]:>12,.0f} GET/s | aciertos: {store.cache_stats['hits']} | fallos: {store.cache_stats['misses']}")
+        print(f"\n  Mejora: x{results[True] / results[False]:.2f}")
+
+
+def bench_stress(): # Prueba de concurrencia: GETs y recorridos mientras llegan SETs multi-varbind y muestras de CPU
+    print_header("Concurrencia: lecturas con versión fijada frente a SETs y muestras")
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(directory, STRESS_WALK_SIZE)
+        manager_oid = next(oid for oid, name in store.oid_map.items() if name == "manager")
+        email_oid = next(oid for oid, name in store.oid_map.items() if name == "managerEmail")
+        stop = threading.Event()
+        counts = {"gets": 0, "walks": 0, "sets": 0, "samples": 0, "inconsistent": 0, "torn_unpinned": 0}
+        errors = []
+        lock = threading.Lock()
+
+        def setter(): # SET de dos varbinds que siempre deben verse juntos: manager=mN, managerEmail=mN@bench
+            i = 0
+            while not stop.is_set():
+                i += 1
+                store.commit_many([(manager_oid, agent.v2c.OctetString(f"m{i}")),
+                                   (email_oid, agent.v2c.OctetString(f"m{i}@bench"))])
+                counts["sets"] += 1
+
+        def sampler(): # Muestras de CPU tan rápido como sea posible
+            i = 0
+            while not stop.is_set():
+                i += 1
+                store.set_cpu_usage_internal(i % 100)
+                counts["samples"] += 1
+
+        def reader(): # Un GET de dos varbinds sobre la versión fijada debe ver siempre la pareja completa
+            gets = walks = inconsistent = torn = 0
+            try:
+                while not stop.is_set():
+                    snap = store.pin()
+                    manager = str(store.get_exact(manager_oid, snap)[1])
+                    email = str(store.get_exact(email_oid, snap)[1])
+                    if email != f"{manager}@bench" and manager != "Ruben":
+                        inconsistent += 1
+                    # Sin fijar la versión, cada lectura puede caer en una versión distinta
+                    manager = str(store.get_exact(manager_oid)[1])
+                    email = str(store.get_exact(email_oid)[1])
+                    if email != f"{manager}@bench" and manager != "Ruben":
+                        torn += 1
+                    gets += 1
+                    if gets % 50 == 0: # Recorrido completo: el número de objetos no puede variar
+                        if sum(1 for _ in store.walk(BASE_OID, snap)) != STRESS_WALK_SIZE:
+                            inconsistent += 1
+                        walks += 1
+            except Exception as e: # Cualquier excepción en un lector es un fallo de la prueba
+                errors.append(e)
+            with lock: # Acumular los contadores del hilo al terminar
+                counts["gets"] += gets
+                counts["walks"] += walks
+                counts["inconsistent"] += inconsistent
+                counts["torn_unpinned"] += torn
+
+        previous = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5) # Cambios de hilo muy frecuentes para provocar intercalados
+        threads = [threading.Thread(target=setter), threading.Thread(target=sampler)]
+        threads += [threading.Thread(target=reader) for _ in range(STRESS_READERS)]
+        try:
+            for thread in threads:
+                thread.start()
+            time.sleep(STRESS_SECONDS)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            sys.setswitchinterval(previous)
+
+        print(f"  GETs: {counts['gets']:,} | recorridos: {counts['walks']:,} | SETs: {counts['sets']:,} | muestras: {counts['samples']:,}")
+        print(f"  Versión final: {store.pin().version:,}")
+        print(f"  Lecturas incoherentes con versión fijada: {counts['inconsistent']} | excepciones: {len(errors)}")
+        print(f"  Lecturas mezcladas sin fijar versión (referencia): {counts['torn_unpinned']}")
+        if counts["inconsistent"] or errors:
+            raise SystemExit("  ❌ La prueba de concurrencia ha fallado")
+        print("  ✅ Todas las lecturas con versión fijada fueron coherentes")
+
+
+def bench_table(): # Benchmark: coste de publicar una muestra por núcleo y de recorrer cpuCoreTable
+    print_header("cpuCoreTable: muestreo y recorrido frente al número de núcleos")
+    print(f"  {'Núcleos':>8} | {'muestra (µs)':>12} | {'GETNEXT tabla (ms)':>18} | {'µs/fila':>8}")
+    print(f"  {'-'*8}-+-{'-'*12}-+-{'-'*18}-+-{'-'*8}")
+    table_oid = (1, 3, 6, 1, 4, 1, 28308, 1, 5)
+
+    for cores in TABLE_CORES:
+        with tempfile.TemporaryDirectory() as directory:
+            store = make_store(directory, 4)
+            start = time.perf_counter()
+            for tick in range(TABLE_TICKS): # Cada tick cambia aproximadamente la mitad de los núcleos
+                store.replace_rows("cpuCoreTable", {core: {"cpuCoreUsage": (core * tick) % 101 if core % 2 else 50}
+                                                    for core in range(1, cores + 1)}, {"cpuUsage": tick % 100})
+            t_sample = (time.perf_counter() - start) * 1e6 / TABLE_TICKS
+
+            def walk_table(): # GETNEXT encadenado sobre la tabla, como un snmpwalk
+                oid, count = table_oid, 0
+                while True:
+                    ok, oid, _ = store.get_next(oid)
+                    if not ok or oid[:len(table_oid)] != table_oid:
+                        return count
+                    count += 1
+
+            count, t_walk = timed(walk_table)
+            assert count == cores # Una celda por núcleo
+            print(f"  {cores:>8} | {t_sample:12.1f} | {t_walk:18.2f} | {t_walk * 1000 / count:8.2f}")
+
+
+def bench_cpucache(): # Benchmark: GETs de cpuUsage en paralelo con refresco bajo demanda y TTL
+    print_header("cpuUsage bajo demanda: lecturas frente a muestras reales")
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(directory, 4)
+        for ttl in (0.1, agent.CPU_CACHE_TTL):
+            cache = agent.CpuSampleCache(store, ttl)
+            store.refreshers = []
+            store.add_refresher([store.cpu_usage_oid], cache.refresh)
+            stop = threading.Event()
+            reads = [0] * CPUCACHE_READERS
+
+            def reader(slot): # Un GET de cpuUsage tras otro, como muchos gestores sondeando a la vez
+                while not stop.is_set():
+                    store.refresh([store.cpu_usage_oid])
+                    store.get_exact(store.cpu_usage_oid)
+                    reads[slot] += 1
+
+            threads = [threading.Thread(target=reader, args=(slot,)) for slot in range(CPUCACHE_READERS)]
+            for thread in threads:
+                thread.start()
+            time.sleep(CPUCACHE_SECONDS)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            total = sum(reads)
+            print(f"  TTL {ttl:>4} s: {total:>10,} GETs | {cache.stats['samples']:>3} muestras "
+                  f"(máximo esperado {int(CPUCACHE_SECONDS / ttl) + 1}) | {total / CPUCACHE_SECONDS:>10,.0f} GET/s")
+
+
+def bench_history(): # Benchmark: coste de añadir muestras y leer agregados frente al tamaño del histórico
+    print_header("Histórico de CPU: coste por muestra frente al tamaño del búfer")
+    print(f"  {'Capacidad':>9} | {'memoria (KiB)':>13} | {'añadir (µs)':>11} | {'agregados (µs)':>14}")
+    print(f"  {'-'*9}-+-{'-'*13}-+-{'-'*11}-+-{'-'*14}")
+    for capacity in HISTORY_CAPACITIES:
+        history = agent.CpuHistory(capacity)
+        start = time.perf_counter()
+        for i in range(HISTORY_APPENDS): # Una muestra cada 0,1 s simulados: las ventanas se llenan y expulsan
+            history.append((i * 37) % 101, i * 0.1)
+        t_append = (time.perf_counter() - start) * 1e6 / HISTORY_APPENDS
+        start = time.perf_counter()
+        for _ in range(1000):
+            for window in history.windows.values():
+                window.mean(), window.maximum(), window.percentile(95)
+        t_read = (time.perf_counter() - start) * 1e6 / 1000
+        print(f"  {capacity:>9} | {history.nbytes / 1024:13.1f} | {t_append:11.2f} | {t_read:14.2f}")
+
+
+class StandInReceiver(asyncio.DatagramProtocol): # Receptor de notificaciones simulado: confirma los INFORM tras `delay` segundos
+    def __init__(self, delay=0.0, drop_first=0, mute=False):
+        from pysnmp.proto import api
+        self.pMod = api.PROTOCOL_MODULES[api.SNMP_VERSION_2C]
+        self.delay = delay
+        self.drop_first = drop_first # Primeros INFORM que se ignoran para forzar reenvíos
+        self.mute = mute # No contesta nunca
+        self.received = 0
+    
+    def connection_made(self, transport):
+        self.transport = transport
+    
+    def datagram_received(self, data, addr):
+        from pyasn1.codec.ber import decoder, encoder
+        self.received += 1
+        if self.mute or self.received <= self.drop_first:
+            return
+        msg, _ = decoder.decode(data, asn1Spec=self.pMod.Message())
+        pdu = self.pMod.apiMessage.getPDU(msg)
+        if pdu.isSameTypeWith(self.pMod.InformRequestPDU()):
+            self.pMod.apiMessage.setPDU(msg, self.pMod.apiPDU.getResponse(pdu))
+            asyncio.get_event_loop().call_later(self.delay, self.transport.sendto, encoder.encode(msg), addr)
+
+
+async def notify_round(agent, receivers): # Envía una alerta a receptores simulados; devuelve (ok, segundos, sender)
+    from pysnmp.entity import config, engine
+    from pysnmp.entity.rfc3413 import context
+    from pysnmp.carrier.asyncio.dgram import udp
+    loop = asyncio.get_event_loop()
+    snmpEngine = engine.SnmpEngine()
+    config.addTransport(snmpEngine, udp.domainName, udp.UdpTransport().openServerMode(("127.0.0.1", free_port())))
+    config.addV1System(snmpEngine, "public-area", "public")
+    config.addVacmUser(snmpEngine, 2, "public-area", "noAuthNoPriv", readSubTree=(1,3,6,1), notifySubTree=(1,3,6,1))
+    context.SnmpContext(snmpEngine)
+    targets, endpoints = [], []
+    for n, (kind, receiver) in enumerate(receivers):
+        port = free_port()
+        transport, _ = await loop.create_datagram_endpoint(lambda r=receiver: r, local_addr=("127.0.0.1", port))
+        endpoints.append(transport)
+        targets.append({"name": f"bench{n}", "host": "127.0.0.1", "port": port, "type": kind, "timeout": NOTIFY_TIMEOUT})
+    sender = agent.TrapSender(snmpEngine, targets)
+    start = time.perf_counter()
+    ok = await sender.send({"cpu": 95, "threshold": 80, "email": "bench@example.com"})
+    elapsed = time.perf_counter() - start
+    for transport in endpoints:
+        transport.close()
+    snmpEngine.transportDispatcher.closeDispatcher()
+    return ok, elapsed, sender
+
+
+def bench_notify(): # Benchmark: entrega en paralelo a varios destinos INFORM frente a la suma secuencial
+    agent = load_agent()
+    agent.log.setLevel("WARNING")
+    print_header("Notificaciones: fan-out concurrente a receptores INFORM simulados")
+    print(f"Cada receptor confirma tras {NOTIFY_DELAY*1000:.0f} ms\n")
+    print(f"  {'Destinos':>8} | {'Tiempo (ms)':>11} | {'Secuencial (ms)':>15} | {'Entregadas':>10}")
+    print("  " + "-" * 55)
+    for count in NOTIFY_RECEIVERS:
+        receivers = [("inform", StandInReceiver(NOTIFY_DELAY)) for _ in range(count)]
+        ok, elapsed, sender = asyncio.run(notify_round(agent, receivers))
+        sequential = sum(stats["latency_total"] for stats in sender.stats.values())
+        delivered = sum(stats["sent"] for stats in sender.stats.values())
+        print(f"  {count:>8} | {elapsed*1000:11.1f} | {sequential*1000:15.1f} | {delivered:>10}")
+    
+    print("\nDestinos mezclados: trap, inform, inform que pierde la primera copia e inform sin respuesta\n")
+    receivers = [("trap", StandInReceiver()), ("inform", StandInReceiver(NOTIFY_DELAY)),
+                 ("inform", StandInReceiver(drop_first=1)), ("inform", StandInReceiver(mute=True))]
+    ok, elapsed, sender = asyncio.run(notify_round(agent, receivers))
+    print(f"  {'Destino':<8} | {'Tipo':<6} | {'Datagramas':>10} | {'Entregadas':>10} | {'Fallidas':>8} | {'Reenvíos':>8}")
+    print("  " + "-" * 66)
+    for target, (_, receiver) in zip(sender.targets, receivers):
+        stats = sender.stats[target["name"]]
+        print(f"  {target['name']:<8} | {target['type']:<6} | {receiver.received:>10} | {stats['sent']:>10} | "
+              f"{stats['failed']:>8} | {stats['retries']:>8}")
+    print(f"\n  Todos entregados: {ok} | Tiempo total: {elapsed*1000:.1f} ms")
+
+
+V3_LEVELS = [ # (nombre, credenciales del cliente); los usuarios se dan de alta en el agente en bench_v3
+    ("v2c", lambda h: h.CommunityData('public')),
+    ("authNoPriv", lambda h: h.UsmUserData('benchauth', 'benchauth2025', authProtocol=h.usmHMACSHAAuthProtocol)),
+    ("authPriv", lambda h: h.UsmUserData('benchpriv', 'benchauth2025', 'benchpriv2025', authProtocol=h.usmHMACSHAAuthProtocol,
+                                         privProtocol=h.usmAesCfb128Protocol)),
+]
+
+
+async def v3_round(port, credentials): # Lanza V3_REQUESTS GET contra el agente con V3_CONCURRENCY en vuelo
+    from pysnmp.hlapi.v3arch import asyncio as hlapi
+    client = hlapi.SnmpEngine()
+    target = await hlapi.UdpTransportTarget.create(("127.0.0.1", port), timeout=2, retries=0)
+    errors = 0
+    
+    async def worker(count):
+        nonlocal errors
+        for _ in range(count):
+            errorIndication, errorStatus, _, _ = await hlapi.getCmd(
+                client, credentials, target, hlapi.ContextData(), hlapi.ObjectType(hlapi.ObjectIdentity("1.3.6.1.4.1.28308.1.1.0")))
+            errors += bool(errorIndication or errorStatus)
+    
+    await worker(1) # Descubrimiento del engine ID (SNMPv3) fuera de la medición
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(V3_REQUESTS // V3_CONCURRENCY) for _ in range(V3_CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+    client.transportDispatcher.closeDispatcher()
+    return elapsed, errors
+
+
+async def v3_agent(agent, directory, levels): # Agente en proceso con v2c y los usuarios del benchmark; mide cada nivel
+    from pysnmp.entity import engine, config
+    from pysnmp.entity.rfc3413 import context
+    from pysnmp.carrier.asyncio.dgram import udp
+    from pysnmp.proto.api import v2c
+    from pysnmp.hlapi.v3arch import asyncio as hlapi
+    key_cache = agent.UsmKeyCache(os.path.join(directory, "usm_keys.json"))
+    snmpEngine = engine.SnmpEngine(v2c.OctetString(key_cache.engine_id()))
+    port = free_port()
+    config.addTransport(snmpEngine, udp.domainName, udp.UdpTransport().openServerMode(("127.0.0.1", port)))
+    agent.configure_security(snmpEngine, key_cache.localize_users(), True)
+    snmpContext = context.SnmpContext(snmpEngine)
+    agent.JsonGet(snmpEngine, snmpContext, make_store(directory, 4))
+    results = [(name, *await v3_round(port, credentials(hlapi))) for name, credentials in levels]
+    snmpEngine.transportDispatcher.closeDispatcher()
+    return results
+
+
+def bench_v3(): # Benchmark: GET con v2c frente a SNMPv3 authNoPriv y authPriv, y coste de preparar las claves USM
+    agent = load_agent()
+    agent.log.setLevel("WARNING")
+    agent.SNMP_V3_USERS = [
+        {"user": "benchauth", "auth": "sha", "auth_key": "benchauth2025", "priv": "none", "view": "readonly"},
+        {"user": "benchpriv", "auth": "sha", "auth_key": "benchauth2025", "priv": "aes", "priv_key": "benchpriv2025", "view": "readonly"},
+    ]
+    print_header("SNMPv3: coste de autenticación y cifrado frente a v2c")
+    print(f"{V3_REQUESTS} GET por nivel, {V3_CONCURRENCY} en vuelo (cliente y agente en el mismo proceso)\n")
+    print(f"  {'Nivel':<10} | {'Tiempo (ms)':>11} | {'Peticiones/s':>12} | {'vs v2c':>7} | {'Errores':>7}")
+    print("  " + "-" * 60)
+    with tempfile.TemporaryDirectory() as directory:
+        results = asyncio.run(v3_agent(agent, directory, V3_LEVELS))
+    baseline = results[0][1]
+    for name, elapsed, errors in results:
+        print(f"  {name:<10} | {elapsed*1000:11.1f} | {V3_REQUESTS/elapsed:12.0f} | {elapsed/baseline:6.2f}x | {errors:>7}")
+    
+    print(f"\nPreparación de claves USM para {V3_KEY_USERS} usuarios authPriv (SHA + AES)\n")
+    users = [{"user": f"user{i}", "auth": "sha", "auth_key": f"authpass{i:04d}", "priv": "aes", "priv_key": f"privpass{i:04d}",
+              "view": "readonly"} for i in range(V3_KEY_USERS)]
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "usm_keys.json")
+        print(f"  {'Arranque':<22} | {'Tiempo (ms)':>11} | {'Derivadas':>9} | {'De caché':>8}")
+        print("  " + "-" * 60)
+        for label in ("Primero (sin caché)", "Siguiente (con caché)"):
+            key_cache = agent.UsmKeyCache(filepath)
+            engine_id = key_cache.engine_id()
+            start = time.perf_counter()
+            for user in users:
+                key_cache.localized(user, engine_id)
+            elapsed = time.perf_counter() - start
+            key_cache.save()
+            print(f"  {label:<22} | {elapsed*1000:11.2f} | {key_cache.stats['derived']:>9} | {key_cache.stats['hits']:>8}")
+
+
+def udp_client(port, message, seconds, results): # Mantiene WORKER_WINDOW GET en vuelo durante seconds y cuenta las respuestas
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(("127.0.0.1", port))
+    sock.settimeout(0.5)
+    answered = lost = 0
+    deadline = time.perf_counter() + seconds
+    for _ in range(WORKER_WINDOW):
+        sock.send(message)
+    while time.perf_counter() < deadline:
+        try:
+            sock.recv(2048)
+            answered += 1
+            sock.send(message)
+        except socket.timeout: # Datagramas perdidos: volver a llenar la ventana
+            lost += WORKER_WINDOW
+            for _ in range(WORKER_WINDOW):
+                sock.send(message)
+    results.put((answered, lost))
+
+
+def bench_workers(): # Benchmark: peticiones por segundo del agente real frente al número de procesos
+    print_header("Multiproceso: GET por segundo frente a --workers")
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT no disponible en este sistema")
+        return
+    print(f"{WORKER_CLIENTS} clientes con {WORKER_WINDOW} GET en vuelo cada uno durante {WORKER_SECONDS} s "
+          f"| CPUs disponibles: {os.cpu_count()}\n")
+    print(f"  {'Procesos':>8} | {'Respuestas':>10} | {'GET/s':>8} | {'vs 1':>6} | {'Perdidas':>8}")
+    print("  " + "-" * 52)
+    message = encode_get((1, 3, 6, 1, 4, 1, 28308, 1, 1, 0))
+    baseline = None
+    for workers in WORKER_COUNTS:
+        with tempfile.TemporaryDirectory() as directory:
+            port = free_port()
+            process = start_agent(directory, port, "--workers", str(workers))
+            time.sleep(0.5) # Dejar que terminen de arrancar los trabajadores
+            try:
+                results = multiprocessing.Queue()
+                clients = [multiprocessing.Process(target=udp_client, args=(port, message, WORKER_SECONDS, results))
+                           for _ in range(WORKER_CLIENTS)]
+                for client in clients:
+                    client.start()
+                totals = [results.get() for _ in clients]
+                for client in clients:
+                    client.join()
+            finally:
+                stop_agent(process)
+        answered = sum(count for count, _ in totals)
+        lost = sum(count for _, count in totals)
+        rate = answered / WORKER_SECONDS
+        baseline = baseline or rate
+        print(f"  {workers:>8} | {answered:>10} | {rate:8.0f} | {rate/baseline:5.2f}x | {lost:>8}")
+
+
+def mmap_writer(filepath, manager_oid, email_oid, stop): # Proceso escritor: SETs dobles que siempre deben verse juntos
+    shared = MmapStore(filepath, writable=True)
+    i = 0
+    while not stop.is_set():
+        i += 1
+        shared.commit_many([(manager_oid, f"m{i}"), (email_oid, f"m{i}@bench")])
+    shared.close()
+
+
+def mmap_reader(filepath, manager_oid, email_oid, stop, results): # Proceso lector: comprueba que cada pareja leída es coherente
+    shared = MmapStore(filepath)
+    reads = inconsistent = stalled = 0
+    while not stop.is_set():
+        try:
+            (_, manager), (_, email) = shared.get_many([manager_oid, email_oid])
+        except TimeoutError: # El escritor dejó la secuencia en impar: el lector no debe quedarse colgado
+            stalled = 1
+            break
+        manager, email = str(manager), str(email)
+        if email != f"{manager}@bench" and manager != "Ruben":
+            inconsistent += 1
+        reads += 1
+    results.put((reads, inconsistent, shared.stats["retries"], stalled))
+    shared.close()
+
+
+def bench_mmap(): # Benchmark: MIB compartida en memoria mapeada frente a JsonStore
+    print_header("MIB compartida: registros fijos en un fichero mapeado en memoria")
+    print(f"  {'Objetos':>8} | {'JsonStore get':>13} | {'mmap get':>9} | {'mmap fijado':>11} | "
+          f"{'SET+volcado JSON':>16} | {'SET mmap':>9}")
+    print(f"  {'':>8} | {'(µs)':>13} | {'(µs)':>9} | {'(µs)':>11} | {'(µs)':>16} | {'(µs)':>9}")
+    print("  " + "-" * 80)
+    for size in MMAP_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            store = make_store(directory, size)
+            shared = MmapStore.mirror(os.path.join(directory, "mib.bin"), store)
+            reader = MmapStore(shared.filepath)
+            oids = sorted(store.oid_map)
+            manager_oid = next(oid for oid, name in store.oid_map.items() if name == "manager")
+            
+            start = time.perf_counter()
+            for i in range(MMAP_READS):
+                store.get_exact(oids[i % size])
+            json_get = (time.perf_counter() - start) / MMAP_READS
+            start = time.perf_counter()
+            for i in range(MMAP_READS):
+                reader.get_exact(oids[i % size])
+            mmap_get = (time.perf_counter() - start) / MMAP_READS
+            snap = reader.pin()
+            start = time.perf_counter()
+            for i in range(MMAP_READS):
+                reader.get_exact(oids[i % size], snap)
+            mmap_pinned = (time.perf_counter() - start) / MMAP_READS
+            
+            writes = max(1, MMAP_WRITES // (size // 100)) # El volcado JSON crece con la MIB: menos repeticiones
+            store.listeners.clear()
+            start = time.perf_counter()
+            for i in range(writes): # Lo que cuesta hacer visible un SET a otro proceso a través de mib_state.json
+                store.commit_set(manager_oid, agent.v2c.OctetString(f"m{i}"))
+                store.save()
+            json_set = (time.perf_counter() - start) / writes
+            start = time.perf_counter()
+            for i in range(MMAP_WRITES):
+                shared.commit_set(manager_oid, agent.v2c.OctetString(f"m{i}"))
+            mmap_set = (time.perf_counter() - start) / MMAP_WRITES
+            reader.close()
+            shared.close()
+        print(f"  {size:>8} | {json_get*1e6:13.2f} | {mmap_get*1e6:9.2f} | {mmap_pinned*1e6:11.2f} | "
+              f"{json_set*1e6:16.1f} | {mmap_set*1e6:9.2f}")
+    
+    print(f"\nUn proceso escritor y {STRESS_READERS} lectores sobre el mismo fichero durante {MMAP_SECONDS} s\n")
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(directory, STRESS_WALK_SIZE)
+        shared = MmapStore.mirror(os.path.join(directory, "mib.bin"), store)
+        manager_oid = next(oid for oid, name in store.oid_map.items() if name == "manager")
+        email_oid = next(oid for oid, name in store.oid_map.items() if name == "managerEmail")
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=mmap_writer, args=(shared.filepath, manager_oid, email_oid, stop))]
+        processes += [multiprocessing.Process(target=mmap_reader, args=(shared.filepath, manager_oid, email_oid, stop, results))
+                      for _ in range(STRESS_READERS)]
+        for process in processes:
+            process.start()
+        time.sleep(MMAP_SECONDS)
+        stop.set()
+        totals = [results.get() for _ in range(STRESS_READERS)]
+        for process in processes:
+            process.join()
+        shared.close()
+    reads = sum(total[0] for total in totals)
+    inconsistent = sum(total[1] for total in totals)
+    retries = sum(total[2] for total in totals)
+    stalled = sum(total[3] for total in totals)
+    print(f"  Lecturas dobles: {reads} | Reintentos del seqlock: {retries} | Incoherentes: {inconsistent} | Lectores bloqueados: {stalled}")
+    if inconsistent or stalled:
+        raise SystemExit("  ❌ Algún lector vio un SET a medias o no logró una lectura coherente")
+    print("  ✅ Todas las lecturas entre procesos fueron coherentes")
+
+
+def first_response(port, process): # Segundos hasta que el agente recién lanzado responde al primer GET
+    message = encode_get((1, 3, 6, 1, 4, 1, 28308, 1, 1, 0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.02)
+    start = time.perf_counter()
+    try:
+        while process.poll() is None:
+            try:
+                sock.sendto(message, ("127.0.0.1", port))
+                sock.recv(2048)
+                return time.perf_counter() - start
+            except OSError:
+                pass
+        raise RuntimeError("el agente terminó sin responder")
+    finally:
+        sock.close()
+
+
+def bench_coldstart(): # Benchmark: arranque desde mib_state.json frente a la instantánea binaria
+    print_header("Arranque en frío: JSON frente a instantánea binaria")
+    print(f"  {'Objetos':>8} | {'JSON':>8} | {'Instantánea':>11} | {'Carga JSON':>10} | {'Carga inst.':>11} | "
+          f"{'Mejora':>6} | {'Escritura inst.':>15}")
+    print(f"  {'':>8} | {'(MB)':>8} | {'(MB)':>11} | {'(ms)':>10} | {'(ms)':>11} | {'':>6} | {'(ms)':>15}")
+    print("  " + "-" * 88)
+    startups = []
+    for size in COLDSTART_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, "mib_state.json")
+            snap_path = os.path.join(directory, "mib_state.snap")
+            store = make_store(directory, size)
+            store.export_json()
+            start = time.perf_counter()
+            agent.write_atomic(snap_path, agent.encode_snapshot(store.snapshot))
+            write_time = time.perf_counter() - start
+            
+            json_load = snap_load = float("inf")
+            for _ in range(COLDSTART_LOADS):
+                start = time.perf_counter()
+                agent.JsonStore(json_path)
+                json_load = min(json_load, time.perf_counter() - start)
+                start = time.perf_counter()
+                loaded = agent.JsonStore(json_path, snap_path)
+                snap_load = min(snap_load, time.perf_counter() - start)
+            assert loaded.load_source == "snapshot" and loaded.snapshot.model == store.snapshot.model
+            print(f"  {size:>8} | {os.path.getsize(json_path)/1e6:8.2f} | {os.path.getsize(snap_path)/1e6:11.2f} | "
+                  f"{json_load*1000:10.1f} | {snap_load*1000:11.1f} | {json_load/snap_load:5.1f}x | {write_time*1000:15.1f}")
+            
+            row = [size]
+            for source in ("json", "snapshot"): # El agente real, como lo relanzaría un supervisor
+                if source == "json":
+                    os.rename(snap_path, snap_path + ".bak")
+                else:
+                    os.replace(snap_path + ".bak", snap_path)
+                    store.export_json() # El agente guardó el JSON al salir: volver a dejarlo más antiguo
+                    os.utime(snap_path)
+                port = free_port()
+                process = launch_agent(directory, port)
+                try:
+                    row.append(first_response(port, process))
+                finally:
+                    stop_agent(process, 30)
+            startups.append(row)
+    
+    print("\nAgente real: desde que se lanza el proceso hasta la primera respuesta a un GET\n")
+    print(f"  {'Objetos':>8} | {'Desde JSON (s)':>14} | {'Desde instantánea (s)':>21}")
+    print("  " + "-" * 52)
+    for size, from_json, from_snapshot in startups:
+        print(f"  {size:>8} | {from_json:14.2f} | {from_snapshot:21.2f}")
+
+
+def wal_store(directory, size, policy): # make_store con instantánea y WAL (política de fsync policy)
+    store = make_store(directory, size)
+    store.snapshot_path = os.path.join(directory, "mib_state.snap")
+    store.flush() # Los objetos sintéticos quedan en la instantánea, no en el WAL
+    store.attach_wal(agent.WriteAheadLog(os.path.join(directory, "mib_state.wal"), policy))
+    return store
+
+
+async def group_sets(store, oid, concurrency): # WAL_SETS SETs con concurrency en vuelo, cada uno esperando a su fsync
+    async def client(count):
+        for i in range(count):
+            store.commit_set(oid, agent.v2c.Integer(i % 100))
+            await store.wal.durable(store.wal.appended)
+    await asyncio.gather(*(client(WAL_SETS // concurrency) for _ in range(concurrency)))
+
+
+def bench_wal(): # Benchmark: SET durable con WAL frente a reescribir el estado completo
+    print_header("WAL: coste de un SET durable frente al tamaño de la MIB")
+    print(f"  {'Objetos':>8} | {'SET en memoria':>14} | {'+ instantánea':>13} | {'+ WAL (fsync)':>13} | {'solo WAL':>9}")
+    print(f"  {'':>8} | {'(µs)':>14} | {'(ms)':>13} | {'(µs)':>13} | {'(µs)':>9}")
+    print("  " + "-" * 70)
+    for size in WAL_SIZES:
+        with tempfile.TemporaryDirectory() as directory:
+            store = wal_store(directory, size, "always")
+            oid = next(oid for oid, name in store.oid_map.items() if name == "cpuThreshold")
+            wal, store.wal = store.wal, None
+            start = time.perf_counter()
+            for i in range(WAL_SETS):
+                store.commit_set(oid, agent.v2c.Integer(i % 100))
+            memory = (time.perf_counter() - start) / WAL_SETS
+            writes = max(3, WAL_SETS // max(1, size // 100)) # La instantánea crece con la MIB: menos repeticiones
+            start = time.perf_counter()
+            for i in range(writes): # Lo que costaba hacer durable cada SET reescribiendo el estado completo
+                store.commit_set(oid, agent.v2c.Integer(i % 100))
+                store.save()
+            rewrite = (time.perf_counter() - start) / writes
+            store.wal = wal
+            start = time.perf_counter()
+            for i in range(WAL_SETS):
+                store.commit_set(oid, agent.v2c.Integer(i % 100))
+            logged = (time.perf_counter() - start) / WAL_SETS
+            wal.close()
+        print(f"  {size:>8} | {memory*1e6:14.1f} | {rewrite*1000:13.2f} | {logged*1e6:13.1f} | {(logged - memory)*1e6:9.1f}")
+    
+    print(f"\nCompromiso en grupo: {WAL_SETS} SETs que esperan a estar en disco antes de responder\n")
+    print(f"  {'En vuelo':>8} | {'SET/s':>8} | {'fsync':>6} | {'SET por fsync':>13}")
+    print("  " + "-" * 46)
+    for concurrency in WAL_CONCURRENCY:
+        with tempfile.TemporaryDirectory() as directory:
+            store = wal_store(directory, 100, "group")
+            oid = next(oid for oid, name in store.oid_map.items() if name == "cpuThreshold")
+            start = time.perf_counter()
+            asyncio.run(group_sets(store, oid, concurrency))
+            elapsed = time.perf_counter() - start
+            fsyncs = store.wal.stats["fsyncs"]
+            store.wal.close()
+        print(f"  {concurrency:>8} | {WAL_SETS/elapsed:8.0f} | {fsyncs:>6} | {WAL_SETS/fsyncs:13.1f}")
+    
+    print(f"\nRecuperación: {WAL_REPLAY_RECORDS} cambios en el WAL y un registro a medias al final\n")
+    with tempfile.TemporaryDirectory() as directory:
+        store = wal_store(directory, 100, "none")
+        oid = next(oid for oid, name in store.oid_map.items() if name == "cpuThreshold")
+        for i in range(WAL_REPLAY_RECORDS):
+            store.commit_set(oid, agent.v2c.Integer(i % 100))
+        store.wal.close()
+        with open(store.wal.filepath, "ab") as f: # Corte a mitad de escritura
+            f.write(agent.WAL_RECORD.pack(64, 0) + b"torn")
+        start = time.perf_counter()
+        recovered = agent.JsonStore(store.filepath, store.snapshot_path)
+        replayed = recovered.attach_wal(agent.WriteAheadLog(store.wal.filepath, "none"))
+        elapsed = time.perf_counter() - start
+        value = recovered.model["scalars"]["cpuThreshold"]["value"]
+        print(f"  {replayed} cambios aplicados en {elapsed*1000:.0f} ms | colas rotas descartadas: {recovered.wal.stats['torn']} | "
+              f"cpuThreshold = {value} (esperado {(WAL_REPLAY_RECORDS - 1) % 100})")
+        recovered.wal.close()
+
+
+def handler_pdus(store): # (nombre, clase del manejador, PDU) de cada tipo de petición medido
+    oid = agent.v2c.ObjectIdentifier(next(iter(store.oid_map)))
+    get = agent.v2c.GetRequestPDU()
+    agent.v2c.apiPDU.setDefaults(get)
+    agent.v2c.apiPDU.setVarBinds(get, [(oid, agent.v2c.null)])
+    getnext = agent.v2c.GetNextRequestPDU()
+    agent.v2c.apiPDU.setDefaults(getnext)
+    agent.v2c.apiPDU.setVarBinds(getnext, [(oid, agent.v2c.null)])
+    bulk = agent.v2c.GetBulkRequestPDU()
+    agent.v2c.apiBulkPDU.setDefaults(bulk)
+    agent.v2c.apiBulkPDU.setMaxRepetitions(bulk, 20)
+    agent.v2c.apiBulkPDU.setVarBinds(bulk, [(oid, agent.v2c.null)])
+    return [("GET", agent.JsonGet, get), ("GETNEXT", agent.JsonGetNext, getnext), ("GETBULK x20", agent.JsonGetBulk, bulk)]
+
+
+def bench_metrics(): # Benchmark: coste de anotar las métricas de una PDU frente al tiempo del manejador
+    print_header("Métricas: sobrecarga de la instrumentación por PDU")
+    print(f"  {METRICS_SIZE} objetos, {METRICS_ITERATIONS} PDUs por medición, sin red (sendPdu no envía nada)\n")
+    print(f"  {'PDU':>12} | {'Manejador':>9} | {'Métricas':>8} | {'Sobrecarga':>10}")
+    print(f"  {'':>12} | {'(µs)':>9} | {'(µs)':>8} | {'':>10}")
+    print("  " + "-" * 50)
+    with tempfile.TemporaryDirectory() as directory:
+        store = make_store(directory, METRICS_SIZE)
+        snmpEngine = agent.engine.SnmpEngine()
+        snmpContext = agent.context.SnmpContext(snmpEngine)
+        for name, handler_class, pdu in handler_pdus(store):
+            handler = handler_class(snmpEngine, snmpContext, store)
+            handler.sendPdu = lambda *args: None # Solo se mide el manejador
+            start = time.perf_counter()
+            for i in range(METRICS_ITERATIONS):
+                handler.handleMgmtOperation(snmpEngine, i, None, pdu)
+            total = (time.perf_counter() - start) / METRICS_ITERATIONS
+            metrics = agent.PduMetrics(name, agent.MetricsRegistry()) # Las mismas series, en un registro aparte
+            start = time.perf_counter()
+            for _ in range(METRICS_ITERATIONS):
+                metrics.record(time.perf_counter(), 0, 1)
+            record = (time.perf_counter() - start) / METRICS_ITERATIONS
+            print(f"  {name:>12} | {total*1e6:9.1f} | {record*1e6:8.2f} | {record/(total - record)*100:9.1f}%")
+    
+    start = time.perf_counter()
+    text = agent.METRICS.render()
+    print(f"\nExposición OpenMetrics: {len(text)} bytes en {(time.perf_counter() - start)*1000:.2f} ms "
+          f"({agent.METRICS.families['snmp_agent_requests'].series[('get',)].value} GET anotados)")
+
+
+BENCHMARKS = {
+    "walk": bench_walk,
+    "get": bench_get,
+    "stress": bench_stress,
+    "table": bench_table,
+    "cpucache": bench_cpucache,
+    "history": bench_history,
+    "notify": bench_notify,
+    "v3": bench_v3,
+    "workers": bench_workers,
+    "mmap": bench_mmap,
+    "coldstart": bench_coldstart,
+    "wal": bench_wal,
+    "metrics": bench_metrics,
+}
+
+
+def main(): # Ejecuta los benchmarks seleccionados (todos por defecto)
+    parser = argparse.ArgumentParser(description="Benchmarks del mini agente SNMP")
+    parser.add_argument("benchmarks", nargs="*", choices=sorted(BENCHMARKS), help="Benchmarks a ejecutar (todos si se omite)")
+    args = parser.parse_args()
+
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
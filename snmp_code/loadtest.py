@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+loadtest.py - Generador de carga para el mini agente SNMP.
+Arranca el agente real en un puerto UDP sin privilegios de 127.0.0.1, con las alertas hacia un puerto local
+cerrado (agent_launcher.py), y lo ataca con clientes pysnmp asyncio (sin lanzar un proceso por petición) con la
+concurrencia y la mezcla de PDUs indicadas. Mide peticiones por segundo y latencias p50/p99/p999 de cada tipo de PDU y puede guardarlas en JSON. Con --baseline compara el
+resultado con una ejecución de referencia de la misma máquina (generada con --save-baseline, no versionada) y
+termina con código 1 si JsonGet, JsonGetNext, JsonGetBulk o JsonSet han empeorado más de lo tolerado, o con
+código 2 si no hay referencia o la máquina o la configuración no coinciden.
+
+Uso: python loadtest.py [--duration 10] [--concurrency 16] [--clients 1] [--mix get=70,getnext=15,getbulk=10,set=5]
+                        [--json resultados.json] [--baseline loadtest_baseline.json] [--save-baseline FICHERO]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from agent_launcher import AGENT_IP, free_port, start_agent, stop_agent
+
+# Configuración Global
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+COMMUNITY_RO = "public"
+COMMUNITY_RW = "private"
+BASE_OID = "1.3.6.1.4.1.28308"
+
+# OIDs del Agente
+OID_MANAGER = f"{BASE_OID}.1.1.0"
+OID_EMAIL = f"{BASE_OID}.1.2.0"
+OID_CPU_USAGE = f"{BASE_OID}.1.3.0"
+OID_CPU_THRESHOLD = f"{BASE_OID}.1.4.0"
+GET_OIDS = [OID_MANAGER, OID_EMAIL, OID_CPU_USAGE, OID_CPU_THRESHOLD] # OIDs que se leen con GET y desde los que se lanza GETNEXT
+
+DEFAULT_MIX = "get=70,getnext=15,getbulk=10,set=5" # Peso de cada tipo de PDU
+DEFAULT_DURATION = 10 # Segundos de medición
+DEFAULT_WARMUP = 1 # Segundos iniciales que no se miden
+DEFAULT_CONCURRENCY = 16 # Peticiones en vuelo (repartidas entre los procesos cliente)
+DEFAULT_TOLERANCE = 0.25 # Empeoramiento máximo admitido frente a la referencia (25%)
+BULK_REPETITIONS = 10 # max-repetitions de cada GETBULK
+REQUEST_TIMEOUT = 2 # Segundos de timeout de cada petición (sin reintentos)
+
+HANDLERS = { # Manejador del agente que atiende cada tipo de PDU
+    "get": "JsonGet",
+    "getnext": "JsonGetNext",
+    "getbulk": "JsonGetBulk",
+    "set": "JsonSet",
+}
+
+
+def print_header(title): # Imprime un encabezado de sección bonito
+    print(f"\n{'='*60}")
+    print(f" {title.upper()} ")
+    print(f"{'='*60}")
+
+
+def parse_mix(text): # "get=70,set=5" -> {"get": 70.0, "set": 5.0}
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip().lower()
+        if name not in HANDLERS:
+            raise argparse.ArgumentTypeError(f"tipo de PDU desconocido: {name!r} (válidos: {', '.join(HANDLERS)})")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"peso no válido para {name}: {weight!r}")
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("la mezcla necesita al menos un peso positivo")
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def agent_args(args): # Opciones del agente que dependen de las de la carga
+    extra = ["--workers", str(args.workers)]
+    if args.wal_fsync:
+        extra += ["--wal-fsync", args.wal_fsync]
+    return extra
+
+
+async def run_client(port, mix, concurrency, warmup, duration, seed): # Un cliente asyncio: concurrency peticiones en vuelo
+    from pysnmp.hlapi.v3arch import asyncio as hlapi
+    client = hlapi.SnmpEngine()
+    target = await hlapi.UdpTransportTarget.create((AGENT_IP, port), timeout=REQUEST_TIMEOUT, retries=0)
+    read, write, context = hlapi.CommunityData(COMMUNITY_RO), hlapi.CommunityData(COMMUNITY_RW), hlapi.ContextData()
+    samples = {name: [] for name in mix} # Latencias (s) de las respuestas correctas
+    errors = {name: 0 for name in mix}
+    names, weights = list(mix), list(mix.values())
+    rng = random.Random(seed)
+    counter = 0
+
+    def request(name): # Corrutina de una petición del tipo name
+        nonlocal counter
+        counter += 1
+        if name == "get":
+            return hlapi.getCmd(client, read, target, context, hlapi.ObjectType(hlapi.ObjectIdentity(rng.choice(GET_OIDS))))
+        if name == "getnext":
+            return hlapi.nextCmd(client, read, target, context, hlapi.ObjectType(hlapi.ObjectIdentity(rng.choice(GET_OIDS))))
+        if name == "getbulk":
+            return hlapi.bulkCmd(client, read, target, context, 0, BULK_REPETITIONS, hlapi.ObjectType(hlapi.ObjectIdentity(BASE_OID)))
+        return hlapi.setCmd(client, write, target, context, # manager no dispara alertas (el umbral de CPU sí podría)
+                            hlapi.ObjectType(hlapi.ObjectIdentity(OID_MANAGER), hlapi.OctetString(f"loadtest-{seed}-{counter}")))
+
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    async def worker():
+        while True:
+            sent = time.perf_counter()
+            if sent >= deadline:
+                return
+            name = rng.choices(names, weights)[0]
+            errorIndication, errorStatus, _, _ = await request(name)
+            if sent < measure_from:
+                continue
+            if errorIndication or errorStatus:
+                errors[name] += 1
+            else:
+                samples[name].append(time.perf_counter() - sent)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    client.transportDispatcher.closeDispatcher()
+    return samples, errors
+
+
+def client_process(port, mix, concurrency, warmup, duration, seed, results): # Proceso cliente (con --clients > 1)
+    results.put(asyncio.run(run_client(port, mix, concurrency, warmup, duration, seed)))
+
+
+def run_clients(port, args): # Lanza los clientes y junta sus latencias y errores
+    shares = [args.concurrency // args.clients + (i < args.concurrency % args.clients) for i in range(args.clients)]
+    if args.clients == 1:
+        parts = [asyncio.run(run_client(port, args.mix, shares[0], args.warmup, args.duration, args.seed))]
+    else:
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client_process,
+                                             args=(port, args.mix, share, args.warmup, args.duration, args.seed + i, results))
+                     for i, share in enumerate(shares)]
+        for process in processes:
+            process.start()
+        parts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    samples = {name: [] for name in args.mix}
+    errors = {name: 0 for name in args.mix}
+    for part_samples, part_errors in parts:
+        for name in args.mix:
+            samples[name].extend(part_samples[name])
+            errors[name] += part_errors[name]
+    return samples, errors
+
+
+def percentile(ordered, fraction): # Percentil por rango más cercano de una lista ya ordenada
+    if not ordered:
+        return None
+    return ordered[max(1, math.ceil(fraction * len(ordered))) - 1]
+
+
+def summarize(latencies, errors, duration, handler): # Resultado de un tipo de PDU (tiempos en ms)
+    ordered = sorted(latencies)
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "handler": handler,
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput": round(len(ordered) / duration, 1),
+        "p50_ms": to_ms(percentile(ordered, 0.5)),
+        "p99_ms": to_ms(percentile(ordered, 0.99)),
+        "p999_ms": to_ms(percentile(ordered, 0.999)),
+    }
+
+
+def build_report(args, samples, errors): # Resultado completo, listo para guardar en JSON
+    results = {name: summarize(samples[name], errors[name], args.duration, HANDLERS[name]) for name in args.mix}
+    results["total"] = summarize([value for name in args.mix for value in samples[name]], sum(errors.values()),
+                                 args.duration, None)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"name": platform.node(), "machine": platform.machine(), "cpus": os.cpu_count(), "python": sys.version.split()[0]},
+        "config": {"duration": args.duration, "warmup": args.warmup, "concurrency": args.concurrency,
+                   "clients": args.clients, "workers": args.workers, "wal_fsync": args.wal_fsync, "mix": args.mix,
+                   "bulk_repetitions": BULK_REPETITIONS},
+        "results": results,
+    }
+
+
+def compare(report, baseline, tolerance): # Regresiones frente a la referencia (lista de textos; vacía si no hay)
+    regressions = []
+    for name, reference in baseline["results"].items():
+        current = report["results"].get(name)
+        if name == "total" or current is None:
+            continue
+        label = reference.get("handler") or name
+        if current["errors"] > reference["errors"] + max(1, reference["requests"] * 0.001):
+            regressions.append(f"{label}: {current['errors']} errores (referencia {reference['errors']})")
+        if current["throughput"] < reference["throughput"] * (1 - tolerance):
+            regressions.append(f"{label}: {current['throughput']:.0f} peticiones/s (referencia {reference['throughput']:.0f})")
+        for key in ("p50_ms", "p99_ms"):
+            if reference[key] and current[key] and current[key] > reference[key] * (1 + tolerance):
+                regressions.append(f"{label}: {key} {current[key]:.2f} ms (referencia {reference[key]:.2f} ms)")
+    return regressions
+
+
+def print_report(report): # Tabla legible de los resultados
+    print(f"\n  {'PDU':<8} | {'Manejador':<11} | {'Respuestas':>10} | {'Errores':>7} | {'Peticiones/s':>12} | "
+          f"{'p50 (ms)':>8} | {'p99 (ms)':>8} | {'p999 (ms)':>9}")
+    print("  " + "-" * 94)
+    fmt = lambda value: "-" if value is None else f"{value:.2f}"
+    for name, result in report["results"].items():
+        print(f"  {name.upper():<8} | {result['handler'] or '':<11} | {result['requests']:>10} | {result['errors']:>7} | "
+              f"{result['throughput']:12.1f} | {fmt(result['p50_ms']):>8} | {fmt(result['p99_ms']):>8} | {fmt(result['p999_ms']):>9}")
+
+
+def parse_args(): # Opciones de la línea de comandos
+    parser = argparse.ArgumentParser(description="Generador de carga del mini agente SNMP")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Segundos de medición (por defecto %(default)s)")
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP, help="Segundos iniciales sin medir (por defecto %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Peticiones en vuelo (por defecto %(default)s)")
+    parser.add_argument("--clients", type=int, default=1, help="Procesos cliente entre los que se reparte la concurrencia")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), metavar="PDU=PESO,...",
+                        help=f"Mezcla de PDUs: get, getnext, getbulk, set (por defecto {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=1, help="Semilla de la elección de PDUs y OIDs")
+    parser.add_argument("--workers", type=int, default=1, help="Procesos del agente (--workers del agente)")
+    parser.add_argument("--wal-fsync", help="Política de fsync del WAL del agente (--wal-fsync del agente)")
+    parser.add_argument("--port", type=int, help="Puerto UDP del agente (por defecto uno libre)")
+    parser.add_argument("--json", metavar="FICHERO", help="Guardar los resultados en JSON ('-' para la salida estándar)")
+    parser.add_argument("--baseline", nargs="?", const=BASELINE_FILE, metavar="FICHERO",
+                        help="Comparar con una referencia de esta máquina y fallar si hay regresiones (por defecto loadtest_baseline.json)")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_FILE, metavar="FICHERO",
+                        help="Guardar este resultado como referencia de esta máquina (por defecto loadtest_baseline.json, no versionado)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Empeoramiento admitido frente a la referencia (por defecto %(default)s)")
+    args = parser.parse_args()
+    if args.concurrency < 1 or args.clients < 1 or args.clients > args.concurrency:
+        parser.error("--concurrency y --clients deben ser al menos 1 y --clients no puede superar a --concurrency")
+    if args.duration <= 0:
+        parser.error("--duration debe ser positivo")
+    return args
+
+
+def main(): # Arranca el agente, genera la carga y compara con la referencia
+    args = parse_args()
+    quiet = args.json == "-" # La salida estándar es solo para el JSON
+    say = (lambda *a, **k: print(*a, file=sys.stderr, **k)) if quiet else print
+    port = args.port or free_port()
+
+    with tempfile.TemporaryDirectory() as directory: # Estado nuevo: no toca mib_state.json del proyecto
+        process = start_agent(directory, port, *agent_args(args))
+        try:
+            if not quiet:
+                print_header("Carga sobre el agente SNMP")
+            say(f"Agente en {AGENT_IP}:{port} ({args.workers} proceso(s)) | {args.concurrency} peticiones en vuelo en "
+                f"{args.clients} cliente(s) | {args.duration} s (+{args.warmup} s de calentamiento)")
+            say("Mezcla: " + ", ".join(f"{name}={weight:g}" for name, weight in args.mix.items()))
+            samples, errors = run_clients(port, args)
+        finally:
+            stop_agent(process)
+
+    report = build_report(args, samples, errors)
+    if not quiet:
+        print_report(report)
+    if args.json:
+        payload = json.dumps(report, indent=2)
+        if quiet:
+            print(payload)
+        else:
+            with open(args.json, "w") as f:
+                f.write(payload + "\n")
+            print(f"\n💾 Resultados guardados en {args.json}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+        say(f"💾 Referencia guardada en {args.save_baseline}")
+
+    if args.baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            say(f"\n❌ No existe {args.baseline}: genérala en esta máquina con --save-baseline")
+            sys.exit(2)
+        for section, label in (("host", "la máquina"), ("config", "la configuración")):
+            if baseline.get(section) != report[section]: # Números absolutos: solo se comparan en la misma máquina y con la misma carga
+                say(f"\n❌ {label.capitalize()} difiere de la de {args.baseline}: no se compara "
+                    f"(referencia {baseline.get(section)}, ahora {report[section]})")
+                sys.exit(2)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            say(f"\n❌ Regresiones frente a {args.baseline} (tolerancia {args.tolerance:.0%}):")
+            for line in regressions:
+                say(f"   - {line}")
+            sys.exit(1)
+        say(f"\n✅ Sin regresiones frente a {args.baseline} (tolerancia {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,39 @@ This agent works on pysnmp 7.1.4
 
 import json
 import os
+import hashlib
+import sys
+import bisect
+import cProfile
+import heapq
+import io
+import math
+import multiprocessing
+import pickle
+import pstats
+from array import array
+import argparse
+import logging
+import logging.handlers
+import marshal
+import queue
+import struct
 import time
 import threading
+import tracemalloc
+import signal
 import smtplib
+import socket
+import ssl
+import zlib
 import keyboard
 import psutil
-import asyncio  # <-- NUEVO: usaremos asyncio para el muestreo de CPU
+import asyncio  # Un único bucle asyncio para el transporte SNMP, el muestreo, las notificaciones y la persistencia
 from pysnmp.entity import engine, config
 from pysnmp.entity.rfc3413 import cmdrsp, ntforg, context
 from pysnmp.carrier.asyncio.dgram import udp
 from pysnmp.proto.api import v2c
+from pyasn1.codec.ber import encoder
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText as MIMETextPart
 
@@ -23,6 +46,8 @@ from email.mime.text import MIMEText as MIMETextPart
 
 # Constantes iniciales
 JSON_FILE = "mib_state.json"
+SNAPSHOT_FILE = "mib_state.snap"  # Instantánea binaria del estado: se carga al arrancar en lugar del JSON si es más reciente
+WAL_FILE = "mib_state.wal"  # Registro de cambios (write-ahead log) posteriores a la instantánea
 AGENT_START = time.time()
 
 
@@ -30,23 +55,835 @@ AGENT_START = time.time()
 GMAIL_USER = "fakeunizar@gmail.com"  
 GMAIL_PASSWORD = "ldwb lraj msnw smoo"  
 
+# Servidor SMTP para las alertas. Para pruebas se puede apuntar a un servidor local (p. ej. MailHog en
+# localhost:1025 con SMTP_TLS = "none" y SMTP_USER = None).
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_TLS = "ssl"  # "ssl" (SMTP sobre TLS), "starttls" o "none"
+SMTP_USER = GMAIL_USER  # None para no autenticarse
+SMTP_PASSWORD = GMAIL_PASSWORD
+SMTP_TIMEOUT = 10  # Segundos de timeout de conexión y de cada comando
+SMTP_IDLE_TIMEOUT = 60  # Segundos sin enviar tras los que se cierra la sesión SMTP reutilizada
+EMAIL_FROM = GMAIL_USER  # Remitente de las alertas
+EMAIL_DIGEST_WINDOW = 0  # Segundos durante los que se agrupan alertas en un único email por destinatario (0 = sin agrupar)
+
+
+# Registro (logging): DEBUG reproduce la salida detallada original, INFO escribe una línea por PDU
+# y WARNING es el modo producción silencioso. Se puede cambiar al arrancar con --verbose, --quiet o --log-level.
+LOG_LEVEL = "INFO"
+LOG_JSON = False  # True para emitir cada registro como una línea JSON (también con --log-json)
+
+
+# Cola de notificaciones: el muestreador publica alertas y unos trabajadores dedicados entregan traps y emails
+NOTIFY_QUEUE_SIZE = 100  # Capacidad de la cola de cada canal (trap, email)
+NOTIFY_DROP_POLICY = "drop-oldest"  # Con la cola llena: "drop-oldest", "drop-newest" o "block"
+NOTIFY_BLOCK_TIMEOUT = 1.0  # Espera máxima (s) del muestreador con la política "block" antes de descartar la alerta
+NOTIFY_EMAIL_WORKERS = 1  # Trabajadores que envían emails en paralelo
+
+# Gobernador de notificaciones: una CPU que oscila alrededor del umbral no debe inundar al gestor
+NOTIFY_HYSTERESIS = 5  # Puntos por debajo de cpuThreshold a los que tiene que bajar la CPU para rearmar la alerta
+NOTIFY_MIN_HOLD = 60  # Segundos mínimos desde una alerta hasta que se puede rearmar
+NOTIFY_RATE_PER_MINUTE = 2  # Notificaciones por minuto que repone el cubo de tokens de cada canal (trap, email)
+NOTIFY_BURST = 3  # Capacidad del cubo: como mucho NOTIFY_BURST + NOTIFY_RATE_PER_MINUTE * minutos por canal
+
+# Destinos de las notificaciones SNMP: cada alerta se envía a todos a la vez. Un "trap" no espera confirmación;
+# un "inform" espera la respuesta del gestor y se reenvía si no llega a tiempo ("timeout" y "retries" opcionales)
+NOTIFY_TARGETS = [
+    {"name": "trap-target", "host": "127.0.0.1", "port": 162, "type": "trap"},
+]
+NOTIFY_INFORM_TIMEOUT = 1.5  # Segundos de espera de la respuesta a un INFORM antes de reenviarlo
+NOTIFY_INFORM_RETRIES = 2  # Reenvíos de un INFORM sin respuesta antes de darlo por fallido
+
+
+# Muestreo de CPU: en segundo plano solo se muestrea tan rápido como lo exige la comprobación del umbral;
+# un GET de cpuUsage o cpuCoreTable refresca la muestra bajo demanda si tiene más de CPU_CACHE_TTL segundos
+CPU_SAMPLE_INTERVAL = 5  # Segundos entre comprobaciones del umbral con la CPU cerca o por encima de él
+CPU_IDLE_SAMPLE_INTERVAL = 30  # Segundos entre comprobaciones con la CPU lejos del umbral
+CPU_NEAR_MARGIN = 20  # Puntos porcentuales por debajo del umbral a partir de los que se considera "cerca"
+CPU_CACHE_TTL = 1.0  # Edad máxima (s) de la muestra servida en un GET (0 = sin refresco bajo demanda)
+
+
+# Persistencia del estado de la MIB: cada cambio se añade al WAL y la instantánea completa solo se reescribe al
+# compactar (cada FLUSH_INTERVAL segundos si hay cambios o en cuanto el WAL supera WAL_COMPACT_BYTES)
+FLUSH_INTERVAL = 30  # Segundos máximos entre compactaciones (o entre escrituras completas sin WAL)
+FLUSH_MAX_DIRTY = 20  # Sin WAL: número de cambios pendientes que fuerzan una escritura inmediata
+WAL_FSYNC = "group"  # "always" (un fsync por cambio), "group" (la respuesta al SET espera a un fsync compartido con los SET simultáneos), "interval" (fsync cada WAL_FSYNC_INTERVAL s) o "none" (lo decide el sistema operativo)
+WAL_FSYNC_INTERVAL = 1.0  # Segundos entre fsync con WAL_FSYNC = "interval" (es lo máximo que se puede perder)
+WAL_COMPACT_BYTES = 4 * 1024 * 1024  # Tamaño del WAL que adelanta la compactación
+
+# MIB compartida: copia viva de los valores en un fichero mapeado en memoria para otros procesos locales (shared_mib.py)
+SHARED_MIB_FILE = None  # Ruta del fichero (None = desactivado; también --shared-mib)
+
+# GETBULK: tamaño máximo del mensaje SNMP de respuesta para que quepa en un datagrama de MTU 1500
+# (1500 - 20 IP - 8 UDP, con margen). Los varbinds tienen lo que queda tras las cabeceras del mensaje y de la PDU,
+# que se miden en la petición: con SNMPv3/USM (engine ID, usuario, parámetros de autenticación y cifrado) son
+# bastante más grandes que con una comunidad v2c
+BULK_MAX_RESPONSE_SIZE = 1400
+BULK_HEADER_MARGIN = 32  # Bytes que puede crecer la cabecera de la respuesta frente a la de la petición (longitudes BER y relleno del cifrado)
+BULK_DEFAULT_OVERHEAD = 256  # Cabeceras supuestas cuando no se conoce el mensaje de la petición (caben las de SNMPv3 con USM)
+
+# Transporte y modo multiproceso
+AGENT_PORT = 161  # Puerto UDP en el que escucha el agente
+WORKERS = 1  # Procesos que atienden AGENT_PORT; con más de 1 el núcleo reparte las peticiones (SO_REUSEPORT)
+WORKER_SET_TIMEOUT = 2.0  # Segundos que un proceso trabajador espera a que el principal aplique un SET reenviado
+
+
+# Seguridad: comunidades v1/v2c y usuarios SNMPv3 (USM), cada uno con una vista VACM
+VACM_VIEWS = { # Vista -> subárboles de lectura, escritura y notificación
+    "readonly": {"read": (1,3,6,1), "write": (), "notify": (1,3,6,1)},
+    "readwrite": {"read": (1,3,6,1), "write": (1,3,6,1), "notify": (1,3,6,1)},
+}
+SNMP_COMMUNITIES = { # Comunidad -> (securityName, vista)
+    "public": ("public-area", "readonly"),
+    "private": ("private-area", "readwrite"),
+}
+SNMP_V2C_ENABLED = True  # False (o --no-v2c) para atender solo peticiones SNMPv3
+SNMP_V3_USERS = [ # "auth": none, md5, sha, sha256, sha512; "priv": none, des, aes, aes256 (contraseñas: ver SNMP_V3_CREDENTIALS_FILE)
+    {"user": "admin", "auth": "sha", "priv": "aes", "view": "readwrite"},
+    {"user": "monitor", "auth": "sha", "priv": "aes", "view": "readonly"},
+]
+# Las contraseñas USM no van en el código: se leen de SNMP_V3_<USUARIO>_AUTH_KEY / SNMP_V3_<USUARIO>_PRIV_KEY en el
+# entorno o de este fichero JSON sin versionar, {"usuario": {"auth_key": ..., "priv_key": ...}}. Un usuario sin las
+# contraseñas que exigen sus protocolos no se registra (se avisa en el log)
+SNMP_V3_CREDENTIALS_FILE = "snmpv3_credentials.json"
+SNMP_ENGINE_ID = None  # Engine ID fijo en hexadecimal; None para generarlo una vez y guardarlo en USM_KEY_FILE
+USM_KEY_FILE = "usm_keys.json"  # Claves USM ya localizadas por engine ID (evita derivarlas de la contraseña en cada arranque)
+
+
+# Histórico de CPU: búfer circular de tamaño fijo con las últimas muestras y agregados por ventana
+HISTORY_INTERVAL = 1.0  # Segundos entre muestras del histórico, a ritmo fijo (independiente del muestreador del umbral y de los GET)
+HISTORY_SIZE = 1024  # Muestras guardadas (algo más de 17 min con HISTORY_INTERVAL = 1: cabe la ventana de 15 min)
+HISTORY_WINDOWS = (1, 5, 15)  # Ventanas (minutos) de cpu1MinMean/Max/P95, cpu5Min... y cpu15Min...
+
+# Métricas internas: contadores e histogramas en memoria, en formato OpenMetrics por HTTP local y/o en un fichero
+METRICS_PORT = None  # Puerto TCP de 127.0.0.1 en el que se sirve /metrics (None = desactivado; también --metrics-port)
+METRICS_FILE = None  # Fichero que se reescribe cada METRICS_DUMP_INTERVAL s (None = desactivado; también --metrics-file)
+METRICS_DUMP_INTERVAL = 15  # Segundos entre volcados del fichero de métricas
+METRICS_PUSH_INTERVAL = 2.0  # Segundos entre envíos de las métricas de cada proceso trabajador al principal
+METRICS_FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0) # Límites (s) de los histogramas de los manejadores
+METRICS_SLOW_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Límites (s) del guardado, la deriva del muestreador y las notificaciones
+
+# Perfilado bajo demanda (nunca activo por defecto): se lanza con la señal PROFILE_SIGNAL o escribiendo profileSeconds
+PROFILE_DIR = "profiles"  # Directorio de los resultados (ficheros con la fecha y la hora del perfil en el nombre)
+PROFILE_MODE = "sample"  # "sample" (muestreo de pilas desde otro hilo, coste bajo y constante) o "cprofile" (todas las llamadas del bucle, más caro)
+PROFILE_SIGNAL = "SIGUSR1"  # Señal que lanza un perfil de PROFILE_SIGNAL_SECONDS (kill -USR1 <pid del principal>)
+PROFILE_SIGNAL_SECONDS = 30  # Duración de un perfil lanzado con la señal
+PROFILE_MAX_SECONDS = 600  # Duración máxima que se acepta en profileSeconds
+PROFILE_SAMPLE_INTERVAL = 0.005  # Segundos entre muestras de pila en el modo "sample"
+PROFILE_TRACEMALLOC = False  # Añadir la diferencia de tracemalloc entre el principio y el final (ralentiza el agente mientras dura)
+PROFILE_V3_ONLY = True  # profileSeconds solo se puede escribir con SNMPv3 (además de tener vista de escritura)
+
+
+
+log = logging.getLogger("mini_agent") # Logger del agente; los registros se escriben en un hilo aparte
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler): # Encola el registro sin formatearlo: el formateo lo hace el hilo escritor
+    def prepare(self, record):
+        return record
+
+
+class JsonLogFormatter(logging.Formatter): # Formatea cada registro como una línea JSON con sus campos estructurados
+    def format(self, record):
+        entry = {"ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), "level": record.levelname, "msg": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=lambda o: o.to_json() if hasattr(o, "to_json") else str(o))
+
+
+class VarBindsText: # Varbinds de una PDU formateados de forma perezosa (solo cuando el hilo escritor los imprime)
+    def __init__(self, varbinds):
+        self.varbinds = varbinds
+    
+    def __str__(self):
+        return " ".join(f"{oid_to_string(oid)}={val.prettyPrint()}" for oid, val in self.varbinds)
+    
+    def to_json(self):
+        return [{"oid": oid_to_string(oid), "value": val.prettyPrint()} for oid, val in self.varbinds]
+
+
+def setup_logging(level=LOG_LEVEL, json_output=LOG_JSON): # Configurar el logger con escritura asíncrona a través de una cola
+    level = logging.getLevelName(level) if isinstance(level, str) else level
+    handler = logging.StreamHandler(sys.stdout)
+    if json_output:
+        handler.setFormatter(JsonLogFormatter())
+    elif level <= logging.DEBUG: # Modo detallado: los bloques se imprimen tal cual, como la salida original
+        handler.setFormatter(logging.Formatter("%(message)s"))
+    else: # Formato compacto: una línea por registro
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    
+    log_queue = queue.SimpleQueue()
+    log.handlers[:] = [BackgroundQueueHandler(log_queue)]
+    log.setLevel(level)
+    log.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, handler) # Hilo escritor: saca los registros de la cola y hace la E/S
+    listener.start()
+    return listener
+
+
+def log_pdu(snmpEngine, pdu_type, err_status, varbinds, context=None): # Registrar una PDU atendida en una sola línea (nivel INFO)
+    ctx = context or snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request') or {} # context: el guardado de una respuesta diferida
+    address = ctx.get('transportAddress')
+    peer = f"{address[0]}:{address[1]}" if address else "-"
+    security_name = ctx.get('securityName')
+    security_name = security_name.prettyPrint() if security_name is not None else "-"
+    status = SET_ERROR_NAME.get(err_status, str(err_status))
+    log.info("%s %s %s %s %s", pdu_type, peer, security_name, status, VarBindsText(varbinds),
+             extra={"fields": {"pdu": pdu_type, "peer": peer, "securityName": security_name,
+                               "status": status, "varbinds": VarBindsText(varbinds)}})
+
+
+# Métricas del agente. Cada familia (contador o histograma) tiene una serie por combinación de etiquetas;
+# los manejadores resuelven sus series al crearse, así que anotar una petición es sumar y buscar un cubo.
+class Counter:
+    __slots__ = ("value",)
+    
+    def __init__(self): # Constructor de la clase Counter
+        self.value = 0
+    
+    def state(self): # Valor exportable (se suma con el de los procesos trabajadores)
+        return self.value
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum")
+    
+    def __init__(self, bounds): # Constructor de la clase Histogram
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # Observaciones por cubo (no acumuladas); la última es +Inf
+        self.sum = 0.0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1 # Cubo con el primer límite >= value
+        self.sum += value
+    
+    def state(self):
+        return (list(self.counts), self.sum)
+
+
+class MetricFamily:
+    def __init__(self, name, kind, help_text, labels, unit=None, buckets=None): # Constructor de la clase MetricFamily
+        self.name = name
+        self.kind = kind # "counter" o "histogram"
+        self.help = help_text
+        self.label_names = labels
+        self.unit = unit
+        self.buckets = buckets
+        self.series = {} # Valores de las etiquetas -> Counter o Histogram
+    
+    def labels(self, *values): # Serie de estas etiquetas (se crea la primera vez)
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = Histogram(self.buckets) if self.kind == "histogram" else Counter()
+        return series
+
+
+def metric_labels(names, values, le=None): # '{pdu="get",le="0.001"}' (vacío si no hay etiquetas)
+    pairs = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+             for name, value in zip(names, values)]
+    if le is not None: # Límite del cubo de un histograma
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    def __init__(self): # Constructor de la clase MetricsRegistry
+        self.families = {} # Nombre -> MetricFamily, en orden de registro
+        self.remote = {} # Id de proceso trabajador -> último export() recibido
+    
+    def counter(self, name, help_text, labels=()): # Familia de contadores (se expone como name_total)
+        return self.family(name, "counter", help_text, labels)
+    
+    def histogram(self, name, help_text, labels=(), buckets=METRICS_FAST_BUCKETS): # Familia de histogramas en segundos
+        return self.family(name, "histogram", help_text, labels, "seconds", buckets)
+    
+    def family(self, name, kind, help_text, labels, unit=None, buckets=None): # Registrar una familia o devolver la existente
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, kind, help_text, tuple(labels), unit, buckets)
+        return family
+    
+    def export(self): # {nombre: {etiquetas: estado}} de este proceso, para enviarlo al principal
+        return {name: {values: series.state() for values, series in family.series.items()}
+                for name, family in self.families.items()}
+    
+    def totals(self, name): # merged() de una familia por su nombre (vacío si aún no se ha registrado)
+        family = self.families.get(name)
+        return self.merged(family) if family is not None else {}
+    
+    def merged(self, family): # {etiquetas: estado} de una familia sumando las series de este proceso y las de los trabajadores
+        merged = {values: series.state() for values, series in list(family.series.items())}
+        for exported in self.remote.values():
+            for values, state in exported.get(family.name, {}).items():
+                current = merged.get(values)
+                if current is None:
+                    merged[values] = state
+                elif family.kind == "histogram":
+                    merged[values] = ([a + b for a, b in zip(current[0], state[0])], current[1] + state[1])
+                else:
+                    merged[values] = current + state
+        return merged
+    
+    def render(self): # Todas las familias en formato de texto OpenMetrics 1.0
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            if family.unit:
+                lines.append(f"# UNIT {family.name} {family.unit}")
+            lines.append(f"# HELP {family.name} {family.help}")
+            for values, state in sorted(self.merged(family).items()):
+                if family.kind == "counter":
+                    lines.append(f"{family.name}_total{metric_labels(family.label_names, values)} {state}")
+                    continue
+                counts, total = state
+                cumulative = 0
+                for bound, count in zip(family.buckets + (math.inf,), counts): # Los cubos de OpenMetrics son acumulados
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f"{family.name}_bucket{metric_labels(family.label_names, values, le)} {cumulative}")
+                lines.append(f"{family.name}_count{metric_labels(family.label_names, values)} {cumulative}")
+                lines.append(f"{family.name}_sum{metric_labels(family.label_names, values)} {total}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry() # Métricas de este proceso
+
+
+class PduMetrics:
+    def __init__(self, pdu, registry=METRICS): # Series de un tipo de PDU, resueltas una vez al crear su manejador
+        self.pdu = pdu
+        self.requests = registry.counter("snmp_agent_requests", "PDUs respondidas por tipo", ("pdu",)).labels(pdu)
+        self.varbinds = registry.counter("snmp_agent_varbinds", "Varbinds respondidos por tipo de PDU", ("pdu",)).labels(pdu)
+        self.latency = registry.histogram("snmp_agent_handler_seconds", "Tiempo desde que el manejador recibe la PDU hasta que envía la respuesta",
+                                          ("pdu",)).labels(pdu)
+        self.errors = registry.counter("snmp_agent_request_errors", "Respuestas con error-status distinto de noError", ("pdu", "status"))
+    
+    def record(self, start, err_status, varbinds): # Anotar una respuesta enviada (start: time.perf_counter() al recibir la PDU)
+        self.latency.observe(time.perf_counter() - start)
+        self.requests.value += 1
+        self.varbinds.value += varbinds
+        if err_status:
+            self.errors.labels(self.pdu, SET_ERROR_NAME.get(err_status, str(err_status))).value += 1
+
+
+SNMP_TYPES = { # Tipo del modelo -> constructor del valor pysnmp
+    "DisplayString": lambda value: v2c.OctetString(str(value).encode('utf-8')),
+    "Integer32": v2c.Integer,
+    "Counter32": lambda value: v2c.Counter32(value & 0xFFFFFFFF), # Los contadores dan la vuelta como en SNMP
+    "Gauge32": v2c.Gauge32,
+    "TimeTicks": v2c.TimeTicks,
+    "Counter64": lambda value: v2c.Counter64(value & 0xFFFFFFFFFFFFFFFF),
+}
+
+
+def parse_oid(text): # Convierte un OID en texto ("1.3.6...") en tupla de enteros
+    return tuple(int(x) for x in text.split('.'))
+
+
+# OidIndex mantiene los OIDs ordenados lexicográficamente (las tuplas de Python se comparan igual que los OIDs)
+# y resuelve GETNEXT y recorridos de subárbol con búsqueda binaria en lugar de un recorrido lineal.
+class OidIndex:
+    def __init__(self, oids=()): # Constructor: ordena una sola vez los OIDs iniciales
+        self.oids = sorted(oids)
+    
+    @classmethod
+    def from_sorted(cls, oids): # Índice a partir de una lista ya ordenada (instantánea binaria), sin reordenar
+        index = cls()
+        index.oids = oids
+        return index
+    
+    def __len__(self):
+        return len(self.oids)
+    
+    def __contains__(self, oid):
+        pos = bisect.bisect_left(self.oids, oid)
+        return pos < len(self.oids) and self.oids[pos] == oid
+    
+    def copy(self): # Copia independiente (sin reordenar) para publicar una nueva versión del índice
+        clone = OidIndex()
+        clone.oids = list(self.oids)
+        return clone
+    
+    def add(self, oid): # Insertar un OID manteniendo el orden (O(log n) búsqueda + desplazamiento)
+        pos = bisect.bisect_left(self.oids, oid)
+        if pos == len(self.oids) or self.oids[pos] != oid:
+            self.oids.insert(pos, oid)
+    
+    def remove(self, oid): # Eliminar un OID si existe
+        pos = bisect.bisect_left(self.oids, oid)
+        if pos < len(self.oids) and self.oids[pos] == oid:
+            del self.oids[pos]
+    
+    def next_after(self, oid): # Primer OID estrictamente mayor que oid, o None si no hay más
+        pos = bisect.bisect_right(self.oids, oid)
+        return self.oids[pos] if pos < len(self.oids) else None
+    
+    def iter_from(self, oid): # Iterar en orden los OIDs estrictamente mayores que oid
+        pos = bisect.bisect_right(self.oids, oid)
+        while pos < len(self.oids):
+            yield self.oids[pos]
+            pos += 1
+    
+    def subtree(self, prefix): # Iterar en orden los OIDs que cuelgan de prefix (incluido el propio prefix)
+        prefix = tuple(prefix)
+        pos = bisect.bisect_left(self.oids, prefix)
+        size = len(prefix)
+        while pos < len(self.oids) and self.oids[pos][:size] == prefix:
+            yield self.oids[pos]
+            pos += 1
+
+
+# Un proveedor sirve un subárbol de la MIB cuyos valores se calculan al leerlos (contadores, estadísticas,
+# el histórico de CPU...) en lugar de guardarse en el modelo y en el JSON. Expone:
+#   get(oid)            valor pysnmp del OID o None si no es suyo
+#   iter_from(oid)      (oid, valor) en orden de los OIDs estrictamente mayores que oid
+class LazyScalars:
+    def __init__(self, scalars): # scalars: {oid: (tipo, función sin argumentos que devuelve el valor)}
+        self.scalars = {tuple(oid): spec for oid, spec in scalars.items()}
+        self.index = OidIndex(self.scalars)
+    
+    def get(self, oid): # Calcular el valor en el momento de la lectura
+        spec = self.scalars.get(oid)
+        if spec is None:
+            return None
+        return SNMP_TYPES[spec[0]](spec[1]())
+    
+    def iter_from(self, oid):
+        for candidate in self.index.iter_from(oid):
+            yield candidate, self.get(candidate)
+
+
+def column_start(base, oid, first): # Primer índice de la columna base que sigue a oid (None si la columna entera queda antes)
+    # Solo índices de un único entero (un subidentificador tras la columna): de un índice compuesto se usaría el primero
+    if oid <= base: # GETNEXT desde antes de la columna o desde el OID de la propia columna
+        return first
+    if oid[:len(base)] == base and len(oid) > len(base):
+        return max(first, oid[len(base)] + 1) # Filas estrictamente posteriores a oid
+    return None
+
+
+# LazyTable publica una tabla calculada al leerla. rows() devuelve [(índice, fila)] ordenado por índice y
+# columns asocia cada subid de columna a (tipo, función que extrae el valor de la fila). El índice de cada fila es
+# un único entero (ver column_start). Pensada para tablas pequeñas que se recalculan enteras en cada lectura;
+# las que crecen con el tiempo se sirven con su propio proveedor (p. ej. CpuHistoryTable desde el búfer circular).
+class LazyTable:
+    def __init__(self, prefix, columns, rows): # Constructor de la clase LazyTable
+        self.entry = tuple(prefix) + (1,)
+        self.columns = columns
+        self.rows = rows
+    
+    def get(self, oid):
+        if len(oid) != len(self.entry) + 2 or oid[:len(self.entry)] != self.entry or oid[-2] not in self.columns:
+            return None
+        row = dict(self.rows()).get(oid[-1]) # Un diccionario por índice por cada llamada a rows(), sin recorrer filas buscando
+        if row is None:
+            return None
+        kind, extract = self.columns[oid[-2]]
+        return SNMP_TYPES[kind](extract(row))
+    
+    def iter_from(self, oid):
+        rows = self.rows()
+        indexes = [row_index for row_index, _ in rows]
+        assert all(type(row_index) is int for row_index in indexes), "LazyTable solo admite índices de un único entero"
+        for column in sorted(self.columns):
+            base = self.entry + (column,)
+            start = column_start(base, oid, 0)
+            if start is None:
+                continue
+            kind, extract = self.columns[column]
+            for row_index, row in rows[bisect.bisect_left(indexes, start):]: # Las filas ya vienen ordenadas por índice
+                yield base + (row_index,), SNMP_TYPES[kind](extract(row))
+
+
+# TableCell identifica en oid_map una celda de tabla (los escalares se identifican por su nombre).
+# El OID de la celda es <oid de la tabla>.1.<columna>.<índice>, así que el índice ordenado recorre
+# las tablas columna a columna y fila a fila en orden numérico, como exige GETNEXT.
+class TableCell:
+    __slots__ = ("table", "column", "index", "key")
+    
+    def __init__(self, table, column, index): # Constructor de la clase TableCell
+        self.table = table # Nombre de la tabla en model["tables"]
+        self.column = column # Nombre de la columna
+        self.index = index # Índice de la fila (entero)
+        self.key = str(index) # Clave de la fila en el JSON
+    
+    def __str__(self): # Nombre legible de la celda, p. ej. cpuCoreUsage.3
+        return f"{self.column}.{self.index}"
+
+
+# Snapshot es una versión inmutable del modelo: nadie modifica sus diccionarios una vez publicada.
+# Los escritores copian solo lo que cambian (copy-on-write) y publican una versión nueva con una única
+# asignación de atributo, que es atómica; cada PDU fija (pin) una versión y la lee entera sin cerrojos.
+class Snapshot:
+    __slots__ = ("version", "model", "oid_map", "index")
+    
+    def __init__(self, version, model, oid_map, index): # Constructor de la clase Snapshot
+        self.version = version # Número de versión, crece con cada publicación
+        self.model = model # Modelo con el mismo formato que el JSON
+        self.oid_map = oid_map # Mapeo OID a nombres de variables (o TableCell para las celdas de tablas)
+        self.index = index # Índice ordenado para get-next y recorridos
+
+
+def write_atomic(filepath, payload): # Escribir un fichero completo de forma atómica; devuelve los bytes escritos
+    directory = os.path.dirname(os.path.abspath(filepath))
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f: # Escribimos a un temporal y forzamos a disco antes de renombrar
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath) # El renombrado es atómico: nunca queda un fichero a medias
+    sync_directory(directory)
+    return len(payload)
+
+
+def sync_directory(directory): # fsync de un directorio para que persistan los ficheros creados o renombrados en él
+    if hasattr(os, 'O_DIRECTORY'): # Solo en POSIX (en Windows no se puede abrir un directorio)
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+# Instantánea binaria del estado (SNAPSHOT_FILE). Tras una cabecera fija (magia, versión del formato, versión
+# de marshal, CRC32 y longitud) va una tupla serializada con marshal, por columnas:
+#   extra        claves del modelo que no son escalares ni tablas (baseoid...)
+#   definitions  definiciones de escalar sin OID ni valor (tipo, acceso, límites), sin repetir
+#   scalars      nombres, OID en texto, OID ya parseado, índice de su definición y valor, en listas paralelas
+#   tables       las tablas tal cual están en el modelo
+#   cells        (OID, tabla, columna, índice) de cada celda
+#   index        todos los OIDs ya ordenados: el índice se carga sin parsear ni ordenar nada
+# Si la cabecera no coincide (otra versión del formato o de Python) o el CRC falla, se carga el JSON.
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<8sHHIQ")
+SNAPSHOT_MAGIC = b"MIBSNAP\0"
+
+
+def encode_snapshot(snap): # Serializar una versión del modelo en el formato binario
+    model = snap.model
+    definitions, definition_ids = [], {}
+    names, oid_texts, oids, definition_refs, values = [], [], [], [], []
+    scalar_oids = {name: oid for oid, name in snap.oid_map.items() if not isinstance(name, TableCell)}
+    for name, obj in model["scalars"].items():
+        definition = obj.copy()
+        del definition["oid"], definition["value"]
+        key = tuple(definition.items())
+        try:
+            ref = definition_ids.setdefault(key, len(definitions))
+        except TypeError: # Algún campo es una lista (no se puede usar como clave): se guarda sin deduplicar
+            ref = len(definitions)
+        if ref == len(definitions):
+            definitions.append(definition)
+        names.append(name)
+        oid_texts.append(obj["oid"])
+        oids.append(scalar_oids[name])
+        definition_refs.append(ref)
+        values.append(obj["value"])
+    cells = [(oid, cell.table, cell.column, cell.index) for oid, cell in snap.oid_map.items() if isinstance(cell, TableCell)]
+    extra = {key: value for key, value in model.items() if key not in ("scalars", "tables")}
+    payload = marshal.dumps((extra, definitions, (names, oid_texts, oids, definition_refs, values),
+                             model.get("tables", {}), cells, snap.index.oids))
+    return SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, marshal.version, zlib.crc32(payload), len(payload)) + payload
+
+
+def decode_snapshot(data): # (modelo, oid_map, índice) de una instantánea binaria; ValueError si no es válida
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError("instantánea truncada")
+    magic, version, marshal_version, crc, size = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT or marshal_version != marshal.version:
+        raise ValueError("formato de instantánea no compatible")
+    payload = memoryview(data)[SNAPSHOT_HEADER.size:]
+    if len(payload) != size or zlib.crc32(payload) != crc:
+        raise ValueError("instantánea dañada (CRC o longitud)")
+    extra, definitions, (names, oid_texts, oids, definition_refs, values), tables, cells, index = marshal.loads(payload)
+    scalars = {name: {"oid": oid_text, **definitions[ref], "value": value}
+               for name, oid_text, ref, value in zip(names, oid_texts, definition_refs, values)}
+    oid_map = dict(zip(oids, names))
+    oid_map.update((oid, TableCell(table, column, row)) for oid, table, column, row in cells)
+    return dict(extra, scalars=scalars, tables=tables), oid_map, OidIndex.from_sorted(index)
+
+
+# WriteAheadLog es el registro de cambios del estado, solo de añadir. Cada registro lleva su longitud y su CRC32
+# seguidos del cambio serializado con marshal (ver JsonStore.apply_change). Al arrancar se aplican sobre la
+# instantánea y se descarta la cola rota que deja un corte a mitad de escritura. Al compactar se empieza un
+# fichero nuevo y el anterior (.old) se borra cuando la instantánea que lo incluye ya está en disco; si el
+# agente cae entre medias se aplican los dos (los cambios son idempotentes: valores absolutos, no incrementos).
+# Con el cerrojo de JsonStore la rotación solo renombra el fichero y cambia de descriptor; su fsync (y, si una
+# compactación anterior falló, la copia del .rotating al final del .old) se hace después, fuera del cerrojo.
+WAL_RECORD = struct.Struct("<II") # Longitud y CRC32 del cambio
+WAL_POLICIES = ("always", "group", "interval", "none")
+
+
+class WriteAheadLog:
+    def __init__(self, filepath, policy=WAL_FSYNC): # Constructor de la clase WriteAheadLog (el fichero se abre en replay)
+        self.filepath = filepath
+        self.rotated_path = filepath + ".old" # Fichero anterior a la compactación en curso
+        self.merging_path = filepath + ".rotating" # Fichero apartado por una rotación que aún hay que añadir al .old
+        self.policy = policy
+        self.fd = None
+        self.closing = None # Descriptor del fichero apartado por rotate() hasta que finish_rotation() lo lleva a disco
+        self.directory = os.path.dirname(os.path.abspath(filepath))
+        self.dir_pending = False # Hay un fichero creado o renombrado cuya entrada de directorio aún no está en disco
+        self.size = 0 # Bytes del fichero actual
+        self.appended = 0 # Número de secuencia del último cambio añadido
+        self.synced = 0 # Último número de secuencia que ya está en disco
+        self.io_lock = threading.Lock() # Protege fd y los contadores frente al fsync del hilo del pool
+        self.syncing = None # Futuro del fsync en curso (compromiso en grupo)
+        self.stats = {"records": 0, "bytes": 0, "fsyncs": 0, "fsync_time": 0.0, "replayed": 0, "torn": 0}
+    
+    @property
+    def group_commit(self): # ¿Hay que esperar a durable() antes de confirmar un cambio?
+        return self.policy == "group"
+    
+    def read_records(self, path): # (cambios válidos, bytes que ocupan); se para en el primer registro roto
+        with open(path, 'rb') as f:
+            data = f.read()
+        records, offset = [], 0
+        while offset + WAL_RECORD.size <= len(data):
+            size, crc = WAL_RECORD.unpack_from(data, offset)
+            payload = data[offset + WAL_RECORD.size:offset + WAL_RECORD.size + size]
+            if len(payload) != size or zlib.crc32(payload) != crc:
+                break
+            try:
+                records.append(marshal.loads(payload))
+            except (ValueError, EOFError, TypeError):
+                break
+            offset += WAL_RECORD.size + size
+        if offset < len(data):
+            self.stats["torn"] += 1
+            log.warning("⚠️  %s: descartados %d bytes de un registro incompleto al final", path, len(data) - offset)
+        return records, offset
+    
+    def replay(self): # Leer los cambios pendientes de aplicar y abrir el fichero para añadir
+        records = []
+        for path in (self.rotated_path, self.merging_path, self.filepath):
+            if os.path.exists(path):
+                found, valid = self.read_records(path)
+                records.extend(found)
+                if valid < os.path.getsize(path): # La cola rota se corta para que los registros nuevos no queden detrás
+                    os.truncate(path, valid)
+        self.merge_rotated() # Una rotación que no terminó antes de la caída
+        self.fd = os.open(self.filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        sync_directory(self.directory) # El fichero puede ser nuevo: su entrada tiene que sobrevivir a un corte antes del primer SET
+        self.size = os.fstat(self.fd).st_size
+        self.stats["replayed"] = len(records)
+        return records
+    
+    def append(self, change): # Añadir un cambio (llamar con el cerrojo de JsonStore tomado); devuelve su número de secuencia
+        payload = marshal.dumps(change)
+        record = WAL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.io_lock:
+            os.write(self.fd, record) # Una sola escritura con O_APPEND: el registro entra entero o se queda en la cola rota
+            self.size += len(record)
+            self.appended += 1
+            lsn = self.appended
+        self.stats["records"] += 1
+        self.stats["bytes"] += len(record)
+        if self.policy == "always":
+            self.sync()
+        return lsn
+    
+    def sync(self): # fsync de todo lo añadido hasta ahora (en el hilo del pool salvo con "always")
+        with self.io_lock:
+            target = self.appended
+            if self.synced >= target:
+                return
+            fds = [os.dup(fd) for fd in (self.fd, self.closing) if fd is not None] # Una compactación puede cerrarlos mientras dura el fsync
+            dir_pending = self.dir_pending
+        start = time.perf_counter()
+        try:
+            for fd in fds: # Tras una rotación, parte de lo añadido sigue en el fichero apartado
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        if dir_pending: # El fichero nuevo de la rotación: sin su entrada de directorio el fsync no sirve de nada
+            sync_directory(self.directory)
+        with self.io_lock:
+            self.synced = max(self.synced, target)
+        self.stats["fsyncs"] += 1
+        self.stats["fsync_time"] += time.perf_counter() - start
+    
+    async def durable(self, lsn): # Esperar a que el cambio lsn esté en disco; un fsync sirve a todos los que esperan (group commit)
+        loop = asyncio.get_running_loop()
+        while self.synced < lsn:
+            if self.syncing is None or self.syncing.done(): # Los cambios llegados durante el fsync anterior van en el siguiente
+                self.syncing = loop.run_in_executor(None, self.sync)
+            await self.syncing
+    
+    def rotate(self): # Empezar un fichero nuevo para la compactación (llamar con el cerrojo de JsonStore tomado); devuelve el último lsn apartado
+        with self.io_lock: # Solo renombrar y cambiar de descriptor: el fsync y la copia van en finish_rotation, sin el cerrojo
+            if self.closing is not None or os.path.exists(self.merging_path): # La rotación anterior falló a mitad: se termina aquí (caso raro)
+                if self.closing is not None and self.policy != "none":
+                    os.fsync(self.closing)
+                self.finish_rotation_locked()
+            path = self.merging_path if os.path.exists(self.rotated_path) else self.rotated_path # Falló la compactación anterior: se añadirá al .old
+            os.replace(self.filepath, path)
+            self.closing = self.fd
+            self.fd = os.open(self.filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o644)
+            self.dir_pending = self.policy != "none" # finish_rotation (o el próximo sync) lleva el renombrado y el fichero nuevo a disco
+            self.size = 0
+            return self.appended
+    
+    def finish_rotation(self, lsn): # Llevar a disco el fichero apartado por rotate() y unirlo al .old (sin el cerrojo de JsonStore)
+        if self.closing is not None and self.policy != "none" and self.synced < lsn: # Lo que queda en el fichero anterior pasa a estar en disco
+            os.fsync(self.closing)
+        if self.dir_pending: # El renombrado y el fichero nuevo, antes de que synced cubra registros de este
+            sync_directory(self.directory)
+        with self.io_lock:
+            self.dir_pending = False
+            self.finish_rotation_locked()
+            self.synced = max(self.synced, lsn)
+    
+    def finish_rotation_locked(self): # Cerrar el fichero apartado y añadir el .rotating al .old (con io_lock tomado)
+        if self.closing is not None:
+            os.close(self.closing)
+            self.closing = None
+        self.merge_rotated()
+    
+    def merge_rotated(self): # Añadir el .rotating al final del .old y borrarlo
+        if not os.path.exists(self.merging_path):
+            return
+        with open(self.merging_path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self.merging_path)
+    
+    def discard_rotated(self): # La instantánea con los cambios del .old ya está en disco
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+    
+    def close(self): # fsync final y cierre
+        if self.fd is None:
+            return
+        if self.policy != "none":
+            self.sync()
+        if self.closing is not None:
+            os.close(self.closing)
+            self.closing = None
+        os.close(self.fd)
+        self.fd = None
 
 
 # JSONStore maneja la MIB almacenada en un archivo JSON, guardando y cargando el estado de las variables.
+# Con snapshot_path el estado se guarda además en la instantánea binaria, que es la que se carga al arrancar
+# salvo que el JSON sea más reciente (lo ha editado una persona): el JSON sigue siendo el formato legible.
+# Con un WriteAheadLog (attach_wal) cada cambio se registra en él y flush() compacta el registro en la instantánea.
 class JsonStore:
-    def __init__(self, filepath): # Constructor de la clase JsonStore
+    def __init__(self, filepath, snapshot_path=None): # Constructor de la clase JsonStore
         self.filepath = filepath # Ruta al archivo JSON
-        self.model = self.load() # Cargar modelo desde JSON
-        self.oid_map = self.build_oid_map() # Mapeo OID a nombres de variables
-        self.sorted_oids = sorted(self.oid_map.keys()) # OIDs ordenados para get-next
-        self.snmpEngine = None  # Se establecerá desde main()
+        self.snapshot_path = snapshot_path # Ruta de la instantánea binaria (None = solo JSON)
+        self.load_source = "json" # De dónde salió el estado al arrancar: json, snapshot o default
+        loaded = self.load_snapshot()
+        if loaded is None:
+            try:
+                model = self.load() # Cargar modelo desde JSON
+            except ValueError as e: # JSON truncado o mal formado: si hay instantánea, se usa aunque sea más antigua
+                loaded = self.load_snapshot(ignore_json=True)
+                if loaded is None:
+                    raise
+                log.warning("⚠️  %s no es un JSON válido (%s): se usa %s", filepath, e, snapshot_path)
+            else:
+                oid_map = self.build_oid_map(model) # Mapeo OID a nombres de variables
+                loaded = model, oid_map, OidIndex(oid_map.keys())
+        self.snapshot = Snapshot(1, *loaded) # Versión publicada actualmente
+        model = loaded[0]
+        self.cpu_usage_oid = tuple(int(x) for x in model["scalars"]["cpuUsage"]["oid"].split('.'))
+        self.lock = threading.Lock() # Serializa a los escritores entre sí; los lectores nunca lo toman
+        self.flush_lock = threading.Lock() # Evita dos escrituras simultáneas del mismo fichero
+        self.dirty = 0 # Número de cambios pendientes de escribir en disco
+        self.flush_wakeup = threading.Event() # Despierta a la tarea de persistencia antes de FLUSH_INTERVAL (la sustituye por un asyncio.Event)
+        self.flush_stats = {"flushes": 0, "bytes_written": 0, "flush_time": 0.0} # Contadores de escritura
+        self.save_latency = METRICS.histogram("snmp_agent_store_save_seconds", "Duración de cada escritura completa del estado (instantánea o JSON)",
+                                              buckets=METRICS_SLOW_BUCKETS).labels()
+        self.auth_failures = METRICS.counter("snmp_agent_set_auth_failures", "SET rechazados porque quien los envía no tiene permiso de escritura sobre el OID").labels()
+        self.cache_enabled = True # Caché de objetos pysnmp ya construidos por OID
+        self.value_cache = {} # OID -> (objeto del modelo, v2c.OctetString / v2c.Integer listo para la respuesta)
+        self.cache_stats = {"hits": 0, "misses": 0} # Contadores de aciertos/fallos de la caché
+        self.refreshers = [] # (prefijos de OID, función) de los objetos volátiles que se refrescan al leerlos
+        self.providers = [] # Subárboles cuyos valores se calculan al leerlos (no están en el modelo ni en el JSON)
+        self.controls = {} # OID -> (comprobación, aplicación) de los objetos de control escribibles que no están en el modelo
+        self.access = AccessTable.compile() # Quién puede escribir dónde, compilado desde las comunidades, usuarios y vistas
+        self.listeners = [] # Funciones a las que se avisa de cada versión publicada (p. ej. WorkerPool)
+        self.wal = None # Registro de cambios (None = solo escrituras completas diferidas)
+    
+    @property
+    def model(self): # Modelo de la versión publicada (solo lectura)
+        return self.snapshot.model
+    
+    @property
+    def oid_map(self): # Mapeo OID a nombre de la versión publicada
+        return self.snapshot.oid_map
+    
+    @property
+    def index(self): # Índice ordenado de la versión publicada
+        return self.snapshot.index
+    
+    def pin(self): # Fijar la versión actual: todo lo que se lea de ella es coherente aunque haya escrituras
+        return self.snapshot
+    
+    def add_refresher(self, prefixes, callback): # Registrar un refresco bajo demanda (read-through) para los OIDs bajo prefixes
+        self.refreshers.append(([tuple(prefix) for prefix in prefixes], callback))
+    
+    def refresh(self, oids, following=False): # Refrescar los objetos volátiles que va a leer una PDU (antes de fijar la versión)
+        for prefixes, callback in self.refreshers:
+            for oid in oids: # GET: el OID está bajo el prefijo; GETNEXT/GETBULK: el recorrido puede llegar hasta él
+                if any(oid[:len(prefix)] == prefix or (following and oid < prefix) for prefix in prefixes):
+                    callback()
+                    break
+    
+    def add_provider(self, provider): # Registrar un subárbol calculado al leerlo (ver LazyScalars)
+        self.providers.append(provider)
+    
+    def add_control(self, oid, check, apply=None): # Registrar un objeto de control: check(valor, principal) -> errStatus; apply(int) -> (anterior, nuevo)
+        self.controls[oid] = (check, apply) # Sin apply (procesos trabajadores) el SET lo aplica el proceso principal
+    
+    def publish(self, model, oid_map=None, index=None): # Publicar una versión nueva (llamar con self.lock tomado)
+        current = self.snapshot
+        self.snapshot = Snapshot(current.version + 1, model,
+                                 current.oid_map if oid_map is None else oid_map,
+                                 current.index if index is None else index)
+        for listener in self.listeners:
+            listener(self.snapshot)
+    
+    def install(self, version, model): # Publicar como propia una versión recibida de otro proceso (modo multiproceso)
+        with self.lock:
+            current = self.snapshot
+            oid_map = self.build_oid_map(model)
+            index = current.index if oid_map.keys() == current.oid_map.keys() else OidIndex(oid_map.keys()) # Reordenar solo si cambian los OIDs
+            self.snapshot = Snapshot(version, model, oid_map, index)
+    
+    def load_snapshot(self, ignore_json=False): # (modelo, oid_map, índice) de la instantánea binaria si existe y no es más antigua que el JSON
+        path = self.snapshot_path
+        if not path or not os.path.exists(path):
+            return None
+        if not ignore_json and os.path.exists(self.filepath) and os.path.getmtime(self.filepath) > os.path.getmtime(path):
+            log.info("📝 %s es más reciente que %s: se importa el JSON", self.filepath, path)
+            return None
+        try:
+            with open(path, 'rb') as f:
+                loaded = decode_snapshot(f.read())
+        except (OSError, ValueError, EOFError, TypeError) as e: # Instantánea dañada o de otra versión: se usa el JSON
+            log.warning("⚠️  No se pudo cargar %s (%s): se usa %s", path, e, self.filepath)
+            return None
+        self.load_source = "snapshot"
+        return loaded
     
     def load(self): # Cargar el modelo desde el archivo JSON o usar valores predeterminados
+        default = self.default_model()
         if os.path.exists(self.filepath):
             with open(self.filepath, 'r') as f:
-                return json.load(f)
-        
-        return { # Modelo por defecto si no existe el archivo JSON
+                model = json.load(f)
+            tables = model.setdefault("tables", {}) # Los JSON anteriores a las tablas reciben su definición vacía
+            for name, table in default["tables"].items():
+                tables.setdefault(name, table)
+            return model
+        self.load_source = "default"
+        return default
+    
+    def default_model(self): # Modelo por defecto si no existe el archivo JSON
+        return {
             "baseoid": "1.3.6.1.4.1.28308.1",
             "scalars": {
                 "manager": {"oid": "1.3.6.1.4.1.28308.1.1.0", "type": "DisplayString", 
@@ -57,87 +894,289 @@ class JsonStore:
                             "access": "read-only", "minval": 0, "maxval": 100, "value": 10},
                 "cpuThreshold": {"oid": "1.3.6.1.4.1.28308.1.4.0", "type": "Integer32",
                                 "access": "read-write", "minval": 0, "maxval": 100, "value": 80}
+            },
+            "tables": {
+                "cpuCoreTable": {"oid": "1.3.6.1.4.1.28308.1.5", "index": "cpuCoreIndex",
+                                 "columns": {"cpuCoreUsage": {"subid": 2, "type": "Integer32",
+                                                              "access": "read-only", "minval": 0, "maxval": 100}},
+                                 "rows": {}} # Una fila por núcleo, se rellena con cada muestra
             }
         }
     
-    def save(self, data=None): # Funcion para guardar el modelo en el archivo JSON
-        with open(self.filepath, 'w') as f:
-            json.dump(data or self.model, f, indent=2)
+    def save(self, snap=None): # Guardar una versión (la actual por defecto) de forma atómica: en la instantánea binaria si la hay, si no en el JSON
+        snap = snap or self.snapshot # La versión fijada no cambia mientras se serializa
+        if self.snapshot_path:
+            return write_atomic(self.snapshot_path, encode_snapshot(snap))
+        return self.export_json(snap.model)
+    
+    def export_json(self, data=None): # Escribir el modelo en el JSON legible de forma atómica
+        payload = json.dumps(data or self.snapshot.model, indent=2).encode('utf-8')
+        return write_atomic(self.filepath, payload)
+    
+    def mark_dirty(self): # Anotar un cambio pendiente; se escribirá en el siguiente flush
+        with self.lock:
+            self.dirty += 1
+            if self.wal is not None: # Con WAL el cambio ya está registrado: solo se adelanta la compactación si el WAL crece demasiado
+                if self.wal.size >= WAL_COMPACT_BYTES:
+                    self.flush_wakeup.set()
+            elif self.dirty >= FLUSH_MAX_DIRTY: # Demasiados cambios acumulados: adelantar la escritura
+                self.flush_wakeup.set()
+    
+    def flush(self): # Escribir el modelo en disco solo si hay cambios pendientes (con WAL: compactarlo en la instantánea)
+        with self.flush_lock:
+            with self.lock:
+                pending = self.dirty
+                if not pending:
+                    return False
+                self.dirty = 0
+                snap = self.snapshot
+                if self.wal is not None: # Los cambios posteriores a snap irán al fichero nuevo
+                    rotated = self.wal.rotate()
+            start = time.perf_counter()
+            try:
+                if self.wal is not None: # fsync del fichero apartado fuera del cerrojo: los SET siguen entrando
+                    self.wal.finish_rotation(rotated)
+                written = self.save(snap)
+            except Exception:
+                with self.lock: # Si falla la escritura, los cambios siguen pendientes (y el .old se conserva)
+                    self.dirty += pending
+                raise
+            if self.wal is not None:
+                self.wal.discard_rotated()
+            self.flush_stats["flushes"] += 1
+            self.flush_stats["bytes_written"] += written
+            elapsed = time.perf_counter() - start
+            self.flush_stats["flush_time"] += elapsed
+            self.save_latency.observe(elapsed)
+            return True
+    
+    def attach_wal(self, wal): # Aplicar los cambios registrados tras la instantánea y registrar en wal los siguientes
+        records = wal.replay()
+        for change in records:
+            self.apply_change(change)
+        self.wal = wal
+        if records: # Se compactan en la siguiente escritura
+            self.mark_dirty()
+        return len(records)
+    
+    def log_change(self, change): # Registrar un cambio ya publicado en el WAL (llamar con self.lock tomado)
+        if self.wal is not None:
+            self.wal.append(change)
     
-    def build_oid_map(self): # Construir un mapeo de OID a nombres de variables
-        return {tuple(int(x) for x in obj["oid"].split('.')): key 
-                for key, obj in self.model["scalars"].items()}
+    def apply_change(self, change): # Volver a aplicar un cambio leído del WAL (se ignora lo que ya no existe)
+        kind = change[0]
+        if kind == "values":
+            scalars = self.snapshot.model["scalars"]
+            values = {name: value for name, value in change[1].items() if name in scalars}
+            if values:
+                self.update_values(values)
+        elif kind == "rows":
+            _, table_name, rows, values = change
+            if table_name in self.snapshot.model["tables"]:
+                self.replace_rows(table_name, rows, values)
+        elif kind == "add":
+            self.add_objects(change[1])
+        elif kind == "remove":
+            if change[1] in self.snapshot.model["scalars"]:
+                self.remove_object(change[1])
     
-    def get_exact(self, oid): # Obtener el valor exacto para un OID dado
-        nombre_objeto = self.oid_map.get(oid)
+    def build_oid_map(self, model): # Construir un mapeo de OID a nombres de variables
+        oid_map = {tuple(int(x) for x in obj["oid"].split('.')): key 
+                   for key, obj in model["scalars"].items()}
+        for name, table in model.get("tables", {}).items():
+            oid_map.update(self.table_cells(name, table, table["rows"]))
+        return oid_map
+    
+    def table_oid(self, name): # OID de una tabla como tupla
+        return tuple(int(x) for x in self.snapshot.model["tables"][name]["oid"].split('.'))
+    
+    def table_cells(self, name, table, row_keys): # Generar (OID, TableCell) de todas las columnas de las filas dadas
+        entry_oid = tuple(int(x) for x in table["oid"].split('.')) + (1,)
+        for key in row_keys:
+            row_index = int(key)
+            for column, definition in table["columns"].items():
+                yield entry_oid + (definition["subid"], row_index), TableCell(name, column, row_index)
+    
+    def resolve(self, snap, name): # (objeto que contiene el valor, definición con tipo y acceso, valor) de un escalar o celda
+        if isinstance(name, TableCell):
+            table = snap.model["tables"][name.table]
+            row = table["rows"][name.key]
+            return row, table["columns"][name.column], row[name.column]
+        obj = snap.model["scalars"][name]
+        return obj, obj, obj["value"]
+    
+    def build_value(self, definition, value): # Construir el objeto pysnmp correspondiente a un valor del modelo
+        return SNMP_TYPES[definition["type"]](value)
+    
+    def get_exact(self, oid, snap=None): # Obtener el valor exacto para un OID dado (en la versión fijada o en la actual)
+        snap = snap or self.snapshot
+        nombre_objeto = snap.oid_map.get(oid)
         if not nombre_objeto:
+            for provider in self.providers: # Puede ser un objeto calculado al leerlo
+                val = provider.get(oid)
+                if val is not None:
+                    return True, val
             return False, v2c.NoSuchObject() # v2c es para usar pysnmp
-        obj = self.model["scalars"][nombre_objeto]
-        val = v2c.OctetString(str(obj["value"]).encode('utf-8')) if obj["type"] == "DisplayString" else v2c.Integer(obj["value"])
+        holder, definition, value = self.resolve(snap, nombre_objeto)
+        if not self.cache_enabled:
+            return True, self.build_value(definition, value)
+        entry = self.value_cache.get(oid)
+        if entry is not None and entry[0] is holder: # Acierto: el valor se construyó a partir de este mismo objeto
+            self.cache_stats["hits"] += 1
+            return True, entry[1]
+        self.cache_stats["misses"] += 1 # Fallo o entrada de otra versión: construir y recordar
+        val = self.build_value(definition, value)
+        self.value_cache[oid] = (holder, val)
         return True, val
     
-    def get_next(self, oid): # Obtener el siguiente OID y su valor
-        for candidate in self.sorted_oids:
-            if candidate > oid:
-                return True, candidate, self.get_exact(candidate)[1] # get_exact devuelve (ok, val) entonces usamos [1] para obtener val
-        return False, None, None
+    def get_next(self, oid, snap=None): # Obtener el siguiente OID y su valor
+        snap = snap or self.snapshot
+        if self.providers:
+            for candidate, val in self.iter_next(oid, snap):
+                return True, candidate, val
+            return False, None, None
+        candidate = snap.index.next_after(oid) # Búsqueda binaria en el índice ordenado
+        if candidate is None:
+            return False, None, None
+        return True, candidate, self.get_exact(candidate, snap)[1] # get_exact devuelve (ok, val) entonces usamos [1] para obtener val
+    
+    def iter_next(self, oid, snap=None): # Iterar en orden (oid, valor) de los objetos estrictamente posteriores a oid
+        snap = snap or self.snapshot
+        if not self.providers:
+            for candidate in snap.index.iter_from(oid):
+                yield candidate, self.get_exact(candidate, snap)[1]
+            return
+        # Mezcla ordenada del índice del modelo con los subárboles calculados; cada valor se obtiene al avanzar
+        stored = ((candidate, None) for candidate in snap.index.iter_from(oid))
+        for candidate, val in heapq.merge(stored, *(provider.iter_from(oid) for provider in self.providers), key=lambda item: item[0]):
+            yield candidate, val if val is not None else self.get_exact(candidate, snap)[1]
+    
+    def walk(self, prefix, snap=None): # Recorrer en orden todos los objetos bajo prefix devolviendo (oid, valor)
+        snap = snap or self.snapshot
+        prefix = tuple(prefix)
+        if not self.providers:
+            for oid in snap.index.subtree(prefix):
+                yield oid, self.get_exact(oid, snap)[1]
+            return
+        ok, val = self.get_exact(prefix, snap)
+        if ok:
+            yield prefix, val
+        for oid, val in self.iter_next(prefix, snap):
+            if oid[:len(prefix)] != prefix:
+                return
+            yield oid, val
     
-    def validate_set(self, oid, snmp_val, stateReference=None, contextName=''): # Validar una operación SET
+    def add_object(self, name, obj): # Añadir un escalar a la MIB y actualizar el índice de forma incremental
+        self.add_objects([(name, obj)])
+    
+    def add_objects(self, items): # Añadir varios escalares publicando una sola versión nueva
+        items = list(items)
+        with self.lock:
+            snap = self.snapshot
+            scalars = dict(snap.model["scalars"])
+            oid_map = dict(snap.oid_map)
+            index = snap.index.copy()
+            for name, obj in items:
+                oid = tuple(int(x) for x in obj["oid"].split('.'))
+                scalars[name] = obj
+                oid_map[oid] = name
+                index.add(oid)
+            self.publish(dict(snap.model, scalars=scalars), oid_map, index)
+            self.log_change(("add", items))
+        self.mark_dirty()
+    
+    def remove_object(self, name): # Eliminar un escalar de la MIB y del índice
+        with self.lock:
+            snap = self.snapshot
+            scalars = dict(snap.model["scalars"])
+            obj = scalars.pop(name)
+            oid = tuple(int(x) for x in obj["oid"].split('.'))
+            oid_map = dict(snap.oid_map)
+            oid_map.pop(oid, None)
+            index = snap.index.copy()
+            index.remove(oid)
+            self.publish(dict(snap.model, scalars=scalars), oid_map, index)
+            self.value_cache.pop(oid, None)
+            self.log_change(("remove", name))
+        self.mark_dirty()
+    
+    def update_values(self, values): # Cambiar el valor de varios escalares {nombre: valor} en una sola versión nueva
+        with self.lock:
+            snap = self.snapshot
+            scalars = dict(snap.model["scalars"])
+            old_values = {}
+            for name, value in values.items():
+                old_values[name] = scalars[name]["value"]
+                scalars[name] = dict(scalars[name], value=value) # Objeto nuevo: el de la versión anterior no se toca
+            self.publish(dict(snap.model, scalars=scalars))
+            self.log_change(("values", values)) # En el mismo orden en que se publican las versiones
+        self.mark_dirty() # La tarea de persistencia compactará el cambio en la instantánea
+        return old_values
+    
+    def replace_rows(self, table_name, rows, values=None, persist=True): # Sustituir las filas {índice: {columna: valor}} de una tabla (y valores escalares) en una sola versión
+        with self.lock:
+            snap = self.snapshot
+            table = snap.model["tables"][table_name]
+            old_rows = table["rows"]
+            new_rows = {}
+            for row_index, row in rows.items():
+                key = str(row_index)
+                old_row = old_rows.get(key)
+                new_rows[key] = old_row if old_row == row else row # Las filas que no cambian conservan su objeto (y su caché)
+            tables = dict(snap.model["tables"])
+            tables[table_name] = dict(table, rows=new_rows)
+            model = dict(snap.model, tables=tables)
+            if values:
+                scalars = dict(snap.model["scalars"])
+                for name, value in values.items():
+                    scalars[name] = dict(scalars[name], value=value)
+                model["scalars"] = scalars
+            oid_map = index = None
+            if new_rows.keys() != old_rows.keys(): # Han aparecido o desaparecido filas: actualizar solo sus OIDs en el índice
+                oid_map = dict(snap.oid_map)
+                index = snap.index.copy()
+                for oid, _ in self.table_cells(table_name, table, old_rows.keys() - new_rows.keys()):
+                    oid_map.pop(oid, None)
+                    index.remove(oid)
+                for oid, cell in self.table_cells(table_name, table, new_rows.keys() - old_rows.keys()):
+                    oid_map[oid] = cell
+                    index.add(oid)
+            self.publish(model, oid_map, index)
+            if persist:
+                self.log_change(("rows", table_name, rows, values))
+        if persist: # Las muestras de CPU no fuerzan escrituras: se guardan con el siguiente cambio o al cerrar
+            self.mark_dirty()
+    
+    def reload_access(self, communities=None, users=None, views=None): # Recompilar la política de acceso y publicarla de una vez
+        self.access = AccessTable.compile(communities, users, views) # Asignación atómica: un SET en curso sigue con la tabla anterior
+    
+    def validate_set(self, oid, snmp_val, principal=None): # Validar una operación SET
         """
         Validación completa que incluye:
-        1. Verificación de permisos de comunidad
+        1. Permiso de escritura del principal (securityModel, securityName) sobre el OID
         2. Existencia del OID
         3. Permisos de acceso del objeto (read-only vs read-write)
         4. Tipo de dato correcto
         """
-        # 1. VERIFICAR PERMISOS DE COMUNIDAD
-        community = 'unknown'
-        
-        if self.snmpEngine and stateReference:
-            try: # Intentamos extraer la comunidad dependiendo de la version de SNMP (v1, v2c, v3)
-                # Guardamos el contexto de ejecución para acceder a la comunidad con securityName
-                cache = self.snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request')
-                if cache and 'securityName' in cache:
-                    securityName = cache['securityName'] 
-                    # securityName es un objeto SnmpAdminString, extraer el valor
-                    if hasattr(securityName, 'prettyPrint'):
-                        community = securityName.prettyPrint()
-                    else:    # Guardamos el valor de la comunidad directamente
-                        community = str(securityName)
-                    
-                    print(f"   🔍 Comunidad detectada: '{community}'")
-                
-                # Si no ha encontrado antes la comunidad lo intentamos con communityName
-                if community == 'unknown' and 'communityName' in cache:
-                    communityName = cache.get('communityName', b'')
-                    community = communityName.decode('utf-8') if communityName else 'unknown'
-                    print(f"   🔍 Comunidad (communityName): '{community}'")
-            
-            except Exception as e:
-                print(f"   ⚠️  Error extrayendo comunidad: {e}")
-        
-        print(f"   🔑 Comunidad FINAL: '{community}'")
-        
-        # Verificar si la comunidad tiene permisos de escritura
-        readonly_communities = ['public', 'public-area']
-        
-        if community in readonly_communities:
-            print(f"   🔒 BLOQUEADO: Comunidad '{community}' es de solo lectura")
+        # 1. Verificar permisos de escritura (se deniega si no se conoce quién envía la petición)
+        if principal is None or not self.access.can_write(principal[0], principal[1], oid):
+            self.auth_failures.value += 1 # agentSetAuthFailures
             return 16, 1  # authorizationError
         
-        if community == 'unknown':
-            # CRÍTICO: Denegar si no podemos verificar la comunidad
-            print(f"   🔒 BLOQUEADO: No se pudo verificar comunidad, denegando por seguridad")
-            return 16, 1  # Error: authorizationError
-        
-        print(f"   ✅ PERMITIDO: Comunidad '{community}' autorizada para escritura") # Si no es publica y existe permitimos escritura (privada)
+        control = self.controls.get(oid)
+        if control is not None: # Objeto de control: lo valida su propia función y no se guarda en el modelo
+            errStatus = control[0](snmp_val, principal)
+            return errStatus, 1 if errStatus else 0
         
         # 2. Verificar que el OID existe
-        nombre_objeto = self.oid_map.get(oid)
+        snap = self.snapshot
+        nombre_objeto = snap.oid_map.get(oid)
         if not nombre_objeto:
+            if any(provider.get(oid) is not None for provider in self.providers):
+                return 17, 1 # Error: notWritable (los objetos calculados al leerlos son de solo lectura)
             return 18, 1 # Error: El OID es valido pero no existe en la MIB del agente
         
-        obj = self.model["scalars"][nombre_objeto] # Como el OID es valido obtenemos el objeto
+        _, obj, _ = self.resolve(snap, nombre_objeto) # Como el OID es valido obtenemos su definición
         
         # 3. Verificar permisos de acceso del objeto
         if obj["access"] == "read-only":
@@ -152,16 +1191,202 @@ class JsonStore:
         return 0, 0 # Sin error
         
     def commit_set(self, oid, snmp_val): # Aplicar el cambio para una operación SET validada
-        nombre_objeto = self.oid_map[oid]
-        old_value = self.model["scalars"][nombre_objeto]["value"]
-        new_value = str(snmp_val) if self.model["scalars"][nombre_objeto]["type"] == "DisplayString" else int(snmp_val)
-        self.model["scalars"][nombre_objeto]["value"] = new_value
-        self.save() # Guardar cambios en el archivo JSON
-        return old_value, new_value
+        return self.commit_many([(oid, snmp_val)])[0]
+    
+    def commit_many(self, varbinds): # Aplicar todos los varbinds validados de un SET como una única versión (atómico para los lectores)
+        snap = self.snapshot
+        values = {}
+        changes = {} # OID -> (valor anterior, valor nuevo)
+        for oid, snmp_val in varbinds:
+            control = self.controls.get(oid)
+            if control is not None: # Objeto de control: se aplica en el momento, sin versión nueva ni WAL
+                changes[oid] = control[1](int(snmp_val))
+                continue
+            nombre_objeto = snap.oid_map[oid]
+            values[nombre_objeto] = str(snmp_val) if snap.model["scalars"][nombre_objeto]["type"] == "DisplayString" else int(snmp_val)
+        if values:
+            old_values = self.update_values(values)
+            snap = self.snapshot
+            for oid, _ in varbinds: # Dejar construidos en caché los valores que la respuesta va a leer
+                if oid not in changes:
+                    obj = snap.model["scalars"][snap.oid_map[oid]]
+                    self.value_cache[oid] = (obj, self.build_value(obj, obj["value"]))
+                    changes[oid] = (old_values[snap.oid_map[oid]], values[snap.oid_map[oid]])
+        return [changes[oid] for oid, _ in varbinds]
     
     def set_cpu_usage_internal(self, cpu_value): # Actualizar internamente el valor de uso de CPU
-        self.model["scalars"]["cpuUsage"]["value"] = cpu_value
-        self.save() # Guardar cambios en el archivo JSON
+        self.update_values({"cpuUsage": cpu_value})
+
+
+USM_AUTH_PROTOCOLS = { # Nombre en SNMP_V3_USERS -> protocolo de autenticación de pysnmp
+    "none": config.USM_AUTH_NONE,
+    "md5": config.USM_AUTH_HMAC96_MD5,
+    "sha": config.USM_AUTH_HMAC96_SHA,
+    "sha256": config.USM_AUTH_HMAC192_SHA256,
+    "sha512": config.USM_AUTH_HMAC384_SHA512,
+}
+
+
+USM_PRIV_PROTOCOLS = { # Nombre en SNMP_V3_USERS -> protocolo de cifrado de pysnmp
+    "none": config.USM_PRIV_NONE,
+    "des": config.USM_PRIV_CBC56_DES,
+    "aes": config.USM_PRIV_CFB128_AES,
+    "aes256": config.USM_PRIV_CFB256_AES,
+}
+
+
+def usm_security_level(user): # Nivel de seguridad mínimo que exige un usuario según sus protocolos
+    if user["auth"] == "none":
+        return "noAuthNoPriv"
+    return "authNoPriv" if user["priv"] == "none" else "authPriv"
+
+
+# UsmKeyCache guarda las claves USM de cada usuario ya localizadas para un engine ID (RFC 3414, A.2). Derivar
+# la clave de la contraseña exige un millón de bytes de hash por clave; con la caché solo se hace la primera
+# vez o cuando cambian el usuario, sus protocolos, sus contraseñas o el engine ID. Guarda también el engine ID
+# generado, que tiene que ser estable entre arranques para que las claves localizadas sigan valiendo.
+class UsmKeyCache:
+    def __init__(self, filepath=USM_KEY_FILE): # Constructor de la clase UsmKeyCache
+        self.filepath = filepath
+        self.engine_hex = None # Engine ID generado la primera vez
+        self.keys = {} # engine ID (hex) -> {usuario: {"fingerprint", "auth", "priv"}}
+        self.dirty = False
+        self.stats = {"hits": 0, "derived": 0, "derive_time": 0.0} # Claves servidas de la caché y derivadas
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.engine_hex = data.get("engineId")
+                self.keys = data.get("keys", {})
+            except (OSError, ValueError) as e: # Caché dañada: se regenera
+                log.warning("⚠️  No se pudo leer %s: %s", filepath, e)
+    
+    def engine_id(self, configured=SNMP_ENGINE_ID): # Engine ID del agente: el configurado o uno persistente
+        if configured:
+            return bytes.fromhex(configured)
+        if self.engine_hex is None: # RFC 3411: empresa con el bit alto, formato 5 (octetos) y 8 bytes aleatorios
+            self.engine_hex = ((0x80000000 | 28308).to_bytes(4, 'big') + b'\x05' + os.urandom(8)).hex()
+            self.dirty = True
+        return bytes.fromhex(self.engine_hex)
+    
+    def localized(self, user, engine_id): # (clave de autenticación, clave de cifrado) del usuario localizadas para engine_id
+        engine_hex = engine_id.hex()
+        fingerprint = hashlib.sha256(json.dumps([user["user"], user["auth"], user.get("auth_key"), user["priv"],
+                                                 user.get("priv_key"), engine_hex]).encode('utf-8')).hexdigest()
+        entry = self.keys.get(engine_hex, {}).get(user["user"])
+        if entry and entry["fingerprint"] == fingerprint:
+            self.stats["hits"] += 1
+            return bytes.fromhex(entry["auth"]), bytes.fromhex(entry["priv"])
+        started = time.perf_counter()
+        auth_proto, priv_proto = USM_AUTH_PROTOCOLS[user["auth"]], USM_PRIV_PROTOCOLS[user["priv"]]
+        auth_key = priv_key = b""
+        if user["auth"] != "none":
+            auth_service = config.AUTH_SERVICES[auth_proto]
+            auth_key = bytes(auth_service.localizeKey(auth_service.hashPassphrase(user["auth_key"].encode('utf-8')),
+                                                      v2c.OctetString(engine_id)))
+            if user["priv"] != "none":
+                priv_service = config.PRIV_SERVICES[priv_proto]
+                master = priv_service.hashPassphrase(auth_proto, user["priv_key"].encode('utf-8'))
+                priv_key = bytes(priv_service.localizeKey(auth_proto, master, v2c.OctetString(engine_id)))
+        self.keys.setdefault(engine_hex, {})[user["user"]] = {"fingerprint": fingerprint, "auth": auth_key.hex(),
+                                                              "priv": priv_key.hex()}
+        self.dirty = True
+        self.stats["derived"] += 1
+        self.stats["derive_time"] += time.perf_counter() - started
+        return auth_key, priv_key
+    
+    def localize_users(self): # {usuario: (clave de autenticación, clave de cifrado)} de SNMP_V3_USERS para el engine ID del agente
+        engine_id = self.engine_id()
+        keys = {user["user"]: self.localized(user, engine_id) for user in SNMP_V3_USERS}
+        self.save()
+        return keys
+    
+    def save(self): # Guardar la caché si ha cambiado (solo lectura y escritura para el propietario)
+        if not self.dirty:
+            return
+        payload = json.dumps({"engineId": self.engine_hex, "keys": self.keys}, indent=2).encode('utf-8')
+        write_atomic(self.filepath, payload)
+        try:
+            os.chmod(self.filepath, 0o600)
+        except OSError:
+            pass
+        self.dirty = False
+
+
+def load_v3_credentials(users, filepath=SNMP_V3_CREDENTIALS_FILE, environ=os.environ): # Usuarios de users con sus contraseñas (los que no las tienen se omiten)
+    stored = {}
+    if filepath and os.path.exists(filepath):
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("⚠️  No se pudo leer %s: %s", filepath, e)
+    ready = []
+    for user in users:
+        name = user["user"]
+        prefix = "SNMP_V3_" + "".join(c if c.isalnum() else "_" for c in name).upper()
+        resolved = dict(user)
+        for field, needed in (("auth_key", user["auth"] != "none"), ("priv_key", user["priv"] != "none")):
+            value = environ.get(f"{prefix}_{field.upper()}") or stored.get(name, {}).get(field) or user.get(field)
+            if needed and (not value or len(value) < 8): # RFC 3414: al menos 8 caracteres
+                log.warning("⚠️  Usuario SNMPv3 %s sin %s válida (%s_%s o %s): no se registra", name, field, prefix,
+                            field.upper(), filepath)
+                break
+            resolved[field] = value
+        else:
+            ready.append(resolved)
+    return ready
+
+
+def add_vacm_view(snmpEngine, securityModel, securityName, securityLevel, view): # Dar a securityName los subárboles de la vista
+    subtrees = VACM_VIEWS[view]
+    config.addVacmUser(snmpEngine, securityModel, securityName, securityLevel, readSubTree=subtrees["read"],
+                       writeSubTree=subtrees["write"], notifySubTree=subtrees["notify"])
+
+
+# AccessTable es la política de escritura ya compilada: un conjunto de claves (securityModel, securityName,
+# prefijo de OID) sacadas de SNMP_COMMUNITIES, SNMP_V3_USERS y VACM_VIEWS. Autorizar un SET es buscar la clave
+# con el prefijo del OID de cada longitud presente (con las vistas actuales solo hay una, así que es una búsqueda).
+# Es inmutable; para cambiar la política se compila otra y se sustituye entera (JsonStore.reload_access).
+class AccessTable:
+    __slots__ = ("grants", "prefix_lengths")
+    
+    def __init__(self, grants): # Constructor de la clase AccessTable
+        self.grants = frozenset(grants) # {(securityModel, securityName en bytes, prefijo de OID)}
+        self.prefix_lengths = tuple(sorted({len(prefix) for _, _, prefix in self.grants})) # Longitudes a probar
+    
+    @classmethod
+    def compile(cls, communities=None, users=None, views=None): # Tabla con los subárboles de escritura de cada principal
+        communities = SNMP_COMMUNITIES if communities is None else communities
+        users = SNMP_V3_USERS if users is None else users
+        views = VACM_VIEWS if views is None else views
+        grants = []
+        for security_name, view in communities.values(): # Las comunidades llegan como SNMPv1 (1) o SNMPv2c (2)
+            if views[view]["write"]:
+                grants += [(model, security_name.encode('utf-8'), tuple(views[view]["write"])) for model in (1, 2)]
+        for user in users:
+            if views[user["view"]]["write"]:
+                grants.append((3, user["user"].encode('utf-8'), tuple(views[user["view"]]["write"])))
+        return cls(grants)
+    
+    def can_write(self, securityModel, securityName, oid): # ¿Puede el principal modificar el OID?
+        grants = self.grants
+        return any((securityModel, securityName, oid[:length]) in grants for length in self.prefix_lengths)
+
+
+def configure_security(snmpEngine, usm_keys, v2c_enabled=SNMP_V2C_ENABLED): # Comunidades, usuarios USM (con claves ya localizadas) y vistas VACM
+    for community, (security_name, view) in SNMP_COMMUNITIES.items():
+        if v2c_enabled: # Sin v2c la comunidad no se registra y las peticiones v1/v2c se rechazan (unknownCommunityName)
+            config.addV1System(snmpEngine, security_name, community)
+        for secModel in (1, 2): # Las notificaciones salen con public-area (v2c) aunque no se atiendan peticiones v2c
+            add_vacm_view(snmpEngine, secModel, security_name, 'noAuthNoPriv', view)
+    
+    for user in SNMP_V3_USERS:
+        auth_key, priv_key = usm_keys[user["user"]] # Claves ya localizadas (UsmKeyCache): pysnmp no las vuelve a derivar
+        config.addV3User(snmpEngine, user["user"], USM_AUTH_PROTOCOLS[user["auth"]], auth_key or None,
+                         USM_PRIV_PROTOCOLS[user["priv"]], priv_key or None,
+                         authKeyType=config.USM_KEY_TYPE_LOCALIZED, privKeyType=config.USM_KEY_TYPE_LOCALIZED)
+        add_vacm_view(snmpEngine, 3, user["user"], usm_security_level(user), user["view"])
 
 
 def oid_to_string(oid): # Convierte la tupla/objeto OID en texto legible
@@ -174,34 +1399,64 @@ def get_timestamp(): # Obtener timestamp
     return time.strftime('%Y-%m-%d %H:%M:%S')
 
 
+def banner(title): # Cabecera de bloque de la salida detallada (modo debug)
+    return f"\n{'='*70}\n{title}\n{'='*70}"
+
+
+SET_ERROR_NAME = {0: "noError", 1: "tooBig", 5: "genErr", 7: "wrongType", 10: "wrongValue", 12: "inconsistentValue", 14: "commitFailed",
+                  16: "authorizationError", 17: "notWritable", 18: "inconsistentName"} # Nombre de error SNMP
+
+
+SET_ERROR_TEXT = { # Descripción de los códigos de error de SET para la salida detallada
+    16: "Sin autorización (authorizationError)",
+    17: "Variable de solo lectura (notWritable)",
+    7: "Tipo incorrecto (wrongType)",
+    10: "Valor fuera de rango (wrongValue)",
+    12: "Valor incompatible con el estado actual (inconsistentValue)",
+}
+
+
+def varbind_size(oid, val): # Tamaño aproximado en bytes (BER) de un varbind dentro de la respuesta
+    body = len(encoder.encode(v2c.ObjectIdentifier(oid))) + len(encoder.encode(val))
+    return body + (2 if body < 128 else 4) # Cabecera SEQUENCE del varbind
+
+
+def message_overhead(snmpEngine, req): # Bytes de la respuesta que no son varbinds, medidos en el mensaje de la petición
+    try:
+        ctx = snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request')
+    except KeyError: # Sin el mensaje original (llamada directa al manejador): suponer las cabeceras de SNMPv3
+        return BULK_DEFAULT_OVERHEAD
+    return len(ctx['wholeMsg']) - sum(varbind_size(oid, val) for oid, val in req) + BULK_HEADER_MARGIN
+
+
 # Cada clase maneja un tipo de operación SNMP (GET, GETNEXT, SET) e interactúa con JsonStore haciendo un override de handleMgmtOperation
 class JsonGet(cmdrsp.GetCommandResponder):
     def __init__(self, snmpEngine, snmpContext, store): # Constructor de la clase JsonGet
         super().__init__(snmpEngine, snmpContext)
         self.store = store
+        self.metrics = PduMetrics("get")
     
     def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU): # Manejar una operación GET (override)
+        start = time.perf_counter()
         req = v2c.apiPDU.getVarBinds(PDU) # Obtener los VarBinds de la solicitud
+        debug = log.isEnabledFor(logging.DEBUG) # Solo en modo debug se construye la salida detallada
         
-        print(f"\n{'='*70}")
-        print(f"📥 GET REQUEST recibida [{get_timestamp()}]")
-        print(f"{'='*70}")
+        if debug:
+            log.debug(banner(f"📥 GET REQUEST recibida [{get_timestamp()}]"))
         
+        self.store.refresh([tuple(oid) for oid, _ in req]) # Refrescar cpuUsage/cpuCoreTable si su muestra ha caducado
+        snap = self.store.pin() # Todos los varbinds se leen de la misma versión
         rsp = [] # Respuesta inicial vacía
         for oid, _ in req:
-            oid_str = oid_to_string(oid)
-            ok, val = self.store.get_exact(tuple(oid))
+            ok, val = self.store.get_exact(tuple(oid), snap)
             
-            if ok: # Si se encontró el OID
-                nombre_objeto = self.store.oid_map.get(tuple(oid), "unknown") # Obtener el nombre de la variable
-                value_str = str(val) if hasattr(val, '__str__') else repr(val) # Convertir valor a string 
-                print(f"   OID: {oid_str}")
-                print(f"   Variable: {nombre_objeto}")
-                print(f"   Valor: {value_str}")
-                print(f"   ✅ Encontrado")
-            else:
-                print(f"   OID: {oid_str}")
-                print(f"   ❌ No existe (NoSuchObject)")
+            if debug:
+                oid_str = oid_to_string(oid)
+                if ok: # Si se encontró el OID
+                    nombre_objeto = snap.oid_map.get(tuple(oid), "unknown") # Obtener el nombre de la variable
+                    log.debug(f"   OID: {oid_str}\n   Variable: {nombre_objeto}\n   Valor: {val}\n   ✅ Encontrado")
+                else:
+                    log.debug(f"   OID: {oid_str}\n   ❌ No existe (NoSuchObject)")
             
             rsp.append((oid, val)) # Construir la respuesta
         
@@ -209,153 +1464,357 @@ class JsonGet(cmdrsp.GetCommandResponder):
         v2c.apiPDU.setErrorStatus(rspPDU, 0)
         v2c.apiPDU.setVarBinds(rspPDU, rsp)
         self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta
+        self.metrics.record(start, 0, len(rsp))
         
-        print(f"   📤 Respuesta enviada correctamente")
-        print(f"{'='*70}\n")
+        if debug:
+            log.debug(f"   📤 Respuesta enviada correctamente\n{'='*70}\n")
+        elif log.isEnabledFor(logging.INFO):
+            log_pdu(snmpEngine, "GET", 0, rsp)
 
 
 class JsonGetNext(cmdrsp.NextCommandResponder): 
     def __init__(self, snmpEngine, snmpContext, store): # Constructor de la clase JsonGetNext
         super().__init__(snmpEngine, snmpContext)
         self.store = store
+        self.metrics = PduMetrics("getnext")
     
     def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU): # Manejar una operación GETNEXT (override)
+        start = time.perf_counter()
         req = v2c.apiPDU.getVarBinds(PDU) # Obtener los VarBinds de la solicitud
+        debug = log.isEnabledFor(logging.DEBUG)
         
-        print(f"\n{'='*70}")
-        print(f"📥 GETNEXT REQUEST recibida [{get_timestamp()}]")
-        print(f"{'='*70}")
+        if debug:
+            log.debug(banner(f"📥 GETNEXT REQUEST recibida [{get_timestamp()}]"))
         
+        self.store.refresh([tuple(oid) for oid, _ in req], following=True)
+        snap = self.store.pin() # Todos los varbinds se leen de la misma versión
         rsp = [] # Respuesta inicial vacía
         for oid, _ in req:
-            oid_str = oid_to_string(oid)
-            ok, next_oid, val = self.store.get_next(tuple(oid)) # Obtener el siguiente OID
-            
-            print(f"   OID solicitado: {oid_str}")
+            ok, next_oid, val = self.store.get_next(tuple(oid), snap) # Obtener el siguiente OID
             
             if ok: # Si se encontró un siguiente OID
-                next_oid_str = oid_to_string(next_oid)
-                nombre_objeto = self.store.oid_map.get(next_oid, "unknown")
-                value_str = str(val) if hasattr(val, '__str__') else repr(val) # Convertir valor a string
-                print(f"   ➡️  Siguiente OID: {next_oid_str}")
-                print(f"   Variable: {nombre_objeto}")
-                print(f"   Valor: {value_str}")
-                print(f"   ✅ Encontrado")
+                if debug:
+                    nombre_objeto = snap.oid_map.get(next_oid, "unknown")
+                    log.debug(f"   OID solicitado: {oid_to_string(oid)}\n   ➡️  Siguiente OID: {oid_to_string(next_oid)}\n"
+                              f"   Variable: {nombre_objeto}\n   Valor: {val}\n   ✅ Encontrado")
                 rsp.append((v2c.ObjectIdentifier(next_oid), val)) # Construir la respuesta
             else:
-                print(f"   ❌ No hay más OIDs (EndOfMibView)")
+                if debug:
+                    log.debug(f"   OID solicitado: {oid_to_string(oid)}\n   ❌ No hay más OIDs (EndOfMibView)")
                 rsp.append((oid, v2c.EndOfMibView())) # Responder con EndOfMibView si no hay siguiente OID
         
         rspPDU = v2c.apiPDU.getResponse(PDU)
         v2c.apiPDU.setVarBinds(rspPDU, rsp)
         self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta
+        self.metrics.record(start, 0, len(rsp))
         
-        print(f"   📤 Respuesta enviada correctamente")
-        print(f"{'='*70}\n")
+        if debug:
+            log.debug(f"   📤 Respuesta enviada correctamente\n{'='*70}\n")
+        elif log.isEnabledFor(logging.INFO):
+            log_pdu(snmpEngine, "GETNEXT", 0, rsp)
+
+
+class JsonGetBulk(cmdrsp.BulkCommandResponder):
+    def __init__(self, snmpEngine, snmpContext, store): # Constructor de la clase JsonGetBulk
+        super().__init__(snmpEngine, snmpContext)
+        self.store = store
+        self.metrics = PduMetrics("getbulk")
+    
+    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU): # Manejar una operación GETBULK (override)
+        start = time.perf_counter()
+        req = v2c.apiPDU.getVarBinds(PDU) # Obtener los VarBinds de la solicitud
+        non_repeaters = max(0, int(v2c.apiBulkPDU.getNonRepeaters(PDU)))
+        max_repetitions = max(0, int(v2c.apiBulkPDU.getMaxRepetitions(PDU)))
+        
+        N = min(non_repeaters, len(req)) # Varbinds que solo se resuelven una vez (como GETNEXT)
+        R = len(req) - N # Varbinds que se repiten hasta max_repetitions
+        M = min(max_repetitions, self.maxVarBinds // R) if R else 0 # Limitar el número total de varbinds
+        
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug(banner(f"📥 GETBULK REQUEST recibida [{get_timestamp()}]") +
+                      f"\n   non-repeaters: {N} | max-repetitions: {max_repetitions} (aplicado: {M})")
+        
+        self.store.refresh([tuple(oid) for oid, _ in req], following=True)
+        snap = self.store.pin() # Toda la respuesta se construye sobre la misma versión
+        rsp = [] # Respuesta inicial vacía
+        size = 0 # Bytes acumulados en la respuesta
+        budget = BULK_MAX_RESPONSE_SIZE - message_overhead(snmpEngine, req) # Bytes disponibles para los varbinds
+        
+        for oid, _ in req[:N]: # Los non-repeaters se comportan como un GETNEXT normal
+            ok, next_oid, val = self.store.get_next(tuple(oid), snap)
+            varbind = (v2c.ObjectIdentifier(next_oid), val) if ok else (oid, v2c.EndOfMibView())
+            size += varbind_size(*varbind)
+            rsp.append(varbind)
+        
+        if size > budget: # Ni siquiera caben los non-repeaters: tooBig sin varbinds, como un GET demasiado grande
+            rspPDU = v2c.apiPDU.getResponse(PDU)
+            v2c.apiPDU.setErrorStatus(rspPDU, 1)
+            v2c.apiPDU.setVarBinds(rspPDU, [])
+            self.sendPdu(snmpEngine, stateReference, rspPDU)
+            self.metrics.record(start, 1, 0)
+            if debug:
+                log.debug(f"   ❌ tooBig: los {N} non-repeaters ocupan ~{size} bytes y caben {budget}\n{'='*70}\n")
+            elif log.isEnabledFor(logging.INFO):
+                log_pdu(snmpEngine, "GETBULK", 1, [])
+            return
+        
+        # Los repeaters avanzan en paralelo por el índice ordenado: un iterador por columna, sin volver a buscar
+        cursors = [self.store.iter_next(tuple(oid), snap) for oid, _ in req[N:]]
+        last_oids = [oid for oid, _ in req[N:]]
+        finished = [False] * R
+        truncated = False
+        
+        for _ in range(M):
+            for col, cursor in enumerate(cursors):
+                if finished[col]:
+                    varbind = (last_oids[col], v2c.EndOfMibView())
+                else:
+                    item = next(cursor, None)
+                    if item is None: # Fin de la MIB para esta columna
+                        finished[col] = True
+                        varbind = (last_oids[col], v2c.EndOfMibView())
+                    else:
+                        last_oids[col] = v2c.ObjectIdentifier(item[0])
+                        varbind = (last_oids[col], item[1])
+                
+                varbind_len = varbind_size(*varbind)
+                if size + varbind_len > budget: # No cabe en el datagrama: cortar la respuesta aquí
+                    truncated = True
+                    break
+                size += varbind_len
+                rsp.append(varbind)
+            
+            if truncated or all(finished): # Todas las columnas han llegado al final de la MIB
+                break
+        
+        rspPDU = v2c.apiPDU.getResponse(PDU)
+        v2c.apiPDU.setErrorStatus(rspPDU, 0)
+        v2c.apiPDU.setVarBinds(rspPDU, rsp)
+        self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta
+        self.metrics.record(start, 0, len(rsp))
+        
+        if debug:
+            log.debug(f"   📦 {len(rsp)} varbinds, ~{size} de {budget} bytes{' (recortada por tamaño)' if truncated else ''}\n"
+                      f"   📤 Respuesta enviada correctamente\n{'='*70}\n")
+        elif log.isEnabledFor(logging.INFO):
+            log_pdu(snmpEngine, "GETBULK", 0, rsp)
 
 
 class JsonSet(cmdrsp.SetCommandResponder):
-    def __init__(self, snmpEngine, snmpContext, store): # Constructor de la clase JsonSet
+    def __init__(self, snmpEngine, snmpContext, store, forward=None, on_commit=None): # Constructor de la clase JsonSet
         super().__init__(snmpEngine, snmpContext)
         self.store = store
+        self.forward = forward # Corrutina que aplica el SET en el proceso principal (solo en los procesos trabajadores)
+        self.on_commit = on_commit # Se llama tras aplicar un SET y antes de responder (el principal difunde la versión nueva)
+        self.metrics = PduMetrics("set")
+        self.principal = None # (securityModel, securityName) de la petición en curso
+        self.deferred = {} # stateReference -> contexto de ejecución de los SET cuya respuesta aún no se ha enviado (reenviados o esperando al WAL)
+    
+    def processPdu(self, snmpEngine, messageProcessingModel, securityModel, securityName, *args): # Recordar quién envía la PDU (override)
+        self.principal = (securityModel, bytes(securityName)) # handleMgmtOperation se llama dentro, en el mismo hilo
+        try:
+            super().processPdu(snmpEngine, messageProcessingModel, securityModel, securityName, *args)
+        finally:
+            self.principal = None
+    
+    def releaseStateInformation(self, stateReference): # Conservar el estado de los SET reenviados hasta responderlos (override)
+        if stateReference not in self.deferred:
+            super().releaseStateInformation(stateReference)
     
     def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU): # Manejar una operación SET (override)
+        start = time.perf_counter()
         req = v2c.apiPDU.getVarBinds(PDU) # Obtener los VarBinds de la solicitud
+        debug = log.isEnabledFor(logging.DEBUG)
         
-        print(f"\n{'='*70}")
-        print(f"📥 SET REQUEST recibida [{get_timestamp()}]")
-        print(f"{'='*70}")
+        if debug:
+            log.debug(banner(f"📥 SET REQUEST recibida [{get_timestamp()}]"))
         
         # Validate all OIDs first
         for idx, (oid, val) in enumerate(req, start=1): # Validar todos los OIDs primero
-            oid_str = oid_to_string(oid)
-            nombre_objeto = self.store.oid_map.get(tuple(oid), "unknown") # Obtener el nombre de la variable
-            
-            # Pasar stateReference para que validate_set pueda verificar comunidad
-            errStatus, _ = self.store.validate_set(tuple(oid), val, stateReference, contextName)
+            errStatus, _ = self.store.validate_set(tuple(oid), val, self.principal) # Una búsqueda en la tabla de acceso
             
-            print(f"   OID: {oid_str}")
-            print(f"   Variable: {nombre_objeto}")
-            print(f"   Nuevo valor: {val}")
+            if debug:
+                nombre_objeto = self.store.oid_map.get(tuple(oid), "unknown") # Obtener el nombre de la variable
+                log.debug(f"   OID: {oid_to_string(oid)}\n   Variable: {nombre_objeto}\n   Nuevo valor: {val}")
             
             if errStatus: # Si hay un error, enviar respuesta de error inmediatamente
-                if errStatus == 16:
-                    print(f"   ❌ ERROR: Sin autorización (authorizationError)")
-                elif errStatus == 17:
-                    print(f"   ❌ ERROR: Variable de solo lectura (notWritable)")
-                elif errStatus == 7:
-                    print(f"   ❌ ERROR: Tipo incorrecto (wrongType)")
-                else:
-                    print(f"   ❌ ERROR: Código {errStatus}")
-                
-                rspPDU = v2c.apiPDU.getResponse(PDU) # Construir PDU de respuesta
-                v2c.apiPDU.setErrorStatus(rspPDU, errStatus)
-                v2c.apiPDU.setVarBinds(rspPDU, req)
-                self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta de error
-                print(f"   📤 Respuesta de error enviada")
-                print(f"{'='*70}\n")
+                if debug:
+                    log.debug(f"   ❌ ERROR: {SET_ERROR_TEXT.get(errStatus, f'Código {errStatus}')}")
+                self.send_error(snmpEngine, stateReference, PDU, req, errStatus, start)
                 return
         
         # Si todos los OIDs son válidos, aplicar los cambios
-        print(f"\n   ✅ Validación exitosa, aplicando cambios...")
+        if debug:
+            log.debug(f"\n   ✅ Validación exitosa, aplicando cambios...")
         
-        for oid, val in req: # Aplicar los cambios
-            oid_str = oid_to_string(oid)
-            nombre_objeto = self.store.oid_map.get(tuple(oid), "unknown")
-            old_value, new_value = self.store.commit_set(tuple(oid), val) # Aplicar el cambio
-            print(f"   📝 {nombre_objeto}: {old_value} → {new_value}")
+        if self.forward: # Proceso trabajador: el SET lo aplica el proceso principal y se responde al confirmarlo
+            self.deferred[stateReference] = snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request')
+            asyncio.ensure_future(self.apply_forwarded(snmpEngine, stateReference, PDU, req, start))
+            return
+        changes = self.store.commit_many([(tuple(oid), val) for oid, val in req]) # Todos los cambios se publican a la vez
+        if self.on_commit:
+            self.on_commit()
+        wal = self.store.wal
+        if wal is not None and wal.group_commit: # Responder cuando el cambio esté en disco, con un fsync compartido
+            self.deferred[stateReference] = snmpEngine.observer.getExecutionContext('rfc3412.receiveMessage:request')
+            asyncio.ensure_future(self.respond_durable(snmpEngine, stateReference, PDU, req, changes, wal.appended, start))
+            return
+        self.send_result(snmpEngine, stateReference, PDU, req, changes, start)
+    
+    async def respond_durable(self, snmpEngine, stateReference, PDU, req, changes, lsn, start): # Confirmar el SET tras el fsync del WAL
+        try:
+            await self.store.wal.durable(lsn)
+            self.send_result(snmpEngine, stateReference, PDU, req, changes, start)
+        except OSError as e: # El cambio está aplicado pero no se ha podido garantizar en disco: commitFailed
+            log.error("⚠️  Error sincronizando %s: %s", self.store.wal.filepath, e)
+            self.send_error(snmpEngine, stateReference, PDU, req, 14, start)
+        finally:
+            self.deferred.pop(stateReference, None)
+            super().releaseStateInformation(stateReference)
+    
+    async def apply_forwarded(self, snmpEngine, stateReference, PDU, req, start): # Reenviar el SET al proceso principal y responder al gestor
+        values = [(tuple(oid), str(val) if isinstance(val, v2c.OctetString) else int(val)) for oid, val in req]
+        try:
+            errStatus, changes = await self.forward(values)
+            if errStatus:
+                self.send_error(snmpEngine, stateReference, PDU, req, errStatus, start)
+            else:
+                self.send_result(snmpEngine, stateReference, PDU, req, changes, start)
+        except (asyncio.TimeoutError, OSError, EOFError) as e: # El principal no contesta: genErr
+            log.warning("⚠️  SET no confirmado por el proceso principal: %s", e or type(e).__name__)
+            self.send_error(snmpEngine, stateReference, PDU, req, 5, start)
+        finally:
+            self.deferred.pop(stateReference, None)
+            super().releaseStateInformation(stateReference)
+    
+    def send_error(self, snmpEngine, stateReference, PDU, req, errStatus, start): # Responder con el código de error del SET
+        rspPDU = v2c.apiPDU.getResponse(PDU) # Construir PDU de respuesta
+        v2c.apiPDU.setErrorStatus(rspPDU, errStatus)
+        v2c.apiPDU.setVarBinds(rspPDU, req)
+        self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta de error
+        self.metrics.record(start, errStatus, len(req))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"   📤 Respuesta de error enviada\n{'='*70}\n")
+        elif log.isEnabledFor(logging.INFO):
+            log_pdu(snmpEngine, "SET", errStatus, req, self.deferred.get(stateReference))
+    
+    def send_result(self, snmpEngine, stateReference, PDU, req, changes, start): # Responder con los valores ya aplicados
+        debug = log.isEnabledFor(logging.DEBUG)
+        snap = self.store.pin()
+        if debug:
+            for (oid, _), (old_value, new_value) in zip(req, changes):
+                nombre_objeto = snap.oid_map.get(tuple(oid), "unknown")
+                log.debug(f"   📝 {nombre_objeto}: {old_value} → {new_value}")
         
-        rsp = [(oid, self.store.get_exact(tuple(oid))[1]) for oid, _ in req] # Construir la respuesta con los nuevos valores
+        rsp = [(oid, self.store.get_exact(tuple(oid), snap)[1]) for oid, _ in req] # Construir la respuesta con los nuevos valores
         rspPDU = v2c.apiPDU.getResponse(PDU)
         v2c.apiPDU.setVarBinds(rspPDU, rsp)
         self.sendPdu(snmpEngine, stateReference, rspPDU) # Enviar la respuesta
+        self.metrics.record(start, 0, len(rsp))
         
-        print(f"   📤 Respuesta enviada correctamente")
-        print(f"   💾 Cambios guardados en {JSON_FILE}")
-        print(f"{'='*70}\n")
+        if debug:
+            logged = self.store.wal is not None and any(tuple(oid) not in self.store.controls for oid, _ in req) # Los objetos de control no van al WAL
+            wal_line = f"   💾 Cambio registrado en {self.store.wal.filepath}\n" if logged else ""
+            log.debug(f"   📤 Respuesta enviada correctamente\n{wal_line}{'='*70}\n")
+        elif log.isEnabledFor(logging.INFO):
+            log_pdu(snmpEngine, "SET", 0, rsp, self.deferred.get(stateReference))
 
 
-def send_trap(snmpEngine, store): # Enviar una TRAP SNMP y un email cuando se supera el umbral de CPU
-    ntfOrg = ntforg.NotificationOriginator() 
-    cpu_val = store.model["scalars"]["cpuUsage"]["value"]
-    threshold_val = store.model["scalars"]["cpuThreshold"]["value"]
-    email_val = store.model["scalars"]["managerEmail"]["value"]
-    
-    print(f"\n{'='*70}")
-    print(f"📡 ENVIANDO TRAP [{get_timestamp()}]")
-    print(f"{'='*70}")
-    print(f"   Razón: CPU {cpu_val}% > Umbral {threshold_val}%")
-    print(f"   Email destino: {email_val}")
-    
-    varBinds = [
+def build_trap_varbinds(cpu_val, threshold_val, email_val): # VarBinds de la notificación cpuOverThreshold
+    return [
         (v2c.ObjectIdentifier((1,3,6,1,2,1,1,3,0)), v2c.TimeTicks(int((time.time()-AGENT_START)*100))),
         (v2c.ObjectIdentifier((1,3,6,1,6,3,1,1,4,1,0)), v2c.ObjectIdentifier((1,3,6,1,4,1,28308,2,1))),
         (v2c.ObjectIdentifier((1,3,6,1,4,1,28308,1,3,0)), v2c.Integer(cpu_val)),
         (v2c.ObjectIdentifier((1,3,6,1,4,1,28308,1,4,0)), v2c.Integer(threshold_val)),
         (v2c.ObjectIdentifier((1,3,6,1,4,1,28308,1,2,0)), v2c.OctetString(email_val.encode('utf-8')))
-    ] # VarBinds de la TRAP
+    ]
+
+
+# TrapSender entrega cada alerta a todos los destinos de NOTIFY_TARGETS a la vez desde un único
+# NotificationOriginator. Un TRAP se da por entregado al salir; un INFORM espera la respuesta del gestor
+# y se reenvía hasta "retries" veces. Guarda por destino entregas, fallos, reenvíos y latencia.
+class TrapSender:
+    def __init__(self, snmpEngine, targets=None): # Constructor de la clase TrapSender
+        self.snmpEngine = snmpEngine
+        self.originator = ntforg.NotificationOriginator() # Reutilizado por todos los envíos
+        self.targets = []
+        self.stats = {}
+        # Las respuestas a los INFORM llegan desde direcciones de la tabla de destinos: la comunidad solo se acepta
+        # desde ellas si comparte alguna de sus etiquetas, así que se registra también con la etiqueta "notify"
+        config.addV1System(snmpEngine, 'public-notify', 'public', transportTag='notify', securityName='public-area')
+        for target in NOTIFY_TARGETS if targets is None else targets:
+            self.add_target(target)
     
-    try: # Enviar la TRAP
-        ntfOrg.sendVarBinds(snmpEngine, 'trap-target', None, '', varBinds) # Enviar TRAP al destino configurado
-        print(f"   ✅ TRAP enviada exitosamente")
-    except Exception as e:
-        print(f"   ❌ Error enviando TRAP: {e}")
+    def add_target(self, target): # Registrar un destino en la configuración SNMP del motor
+        target = {"timeout": NOTIFY_INFORM_TIMEOUT, "retries": NOTIFY_INFORM_RETRIES, **target}
+        if target["type"] not in ("trap", "inform"):
+            raise ValueError(f"Tipo de notificación desconocido: {target['type']}")
+        name, params = target["name"], target["name"] + "-params"
+        config.addTargetParams(self.snmpEngine, params, 'public-area', 'noAuthNoPriv', 1)
+        config.addTargetAddr(self.snmpEngine, name, udp.domainName, (target["host"], target["port"]), params,
+                             timeout=int(target["timeout"] * 100), retryCount=0, tagList=name + " notify") # Los reenvíos los hace send_to
+        config.addNotificationTarget(self.snmpEngine, name, params, name, target["type"])
+        self.targets.append(target)
+        self.stats[name] = {"sent": 0, "failed": 0, "retries": 0, "latency_total": 0.0, "latency_max": 0.0}
     
-    print(f"{'='*70}\n")
+    async def send(self, event): # Enviar la alerta a todos los destinos en paralelo; True si todos la han recibido
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(banner(f"📡 ENVIANDO TRAP [{get_timestamp()}]") +
+                      f"\n   Razón: CPU {event['cpu']}% > Umbral {event['threshold']}%\n   Email destino: {event['email']}"
+                      f"\n   Destinos: {', '.join(t['name'] for t in self.targets)}")
+        varBinds = build_trap_varbinds(event["cpu"], event["threshold"], event["email"])
+        results = await asyncio.gather(*(self.send_to(target, varBinds) for target in self.targets))
+        return all(results)
+    
+    async def send_to(self, target, varBinds): # Entregar a un destino, reenviando los INFORM sin respuesta
+        name = target["name"]
+        stats = self.stats[name]
+        attempts = 1 + target["retries"] if target["type"] == "inform" else 1
+        started = time.perf_counter()
+        for attempt in range(attempts):
+            if attempt:
+                stats["retries"] += 1
+            error = await self.send_once(target, varBinds)
+            if error is None:
+                latency = time.perf_counter() - started
+                stats["sent"] += 1
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+                log.info("%s cpuOverThreshold destino=%s intentos=%d latencia=%.1f ms", target["type"].upper(), name,
+                         attempt + 1, latency * 1000,
+                         extra={"fields": {"event": target["type"], "target": name, "attempts": attempt + 1, "result": "ok"}})
+                return True
+        stats["failed"] += 1
+        log.error("❌ Error enviando %s a %s: %s", target["type"].upper(), name, error,
+                  extra={"fields": {"event": target["type"], "target": name, "attempts": attempts, "result": "error"}})
+        return False
     
-    send_email(email_val, cpu_val, threshold_val) # Llama a la funcion de enviar email de alerta
+    async def send_once(self, target, varBinds): # Un envío: None si se ha entregado o el texto del error
+        future = asyncio.get_event_loop().create_future()
+        
+        def done(snmpEngine, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, cbCtx):
+            if not future.done():
+                future.set_result(str(errorIndication) if errorIndication else
+                                  errorStatus.prettyPrint() if errorStatus else None)
+        
+        try:
+            self.originator.sendVarBinds(self.snmpEngine, target["name"], None, b'', varBinds, done)
+        except Exception as e:
+            return str(e) or type(e).__name__
+        if future.done():
+            return future.result()
+        if target["type"] == "trap": # Un TRAP solo llama a done() si falla el envío
+            future.cancel()
+            return None
+        try: # pysnmp avisa del timeout, pero no llama a done() si descarta la notificación (p. ej. por VACM)
+            return await asyncio.wait_for(future, target["timeout"] + 1.0)
+        except asyncio.TimeoutError:
+            return "sin respuesta"
 
 
-def send_email(to_addr, cpu_val, threshold_val): # Enviar un email de alerta cuando se supera el umbral de CPU
-    print(f"{'='*70}")
-    print(f"📧 ENVIANDO EMAIL [{get_timestamp()}]")
-    print(f"{'='*70}")
-    print(f"   De: {GMAIL_USER}")
-    print(f"   Para: {to_addr}")
-    print(f"   Asunto: ⚠️ Alerta CPU: {cpu_val}%")
-    
-    try: # Construir el cuerpo del email en HTML y texto plano
-        html_body = f"""
+def build_alert_message(to_addr, cpu_val, threshold_val): # Construir el email de una alerta en HTML y texto plano
+    html_body = f"""
 <!DOCTYPE html>
 <html>
 <head>
@@ -490,8 +1949,8 @@ def send_email(to_addr, cpu_val, threshold_val): # Enviar un email de alerta cua
 </body>
 </html>
 """
-        
-        text_body = f"""
+    
+    text_body = f"""
 ╔══════════════════════════════════════════════════════════╗
 ║                  ⚠️  ALERTA DE CPU  ⚠️                   ║
 ╚══════════════════════════════════════════════════════════╝
@@ -543,40 +2002,621 @@ supera el umbral definido.
 
 ══════════════════════════════════════════════════════════
 """
+    
+    msg = MIMEMultipart('alternative') # Crear mensaje para rellenar
+    msg['Subject'] = f'⚠️ Alerta CPU: {cpu_val}% (Umbral: {threshold_val}%)'
+    msg['From'] = EMAIL_FROM
+    msg['To'] = to_addr
+    
+    part1 = MIMETextPart(text_body, 'plain', 'utf-8')
+    msg.attach(part1)
+    
+    part2 = MIMETextPart(html_body, 'html', 'utf-8')
+    msg.attach(part2)
+    return msg
+
+
+def build_digest_message(to_addr, alerts): # Construir un único email que resume varias alertas del mismo destinatario
+    peak = max(alert["cpu"] for alert in alerts)
+    rows_html = "\n".join(
+        f"<tr><td>{time.strftime('%d/%m/%Y - %H:%M:%S', time.localtime(alert['timestamp']))}</td>"
+        f"<td><strong>{alert['cpu']}%</strong></td><td>{alert['threshold']}%</td></tr>" for alert in alerts)
+    rows_text = "\n".join(
+        f"   {time.strftime('%d/%m/%Y - %H:%M:%S', time.localtime(alert['timestamp']))}   CPU {alert['cpu']:>3}%   Umbral {alert['threshold']}%"
+        for alert in alerts)
+    html_body = f"""
+<!DOCTYPE html>
+<html>
+<head><meta charset="UTF-8"></head>
+<body style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; background-color: #f5f5f5; padding: 20px;">
+    <div style="max-width: 600px; margin: 0 auto; background-color: white; border-radius: 10px; padding: 30px;">
+        <h1 style="color: #ff4757;">⚠️ Resumen de alertas de CPU</h1>
+        <p>Se han producido <strong>{len(alerts)}</strong> alertas (pico: <strong>{peak}%</strong>).</p>
+        <table style="width: 100%; border-collapse: collapse;" border="1" cellpadding="6">
+            <tr><th>Fecha y Hora</th><th>Uso de CPU</th><th>Umbral</th></tr>
+            {rows_html}
+        </table>
+        <p style="color: #666; font-size: 12px;">🖥️ Mini SNMP Agent - Agente OID: 1.3.6.1.4.1.28308</p>
+    </div>
+</body>
+</html>
+"""
+    text_body = f"""
+⚠️  RESUMEN DE ALERTAS DE CPU ⚠️
+
+Se han producido {len(alerts)} alertas (pico: {peak}%).
+
+{rows_text}
+
+🖥️  Mini SNMP Agent - Agente OID: 1.3.6.1.4.1.28308
+"""
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = f'⚠️ Resumen alertas CPU: {len(alerts)} alertas (pico: {peak}%)'
+    msg['From'] = EMAIL_FROM
+    msg['To'] = to_addr
+    msg.attach(MIMETextPart(text_body, 'plain', 'utf-8'))
+    msg.attach(MIMETextPart(html_body, 'html', 'utf-8'))
+    return msg
+
+
+# MailSender mantiene abierta una sesión SMTP autenticada y la reutiliza entre alertas. La sesión se cierra
+# tras SMTP_IDLE_TIMEOUT segundos sin uso y se reabre automáticamente si el servidor la ha cortado.
+class MailSender:
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, tls=SMTP_TLS, user=SMTP_USER, password=SMTP_PASSWORD,
+                 timeout=SMTP_TIMEOUT, idle_timeout=SMTP_IDLE_TIMEOUT): # Constructor de la clase MailSender
+        if tls not in ("ssl", "starttls", "none"):
+            raise ValueError(f"Modo TLS de SMTP desconocido: {tls}")
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.smtp = None # Sesión SMTP abierta (o None)
+        self.last_used = 0.0
+        self.lock = threading.Lock() # Los envíos llegan desde hilos del pool del bucle
+        self.stats = {"connects": 0, "reconnects": 0, "messages": 0}
+    
+    def connect(self): # Abrir y autenticar una sesión SMTP nueva
+        if self.tls == "ssl":
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.tls == "starttls":
+                smtp.starttls(context=ssl.create_default_context())
+        try:
+            if self.user:
+                smtp.login(self.user, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.stats["connects"] += 1
+    
+    def send(self, msg): # Enviar un mensaje reutilizando la sesión; si está caída se reconecta una vez
+        with self.lock:
+            if self.smtp is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self._close_locked() # El servidor probablemente ya la ha cerrado: mejor abrir una nueva
+            for attempt in (1, 2):
+                try:
+                    if self.smtp is None:
+                        self.connect()
+                    self.smtp.send_message(msg)
+                    break
+                except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+                    self._close_locked()
+                    if attempt == 2:
+                        raise
+                    self.stats["reconnects"] += 1
+            self.last_used = time.monotonic()
+            self.stats["messages"] += 1
+    
+    def close_if_idle(self): # Cerrar la sesión si lleva más de idle_timeout sin usarse
+        with self.lock:
+            if self.smtp is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                self._close_locked()
+    
+    def close(self): # Cerrar la sesión SMTP (al detener el agente)
+        with self.lock:
+            self._close_locked()
+    
+    def _close_locked(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception: # La conexión ya estaba rota: basta con liberar el socket
+            self.smtp.close()
+        self.smtp = None
+
+
+def send_email(mailer, to_addr, alerts): # Enviar un email de alerta (o un resumen si hay varias) cuando se supera el umbral de CPU
+    cpu_val = max(alert["cpu"] for alert in alerts)
+    debug = log.isEnabledFor(logging.DEBUG)
+    if debug:
+        log.debug(f"{'='*70}\n📧 ENVIANDO EMAIL [{get_timestamp()}]\n{'='*70}\n"
+                  f"   De: {EMAIL_FROM}\n   Para: {to_addr}\n   Asunto: ⚠️ Alerta CPU: {cpu_val}%"
+                  + (f" ({len(alerts)} alertas agrupadas)" if len(alerts) > 1 else ""))
+    
+    try:
+        if len(alerts) == 1:
+            msg = build_alert_message(to_addr, alerts[0]["cpu"], alerts[0]["threshold"])
+        else:
+            msg = build_digest_message(to_addr, alerts)
+        mailer.send(msg) # Sesión SMTP reutilizada
         
-        msg = MIMEMultipart('alternative') # Crear mensaje para rellenar
-        msg['Subject'] = f'⚠️ Alerta CPU: {cpu_val}% (Umbral: {threshold_val}%)'
-        msg['From'] = GMAIL_USER
-        msg['To'] = to_addr
-        
-        part1 = MIMETextPart(text_body, 'plain', 'utf-8')
-        msg.attach(part1)
-        
-        part2 = MIMETextPart(html_body, 'html', 'utf-8')
-        msg.attach(part2)
-        
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465, timeout=10) as smtp: # Enviar el email vía Gmail SMTP con la contraseña de aplicación
-            smtp.login(GMAIL_USER, GMAIL_PASSWORD)
-            smtp.send_message(msg)
-        
-        print(f"   ✅ Email enviado exitosamente vía Gmail")
-        print(f"   📨 Formato: HTML + texto plano")
+        if debug:
+            log.debug(f"   ✅ Email enviado exitosamente vía {mailer.host}\n   📨 Formato: HTML + texto plano\n{'='*70}\n")
+        else:
+            log.info("EMAIL alerta cpu=%s%% para=%s alertas=%d", cpu_val, to_addr, len(alerts),
+                     extra={"fields": {"event": "email", "to": to_addr, "cpu": cpu_val, "alerts": len(alerts), "result": "ok"}})
+        return True
     except Exception as e:
-        print(f"   ❌ Error al enviar email: {e}")
+        log.error("❌ Error al enviar email a %s: %s", to_addr, e, extra={"fields": {"event": "email", "to": to_addr, "result": "error"}})
+        return False
+
+
+# TokenBucket limita la tasa de un canal: cada notificación gasta un token y se reponen `rate` por segundo
+# hasta un máximo de `capacity`. Sin tokens la notificación se descarta y se cuenta como limitada.
+class TokenBucket:
+    def __init__(self, rate, capacity): # Constructor de la clase TokenBucket
+        self.rate = rate # Tokens por segundo
+        self.capacity = capacity
+        self.tokens = float(capacity) # Empieza lleno: se permite una ráfaga inicial
+        self.updated = time.monotonic()
     
-    print(f"{'='*70}\n")
+    def take(self, now=None): # Gastar un token si hay; devuelve si la notificación puede salir
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+# NotificationGovernor decide si un cruce del umbral genera una alerta. Tras una alerta queda desarmado hasta
+# que la CPU baja a cpuThreshold - NOTIFY_HYSTERESIS y han pasado NOTIFY_MIN_HOLD segundos; los cruces que
+# ocurren mientras tanto se cuentan como suprimidos en lugar de notificarse.
+class NotificationGovernor:
+    def __init__(self, hysteresis=NOTIFY_HYSTERESIS, min_hold=NOTIFY_MIN_HOLD): # Constructor de la clase NotificationGovernor
+        self.hysteresis = hysteresis
+        self.min_hold = min_hold
+        self.armed = True # Se puede generar una alerta en el próximo cruce
+        self.raised_at = None # time.monotonic() de la última alerta
+        self.last_over = False # Estado de la muestra anterior respecto al umbral
+        self.stats = {"raised": 0, "suppressed": 0} # Alertas generadas y cruces suprimidos
+    
+    def evaluate(self, cpu, threshold, now=None): # ¿Esta muestra debe generar una alerta?
+        now = time.monotonic() if now is None else now
+        over = cpu > threshold
+        crossing = over and not self.last_over # Solo los cruces de abajo a arriba pueden alertar
+        self.last_over = over
+        if not self.armed and cpu <= threshold - self.hysteresis and now - self.raised_at >= self.min_hold:
+            self.armed = True # La CPU ha bajado lo suficiente y durante suficiente tiempo: rearmar
+        if not crossing:
+            return False
+        if not self.armed:
+            self.stats["suppressed"] += 1
+            return False
+        self.armed = False
+        self.raised_at = now
+        self.stats["raised"] += 1
+        return True
+
+
+# NotificationPipeline desacopla el muestreo de la entrega: el muestreador deja eventos de alerta en una cola
+# acotada por canal y unos trabajadores asyncio entregan las traps y los emails (estos en un hilo aparte,
+# porque smtplib es bloqueante). Un servidor de correo lento ya no detiene el muestreo.
+class NotificationPipeline:
+    def __init__(self, snmpEngine, queue_size=NOTIFY_QUEUE_SIZE, policy=NOTIFY_DROP_POLICY,
+                 block_timeout=NOTIFY_BLOCK_TIMEOUT, email_workers=NOTIFY_EMAIL_WORKERS,
+                 mailer=None, digest_window=EMAIL_DIGEST_WINDOW, rate_per_minute=NOTIFY_RATE_PER_MINUTE,
+                 burst=NOTIFY_BURST, trap_sender=None): # Constructor de la clase NotificationPipeline
+        if policy not in ("drop-oldest", "drop-newest", "block"):
+            raise ValueError(f"Política de descarte desconocida: {policy}")
+        self.snmpEngine = snmpEngine
+        self.queue_size = queue_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.mailer = mailer or MailSender() # Sesión SMTP compartida por los trabajadores de email
+        self.trap_sender = trap_sender or TrapSender(snmpEngine) # Originador SNMP compartido y destinos de las notificaciones
+        self.digest_window = digest_window
+        self.workers = {"trap": 1, "email": email_workers} # Trabajadores por canal
+        self.queues = {} # Se crean en start(), dentro del bucle asyncio que las usará
+        self.tasks = []
+        self.buckets = {channel: TokenBucket(rate_per_minute / 60, burst) for channel in self.workers} # Límite de tasa por canal
+        self.stats = {channel: {"queued": 0, "sent": 0, "failed": 0, "dropped": 0, "throttled": 0,
+                                "latency_total": 0.0, "latency_max": 0.0}
+                      for channel in self.workers} # Contadores por canal
+    
+    def start(self): # Crear las colas y lanzar los trabajadores en el bucle actual
+        for channel, count in self.workers.items():
+            self.queues[channel] = asyncio.Queue(maxsize=self.queue_size)
+            for _ in range(count):
+                self.tasks.append(asyncio.ensure_future(self.worker(channel)))
+        self.tasks.append(asyncio.ensure_future(self.mail_keeper()))
+    
+    async def stop(self): # Detener los trabajadores (las alertas aún en cola se descartan) y cerrar la sesión SMTP
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await asyncio.get_event_loop().run_in_executor(None, self.mailer.close)
+    
+    async def mail_keeper(self): # Cerrar periódicamente la sesión SMTP si lleva demasiado tiempo sin usarse
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(max(1.0, self.mailer.idle_timeout / 2))
+            await loop.run_in_executor(None, self.mailer.close_if_idle)
+    
+    async def publish(self, event): # Encolar un evento de alerta en cada canal aplicando la política de descarte
+        event["created"] = time.perf_counter()
+        for channel, q in self.queues.items():
+            stats = self.stats[channel]
+            if not self.buckets[channel].take(): # Canal sin tokens: se limita en lugar de encolar
+                stats["throttled"] += 1
+                continue
+            if q.full():
+                if self.policy == "drop-newest": # Se pierde la alerta nueva
+                    stats["dropped"] += 1
+                    continue
+                if self.policy == "drop-oldest": # Se pierde la alerta más antigua pendiente
+                    q.get_nowait()
+                    q.task_done()
+                    stats["dropped"] += 1
+                else: # "block": el muestreador espera como mucho block_timeout
+                    try:
+                        await asyncio.wait_for(q.put(event), self.block_timeout)
+                        stats["queued"] += 1
+                    except asyncio.TimeoutError:
+                        stats["dropped"] += 1
+                    continue
+            q.put_nowait(event)
+            stats["queued"] += 1
+    
+    async def worker(self, channel): # Trabajador de un canal: saca eventos de su cola y los entrega
+        q = self.queues[channel]
+        stats = self.stats[channel]
+        delivery_latency = METRICS.histogram("snmp_agent_notification_delivery_seconds", "Tiempo desde que se publica una alerta hasta que termina su entrega",
+                                             ("channel",), METRICS_SLOW_BUCKETS).labels(channel)
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await q.get()]
+            if channel == "email" and self.digest_window > 0: # Modo resumen: agrupar lo que llegue durante la ventana
+                deadline = loop.time() + self.digest_window
+                while True:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(q.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            try:
+                results = await self.deliver(channel, batch)
+            except Exception as e:
+                log.error("❌ Error entregando notificación por %s: %s", channel, e)
+                results = [(event, False) for event in batch]
+            finally:
+                for _ in batch:
+                    q.task_done()
+            now = time.perf_counter()
+            for event, ok in results:
+                latency = now - event["created"] # Espera en cola + entrega
+                stats["sent" if ok else "failed"] += 1
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+                delivery_latency.observe(latency)
+    
+    async def deliver(self, channel, batch): # Entregar un lote de eventos; devuelve [(evento, ok)]
+        if channel == "trap":
+            return [(event, await self.trap_sender.send(event)) for event in batch]
+        by_recipient = {} # Un único email por destinatario con todas sus alertas
+        for event in batch:
+            by_recipient.setdefault(event["email"], []).append(event)
+        loop = asyncio.get_event_loop()
+        results = []
+        for to_addr, alerts in by_recipient.items(): # smtplib es bloqueante: se ejecuta en el pool de hilos del bucle
+            ok = await loop.run_in_executor(None, send_email, self.mailer, to_addr, alerts)
+            results.extend((event, ok) for event in alerts)
+        return results
 
 
-async def cpu_sampler(store, snmpEngine, stop_event): # Hilo para muestrear el uso de CPU y enviar alertas
-    psutil.cpu_percent(interval=None) # Obtenemos un valor inicial usando a psutil
-    last_over = False
+def register_notify_stats(store, governor, pipeline): # Publicar los contadores de notificaciones en myAgentNotifyStats (calculados al leerlos)
+    base = parse_oid(store.model["baseoid"]) + (16,) # myAgentNotifyStats(16)
+    store.add_provider(LazyScalars({
+        base + (1, 0): ("Counter32", lambda: governor.stats["raised"]), # notifyAlertsRaised
+        base + (2, 0): ("Counter32", lambda: governor.stats["suppressed"]), # notifySuppressedHysteresis
+        base + (3, 0): ("Counter32", lambda: pipeline.stats["trap"]["throttled"]), # notifyThrottledTraps
+        base + (4, 0): ("Counter32", lambda: pipeline.stats["email"]["throttled"]), # notifyThrottledEmails
+        base + (5, 0): ("Counter32", lambda: pipeline.stats["trap"]["dropped"]), # notifyDroppedTraps
+        base + (6, 0): ("Counter32", lambda: pipeline.stats["email"]["dropped"]), # notifyDroppedEmails
+    }))
+    sender = pipeline.trap_sender
+    
+    def target_rows(): # Filas de notifyTargetTable: (índice, (destino, contadores)) en el orden de NOTIFY_TARGETS
+        return [(row_index, (target, sender.stats[target["name"]])) for row_index, target in enumerate(sender.targets, start=1)]
+    
+    def latency_avg(row): # Latencia media de entrega en milisegundos
+        stats = row[1]
+        return round(stats["latency_total"] / stats["sent"] * 1000) if stats["sent"] else 0
+    
+    store.add_provider(LazyTable(base + (7,), { # notifyTargetTable
+        2: ("DisplayString", lambda row: row[0]["name"]), # notifyTargetName
+        3: ("DisplayString", lambda row: row[0]["type"]), # notifyTargetType
+        4: ("Counter32", lambda row: row[1]["sent"]), # notifyTargetDelivered
+        5: ("Counter32", lambda row: row[1]["failed"]), # notifyTargetFailed
+        6: ("Counter32", lambda row: row[1]["retries"]), # notifyTargetRetries
+        7: ("Gauge32", latency_avg), # notifyTargetLatencyAvg
+        8: ("Gauge32", lambda row: round(row[1]["latency_max"] * 1000)), # notifyTargetLatencyMax
+    }, target_rows))
+
+
+AGENT_PDU_TYPES = ("get", "getnext", "getbulk", "set") # Filas de agentPduTable, en este orden
+
+
+def register_agent_stats(store, pipeline, cpu_cache): # Publicar las estadísticas del propio agente en myAgentStats (calculadas al leerlas)
+    base = parse_oid(store.model["baseoid"]) + (18,) # myAgentStats(18)
+    
+    def pdu_rows(): # Filas de agentPduTable: (índice, (tipo, respuestas, errores, latencia media en µs)), sumando todos los procesos
+        requests = METRICS.totals("snmp_agent_requests")
+        latency = METRICS.totals("snmp_agent_handler_seconds")
+        errors = {}
+        for (pdu, _), count in METRICS.totals("snmp_agent_request_errors").items():
+            errors[pdu] = errors.get(pdu, 0) + count
+        rows = []
+        for row_index, pdu in enumerate(AGENT_PDU_TYPES, start=1):
+            counts, total = latency.get((pdu,), ((), 0.0))
+            observed = sum(counts)
+            rows.append((row_index, (pdu, requests.get((pdu,), 0), errors.get(pdu, 0), round(total / observed * 1e6) if observed else 0)))
+        return rows
+    
+    def last_sample_time(): # sysUpTime (centésimas de segundo desde el arranque) del momento de la última muestra de CPU
+        if cpu_cache.sampled_at is None:
+            return 0
+        return max(0, int((time.time() - AGENT_START - (time.monotonic() - cpu_cache.sampled_at)) * 100))
+    
+    store.add_provider(LazyTable(base + (1,), { # agentPduTable
+        2: ("DisplayString", lambda row: row[0]), # agentPduType
+        3: ("Counter32", lambda row: row[1]), # agentPduRequests
+        4: ("Counter32", lambda row: row[2]), # agentPduErrors
+        5: ("Gauge32", lambda row: row[3]), # agentPduLatencyAvg
+    }, pdu_rows))
+    store.add_provider(LazyScalars({
+        base + (2, 0): ("Counter32", lambda: sum(METRICS.totals("snmp_agent_set_auth_failures").values())), # agentSetAuthFailures
+        base + (3, 0): ("Counter32", lambda: pipeline.stats["trap"]["sent"]), # agentTrapsSent
+        base + (4, 0): ("Counter32", lambda: pipeline.stats["trap"]["failed"]), # agentTrapsFailed
+        base + (5, 0): ("Counter32", lambda: pipeline.stats["email"]["sent"]), # agentEmailsSent
+        base + (6, 0): ("Counter32", lambda: pipeline.stats["email"]["failed"]), # agentEmailsFailed
+        base + (7, 0): ("TimeTicks", last_sample_time), # agentLastSampleTime
+    }))
+
+
+def make_alert_event(store, cpu, threshold): # Evento de alerta con los valores del momento del muestreo
+    return {"cpu": cpu, "threshold": threshold, "email": store.pin().model["scalars"]["managerEmail"]["value"],
+            "timestamp": time.time()}
+
+
+# CpuSampleCache guarda la última muestra de CPU (total y por núcleo) con su hora. Los GET la refrescan si es más
+# vieja que el TTL (read-through) y las peticiones simultáneas se agrupan en un único refresco; el muestreador de
+# fondo reutiliza esas muestras y solo mide por su cuenta cuando nadie lo ha hecho recientemente.
+class CpuSampleCache:
+    def __init__(self, store, ttl=CPU_CACHE_TTL): # Constructor de la clase CpuSampleCache
+        self.store = store
+        self.ttl = ttl # Edad máxima de la muestra servida en un GET
+        self.lock = threading.Lock() # Un único refresco a la vez; quien espera reutiliza la muestra recién tomada
+        self.sampled_at = None # time.monotonic() de la última muestra
+        self.cpu = 0 # Uso total de la última muestra
+        self.cores = [] # Uso por núcleo de la última muestra
+        self.updated = threading.Event() # Avisa al muestreador de una muestra bajo demanda (cpu_sampler lo sustituye por un asyncio.Event)
+        self.stats = {"samples": 0, "on_demand": 0, "hits": 0} # Muestras tomadas, de ellas bajo demanda, y lecturas servidas sin muestrear
+        psutil.cpu_percent(interval=None, percpu=True) # Obtenemos un valor inicial por núcleo usando a psutil
+    
+    def is_fresh(self, max_age): # ¿La última muestra tiene menos de max_age segundos?
+        return self.sampled_at is not None and time.monotonic() - self.sampled_at < max_age
+    
+    def sample(self): # Tomar una muestra por núcleo y publicar cpuUsage y cpuCoreTable en una sola versión
+        per_core = psutil.cpu_percent(interval=None, percpu=True)
+        cores = [max(0, min(100, round(value))) for value in per_core] # Uso de cada núcleo entre 0 y 100%
+        cpu = max(0, min(100, round(sum(per_core) / len(per_core)))) if per_core else 0 # El total es la media de la misma muestra
+        self.store.replace_rows("cpuCoreTable", {core: {"cpuCoreUsage": value} for core, value in enumerate(cores, start=1)},
+                                {"cpuUsage": cpu}, persist=False)
+        self.cpu, self.cores = cpu, cores
+        self.sampled_at = time.monotonic()
+        self.stats["samples"] += 1
+    
+    def refresh(self): # Refresco bajo demanda desde los manejadores GET/GETNEXT/GETBULK
+        if self.is_fresh(self.ttl):
+            self.stats["hits"] += 1
+            return False
+        with self.lock:
+            if self.is_fresh(self.ttl): # Otra petición acaba de refrescar mientras esperábamos: reutilizar su muestra
+                self.stats["hits"] += 1
+                return False
+            self.sample()
+            self.stats["on_demand"] += 1
+        self.updated.set() # El muestreador comprobará el umbral con esta muestra
+        return True
+    
+    def refresh_background(self): # Muestra del muestreador de fondo, salvo que haya una bajo demanda aún válida
+        with self.lock:
+            if not self.is_fresh(self.ttl):
+                self.sample()
+
+
+# HistoryWindow mantiene los agregados de una ventana deslizante de forma incremental: suma, número de muestras
+# y un histograma de 101 casillas (0..100 %). Añadir o expulsar una muestra es O(1) y la media, el máximo y el
+# percentil 95 se calculan sobre el histograma (101 casillas como mucho), nunca recorriendo el búfer.
+class HistoryWindow:
+    def __init__(self, seconds): # Constructor de la clase HistoryWindow
+        self.seconds = seconds # Duración de la ventana
+        self.start = 0 # Secuencia de la muestra más antigua dentro de la ventana
+        self.count = 0
+        self.total = 0
+        self.histogram = array('I', bytes(4 * 101)) # Muestras por cada valor de 0 a 100
+    
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.histogram[value] += 1
+    
+    def evict(self, value):
+        self.start += 1
+        self.count -= 1
+        self.total -= value
+        self.histogram[value] -= 1
+    
+    def mean(self): # Media en centésimas de punto porcentual
+        return round(self.total * 100 / self.count) if self.count else 0
+    
+    def maximum(self):
+        for value in range(100, -1, -1):
+            if self.histogram[value]:
+                return value
+        return 0
+    
+    def percentile(self, pct): # Percentil por rango más cercano
+        if not self.count:
+            return 0
+        rank = math.ceil(pct / 100 * self.count)
+        seen = 0
+        for value in range(101):
+            seen += self.histogram[value]
+            if seen >= rank:
+                return value
+        return 100
+
+
+# CpuHistory guarda las últimas HISTORY_SIZE muestras de CPU en un búfer circular de arrays tipados
+# (1 byte por valor y 8 por instante), así que su memoria es fija: HISTORY_SIZE * 9 bytes más los histogramas.
+# Cada muestra tiene un número de secuencia creciente que sirve de índice en cpuHistoryTable. La alimenta
+# history_sampler cada HISTORY_INTERVAL s, así que contar muestras en una ventana equivale a ponderar por tiempo.
+class CpuHistory:
+    def __init__(self, capacity=HISTORY_SIZE, windows=HISTORY_WINDOWS): # Constructor de la clase CpuHistory
+        self.capacity = capacity
+        self.values = array('B', bytes(capacity)) # Uso de CPU (0..100)
+        self.times = array('d', bytes(8 * capacity)) # time.monotonic() de cada muestra
+        self.count = 0 # Muestras añadidas desde el arranque (la siguiente secuencia)
+        self.started = time.monotonic() # Origen de cpuHistoryTime
+        self.windows = {minutes: HistoryWindow(minutes * 60) for minutes in windows}
+    
+    @property
+    def nbytes(self): # Memoria ocupada por el búfer y los histogramas
+        return (self.values.itemsize + self.times.itemsize) * self.capacity + \
+            sum(w.histogram.itemsize * len(w.histogram) for w in self.windows.values())
+    
+    def first(self): # Secuencia de la muestra más antigua que sigue en el búfer
+        return max(0, self.count - self.capacity)
+    
+    def append(self, value, now=None): # Añadir una muestra y actualizar los agregados de cada ventana
+        now = time.monotonic() if now is None else now
+        oldest = self.first()
+        for window in self.windows.values():
+            if self.count - window.start >= self.capacity: # La muestra que se va a sobrescribir sale también de la ventana
+                window.evict(self.values[oldest % self.capacity])
+        slot = self.count % self.capacity
+        self.values[slot] = value
+        self.times[slot] = now
+        self.count += 1
+        for window in self.windows.values():
+            window.add(value)
+            limit = now - window.seconds
+            while window.count and self.times[window.start % self.capacity] < limit: # Expulsar lo que ya no cabe en la ventana
+                window.evict(self.values[window.start % self.capacity])
+    
+    def sample(self, sequence): # (uso, centésimas de segundo desde el arranque) de una muestra o None si ya no está
+        if not self.first() <= sequence < self.count:
+            return None
+        slot = sequence % self.capacity
+        return self.values[slot], int((self.times[slot] - self.started) * 100)
+
+
+# CpuHistoryTable sirve cpuHistoryTable directamente desde el búfer circular: índice = secuencia + 1,
+# columnas cpuHistoryUsage(2) y cpuHistoryTime(3). No ocupa nada en el modelo ni en el JSON.
+class CpuHistoryTable:
+    COLUMNS = {2: "Integer32", 3: "TimeTicks"}
+    
+    def __init__(self, prefix, history): # Constructor de la clase CpuHistoryTable
+        self.prefix = tuple(prefix)
+        self.entry = self.prefix + (1,)
+        self.history = history
+    
+    def cell(self, column, row_index): # Valor pysnmp de una celda o None
+        item = self.history.sample(row_index - 1)
+        if item is None:
+            return None
+        return SNMP_TYPES[self.COLUMNS[column]](item[0] if column == 2 else item[1])
+    
+    def get(self, oid):
+        if len(oid) != len(self.entry) + 2 or oid[:len(self.entry)] != self.entry or oid[-2] not in self.COLUMNS:
+            return None
+        return self.cell(oid[-2], oid[-1])
+    
+    def iter_from(self, oid):
+        first, last = self.history.first() + 1, self.history.count # Índices de fila válidos
+        for column in sorted(self.COLUMNS):
+            base = self.entry + (column,)
+            start = column_start(base, oid, first)
+            if start is None:
+                continue
+            for row_index in range(start, last + 1):
+                value = self.cell(column, row_index)
+                if value is not None:
+                    yield base + (row_index,), value
+
+
+def register_cpu_history(store, history): # Publicar cpu{1,5,15}Min{Mean,Max,P95} y cpuHistoryTable (calculados al leerlos)
+    base = parse_oid(store.model["baseoid"])
+    scalars = {}
+    subid = 6
+    for minutes, window in sorted(history.windows.items()):
+        for getter in (window.mean, window.maximum, lambda w=window: w.percentile(95)):
+            scalars[base + (subid, 0)] = ("Integer32", getter)
+            subid += 1
+    store.add_provider(LazyScalars(scalars)) # cpu1MinMean(6) ... cpu15MinP95(14)
+    table = CpuHistoryTable(base + (15,), history) # cpuHistoryTable(15)
+    store.add_provider(table)
+
+
+def cpu_busy_percent(before, after): # Uso total de CPU (0..100) entre dos lecturas de psutil.cpu_times(), como psutil.cpu_percent
+    total = sum(after) - sum(before)
+    total -= sum(getattr(after, field, 0) - getattr(before, field, 0) for field in ("guest", "guest_nice")) # Ya van incluidos en user y nice
+    idle = sum(getattr(after, field, 0) - getattr(before, field, 0) for field in ("idle", "iowait"))
+    if total <= 0:
+        return 0
+    return max(0, min(100, round((total - idle) * 100 / total)))
+
+
+async def history_sampler(history, on_append=None, interval=HISTORY_INTERVAL): # Tarea que añade al histórico una muestra cada interval s (se detiene al cancelarla)
+    # Mide por su cuenta con psutil.cpu_times(): cada muestra cubre exactamente el intervalo anterior, así que las
+    # ventanas pesan igual cada segundo, sin importar cuándo mire el muestreador del umbral o sondee un gestor
+    loop = asyncio.get_running_loop()
+    before = psutil.cpu_times()
+    due = loop.time()
+    while True:
+        due += interval
+        await asyncio.sleep(max(0.0, due - loop.time()))
+        if loop.time() - due > interval: # Bucle bloqueado más de un turno: seguir desde ahora sin ráfagas para recuperar
+            due = loop.time()
+        after = psutil.cpu_times()
+        history.append(cpu_busy_percent(before, after))
+        before = after
+        if on_append is not None: # Modo multiproceso: los trabajadores reciben los agregados nuevos
+            on_append()
+
+
+async def cpu_sampler(store, cpu_cache, pipeline, governor): # Tarea que comprueba el umbral de CPU y publica alertas (se detiene al cancelarla)
     show_output = False
     
     print(f"\n{'='*70}")
     print(f"🖥️  MONITOR DE CPU INICIADO [{get_timestamp()}]")
     print(f"{'='*70}")
     print(f"   Pulsa 'r' para mostrar/ocultar salida por pantalla")
-    print(f"   Intervalo de muestreo: 5 segundos (siempre activo)")
+    print(f"   Intervalo de muestreo: {CPU_SAMPLE_INTERVAL} s cerca del umbral, {CPU_IDLE_SAMPLE_INTERVAL} s lejos de él")
+    print(f"   Refresco bajo demanda: {f'muestras de más de {CPU_CACHE_TTL} s' if CPU_CACHE_TTL else 'desactivado'}")
+    print(f"   Histórico: una muestra cada {HISTORY_INTERVAL:g} s ({HISTORY_SIZE} muestras)")
     print(f"   Archivo de estado: {JSON_FILE}")
     print(f"{'='*70}\n")
     
@@ -586,72 +2626,677 @@ async def cpu_sampler(store, snmpEngine, stop_event): # Hilo para muestrear el u
         estado = "VISIBLE" if show_output else "OCULTA"
         print(f"\n[{get_timestamp()}] Salida por pantalla: {estado}\n")
     
-    keyboard.add_hotkey('r', toggle_output) # Registrar la tecla 'r' para alternar la salida
+    try:
+        keyboard.add_hotkey('r', toggle_output) # Registrar la tecla 'r' para alternar la salida
+    except Exception as e: # Sin teclado accesible (servicio, contenedor, sin permisos): el agente sigue sin la tecla
+        log.warning("⚠️  Tecla 'r' no disponible: %s", str(e) or type(e).__name__)
     
+    cpu_cache.updated = asyncio.Event() # Los GET que refrescan la muestra despiertan a esta tarea
+    drift = METRICS.histogram("snmp_agent_sampler_drift_seconds", "Retraso con el que el muestreador de CPU se despierta respecto a su turno",
+                              buckets=METRICS_SLOW_BUCKETS).labels()
+    loop = asyncio.get_event_loop()
+    delay = CPU_SAMPLE_INTERVAL
     try:
-        while not stop_event.is_set(): # Bucle principal del muestreador de CPU
-            await asyncio.sleep(5)  # Usamos asyncio para dormir sin bloquear
-            # Siempre muestrea y actualiza
-            cpu = max(0, min(100, round(psutil.cpu_percent(interval=None)))) # Obtener uso de CPU entre 0 y 100%
-            store.set_cpu_usage_internal(cpu)
+        while True: # Bucle principal del muestreador de CPU
+            due = loop.time() + delay
+            try: # Esperar al siguiente turno o a una muestra bajo demanda, lo que llegue antes
+                await asyncio.wait_for(cpu_cache.updated.wait(), delay)
+            except asyncio.TimeoutError:
+                drift.observe(max(0.0, loop.time() - due)) # Solo los turnos programados: con el bucle ocupado se retrasan
+            cpu_cache.updated.clear()
+            cpu_cache.refresh_background() # Solo mide si nadie lo ha hecho en los últimos CPU_CACHE_TTL segundos
+            cpu, cores = cpu_cache.cpu, cpu_cache.cores
             threshold = store.model["scalars"]["cpuThreshold"]["value"]
             over = cpu > threshold # Verificar si se supera el umbral
+            # Cerca o por encima del umbral se comprueba a menudo; lejos de él basta con mirar de vez en cuando
+            delay = CPU_SAMPLE_INTERVAL if cpu >= threshold - CPU_NEAR_MARGIN else CPU_IDLE_SAMPLE_INTERVAL
             
             # Solo muestra si show_output está activo (alternado con 'r')
             if show_output:
                 status_icon = '⚠️ SUPERADO' if over else '✅ OK'
-                print(f"[{get_timestamp()}] 🖥️  CPU: {cpu}% | Umbral: {threshold}% | {status_icon}")
+                busiest = max(range(len(cores)), key=cores.__getitem__) if cores else -1
+                busiest_text = f" | Núcleo más cargado: {busiest + 1} ({cores[busiest]}%)" if cores else ""
+                print(f"[{get_timestamp()}] 🖥️  CPU: {cpu}%{busiest_text} | Umbral: {threshold}% | {status_icon}")
             
-            if over and not last_over: # Solo se envia alerta solo cuando se supera el umbral no cada vez que detecta que está por encima
+            suppressed = governor.stats["suppressed"]
+            if governor.evaluate(cpu, threshold): # Solo alerta en un cruce con el gobernador armado (histéresis y tiempo mínimo)
                 if show_output:
                     print(f"\n⚠️⚠️⚠️  ALERTA: Umbral de CPU superado! ⚠️⚠️⚠️\n")
-                send_trap(snmpEngine, store)
-            
-            last_over = over # Actualizar estado de sobrepaso
+                await pipeline.publish(make_alert_event(store, cpu, threshold)) # La entrega la hacen los trabajadores
+            elif show_output and governor.stats["suppressed"] != suppressed:
+                print(f"   🔕 Cruce del umbral suprimido (alerta sin rearmar: hace falta bajar a {threshold - governor.hysteresis}%)")
     finally:
-        keyboard.unhook_all() # Limpiar hotkeys al detener el hilo
+        try:
+            keyboard.unhook_all() # Limpiar hotkeys al detener el muestreador
+        except Exception:
+            pass
 
 
+async def wal_syncer(wal): # Tarea que hace fsync del WAL cada WAL_FSYNC_INTERVAL (política "interval")
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(WAL_FSYNC_INTERVAL)
+        try:
+            await loop.run_in_executor(None, wal.sync)
+        except OSError as e:
+            log.error("⚠️  Error sincronizando %s: %s", wal.filepath, e)
 
-def main(): # Función principal para iniciar el agente SNMP
-    store = JsonStore(JSON_FILE) # Crear instancia de JsonStore
-    snmpEngine = engine.SnmpEngine() # Crear motor SNMP
-    snmpContext = context.SnmpContext(snmpEngine) # Crear contexto SNMP
+
+async def persistence_flusher(store): # Tarea que escribe el estado en disco cada FLUSH_INTERVAL o al acumular FLUSH_MAX_DIRTY cambios (o WAL_COMPACT_BYTES de WAL)
+    store.flush_wakeup = asyncio.Event() # mark_dirty() despierta a esta tarea al superar FLUSH_MAX_DIRTY
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            await asyncio.wait_for(store.flush_wakeup.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        store.flush_wakeup.clear()
+        try: # La escritura y el fsync se hacen en un hilo del pool para no bloquear el bucle
+            await loop.run_in_executor(None, store.flush)
+        except Exception as e: # Un fallo de disco no debe tumbar el agente; se reintenta en el siguiente ciclo
+            log.error("⚠️  Error guardando %s: %s", JSON_FILE, e)
+
+
+METRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+async def serve_metrics(reader, writer): # Atender una conexión HTTP: GET /metrics devuelve METRICS.render() y se cierra
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        method, path = request.split(b" ", 2)[:2]
+        if method == b"GET" and path.split(b"?")[0] in (b"/", b"/metrics"):
+            status, content_type, body = "200 OK", METRICS_CONTENT_TYPE, METRICS.render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("ascii") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass # Petición incompleta o cliente desconectado: no hay nada que responder
+    finally:
+        writer.close()
+
+
+def dump_metrics(filepath): # Escribir las métricas en filepath de forma atómica (mismo formato que /metrics)
+    return write_atomic(filepath, METRICS.render().encode("utf-8"))
+
+
+async def metrics_dumper(filepath): # Tarea que vuelca las métricas cada METRICS_DUMP_INTERVAL
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+        try:
+            await loop.run_in_executor(None, dump_metrics, filepath)
+        except OSError as e:
+            log.error("⚠️  Error escribiendo %s: %s", filepath, e)
+
+
+# StackSampler es el perfilador estadístico: un hilo que cada intervalo apunta la pila de los demás hilos.
+# No instrumenta ninguna llamada, así que el coste es el mismo haga lo que haga el agente.
+class StackSampler(threading.Thread):
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL, loop_ident=None): # Constructor de la clase StackSampler
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.loop_ident = loop_ident or threading.get_ident() # Hilo del bucle asyncio (el que se resume en el informe)
+        self.stop_event = threading.Event()
+        self.stacks = {} # (nombre del hilo, es el del bucle, marcos de la raíz a la hoja) -> muestras
+        self.labels = {} # Objeto de código -> "función (fichero:línea)"
+        self.samples = 0
+    
+    def label(self, code): # Nombre de un marco; se construye una vez por función
+        text = self.labels.get(code)
+        if text is None:
+            text = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return text
     
-    # Configurar referencia al snmpEngine en el store para VACM
-    store.snmpEngine = snmpEngine
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                key = (names.get(ident, str(ident)), ident == self.loop_ident, tuple(reversed(stack)))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+    
+    def folded(self): # Pilas en formato "plegado" (una línea "hilo;raíz;...;hoja muestras"), el que leen flamegraph.pl y speedscope
+        return "".join(f"{';'.join((thread,) + stack)} {count}\n" for (thread, _, stack), count in sorted(self.stacks.items()))
+    
+    def summary(self, elapsed, top=30): # Funciones del hilo del bucle con más muestras propias y acumuladas
+        own, total, samples = {}, {}, 0
+        for (_, is_loop, stack), count in self.stacks.items():
+            if not is_loop or not stack:
+                continue
+            samples += count
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for frame in set(stack):
+                total[frame] = total.get(frame, 0) + count
+        lines = [f"Perfil por muestreo de pilas: {elapsed:.1f} s, {self.samples} muestras cada {self.interval*1000:.1f} ms",
+                 "Hilo del bucle asyncio (despachador SNMP, muestreador de CPU, notificaciones y persistencia)", ""]
+        for title, counts in (("Más tiempo propio", own), ("Más tiempo acumulado (incluye lo que llaman)", total)):
+            lines += [title, f"  {'Propio':>7} {'Total':>7}  Función"]
+            for frame, _ in sorted(counts.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"  {own.get(frame, 0) / max(samples, 1):7.1%} {total[frame] / max(samples, 1):7.1%}  {frame}")
+            lines.append("")
+        return "\n".join(lines)
+
+
+# Profiler ejecuta como mucho un perfil a la vez sobre el hilo del bucle asyncio. start() y stop() se llaman
+# desde el propio bucle (manejador de señal, SET, temporizador); los ficheros se escriben en un hilo del pool.
+class Profiler:
+    def __init__(self, directory=PROFILE_DIR, mode=PROFILE_MODE, memory=PROFILE_TRACEMALLOC): # Constructor de la clase Profiler
+        if mode not in ("sample", "cprofile"):
+            raise ValueError(f"Modo de perfilado desconocido: {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.memory = memory
+        self.running = None # Estado del perfil en curso (None = inactivo)
+        self.writing = None # Futuro de la escritura de los últimos resultados
+        self.stats = {"runs": 0, "last": ""} # Perfiles terminados y resumen del último
+        self.on_change = None # Se llama (desde cualquier hilo) al cambiar profileSeconds o los resultados: el principal los difunde
+    
+    def remaining(self): # Segundos que le quedan al perfil en curso (0 si no hay)
+        return max(0, math.ceil(self.running["deadline"] - time.monotonic())) if self.running else 0
+    
+    def start(self, seconds): # Empezar un perfil de seconds segundos; False si ya hay uno en curso
+        if self.running is not None:
+            log.warning("🔬 Ya hay un perfil en curso (quedan %d s)", self.remaining())
+            return False
+        run = {"stamp": time.strftime("%Y%m%d-%H%M%S"), "started": time.monotonic(), "deadline": time.monotonic() + seconds}
+        if self.memory:
+            run["own_tracemalloc"] = not tracemalloc.is_tracing() # Si ya estaba activo (PYTHONTRACEMALLOC) no se para al acabar
+            if run["own_tracemalloc"]:
+                tracemalloc.start()
+            run["memory_before"] = tracemalloc.take_snapshot()
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e: # Ya hay otro perfilador activo en el proceso
+                log.error("⚠️  No se puede iniciar cProfile: %s", e)
+                if run.get("own_tracemalloc"):
+                    tracemalloc.stop()
+                return False
+        else:
+            profiler = StackSampler(PROFILE_SAMPLE_INTERVAL, threading.get_ident())
+            profiler.start()
+        run["profiler"] = profiler
+        run["timer"] = asyncio.get_running_loop().call_later(seconds, self.stop)
+        self.running = run
+        log.warning("🔬 Perfil %s de %d s iniciado%s", self.mode, seconds, " con tracemalloc" if self.memory else "")
+        if self.on_change:
+            self.on_change()
+        return True
+    
+    def stop(self): # Terminar el perfil en curso (al vencer su plazo, al escribir 0 o al apagar) y guardar sus resultados
+        run, self.running = self.running, None
+        if run is None:
+            return
+        run["timer"].cancel()
+        profiler = run["profiler"]
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        else:
+            profiler.stop_event.set()
+            profiler.join()
+        if self.memory:
+            run["memory_after"] = tracemalloc.take_snapshot()
+            if run["own_tracemalloc"]:
+                tracemalloc.stop()
+        run["elapsed"] = time.monotonic() - run["started"]
+        self.stats["runs"] += 1
+        self.writing = asyncio.get_running_loop().run_in_executor(None, self.write, run)
+    
+    def write(self, run): # Escribir los ficheros de un perfil terminado (en un hilo del pool)
+        base = os.path.join(self.directory, f"profile-{run['stamp']}-{self.mode}")
+        profiler = run["profiler"]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if isinstance(profiler, cProfile.Profile):
+                profiler.dump_stats(base + ".pstats") # Para abrirlo con pstats, snakeviz...
+                report = io.StringIO()
+                report.write(f"cProfile: {run['elapsed']:.1f} s del hilo del bucle asyncio\n")
+                pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(40)
+                summary = report.getvalue()
+            else:
+                with open(base + ".folded", "w", encoding="utf-8") as f:
+                    f.write(profiler.folded())
+                summary = profiler.summary(run["elapsed"])
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(summary)
+            if self.memory: # Líneas que más memoria han reservado (y no liberado) durante el perfil
+                ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+                diff = run["memory_after"].filter_traces(ignore).compare_to(run["memory_before"].filter_traces(ignore), "lineno")
+                with open(base + "-memory.txt", "w", encoding="utf-8") as f:
+                    f.write(f"tracemalloc: diferencia en {run['elapsed']:.1f} s\n\n")
+                    f.writelines(f"{stat}\n" for stat in diff[:40])
+        except OSError as e:
+            log.error("⚠️  Error escribiendo el perfil %s: %s", base, e)
+            return
+        self.stats["last"] = base + ".txt"
+        log.warning("🔬 Perfil terminado: %s", self.stats["last"])
+        if self.on_change:
+            self.on_change()
+
+
+def register_profile_control(store, profiler=None): # myAgentProfile: profileSeconds (lanza o corta un perfil) y resultados
+    base = parse_oid(store.model["baseoid"]) + (17,) # myAgentProfile(17)
+    
+    def check(snmp_val, principal): # Validar un SET de profileSeconds
+        if PROFILE_V3_ONLY and principal[0] != 3: # Las comunidades viajan en claro: solo usuarios SNMPv3
+            return 16 # authorizationError
+        if not isinstance(snmp_val, v2c.Integer):
+            return 7 # wrongType
+        if not 0 <= int(snmp_val) <= PROFILE_MAX_SECONDS:
+            return 10 # wrongValue
+        if int(snmp_val) and profiler is not None and profiler.running is not None:
+            return 12 # inconsistentValue: ya hay un perfil en curso
+        return 0
+    
+    def apply(seconds): # 0 corta el perfil en curso; N lo lanza durante N segundos
+        previous = profiler.remaining()
+        if not seconds:
+            profiler.stop()
+        elif profiler.running is None: # Un SET reenviado por un trabajador no se ha podido comprobar aquí
+            profiler.start(seconds)
+        return previous, seconds
+    
+    store.add_control(base + (1, 0), check, apply if profiler is not None else None)
+    if profiler is not None: # En los trabajadores los valores llegan con la difusión del principal
+        store.add_provider(LazyScalars({
+            base + (1, 0): ("Integer32", profiler.remaining), # profileSeconds
+            base + (2, 0): ("Counter32", lambda: profiler.stats["runs"]), # profileRuns
+            base + (3, 0): ("DisplayString", lambda: profiler.stats["last"]), # profileLastResult
+        }))
+
+
+def open_udp_socket(port, reuse_port=False): # Socket UDP del agente en todas las interfaces (reuse_port: compartido entre procesos)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port: # Cada proceso abre su propio socket en el mismo puerto y el núcleo reparte los datagramas
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.setblocking(False)
+    return sock
+
+
+def add_stop_handlers(stop_event, signals=("SIGINT", "SIGTERM")): # Activar stop_event con Ctrl+C o SIGTERM
+    loop = asyncio.get_running_loop()
+    for sig in (getattr(signal, name, None) for name in signals):
+        if sig is None:
+            continue
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError): # Windows: Ctrl+C llega como KeyboardInterrupt y cancela la corrutina
+            pass
+
+
+def export_values(providers): # Valores de los subárboles calculados como [(oid, clase pysnmp, valor Python)] para otro proceso
+    items = []
+    for provider in providers:
+        for oid, val in provider.iter_from(()):
+            items.append((oid, type(val), bytes(val) if isinstance(val, v2c.OctetString) else int(val)))
+    return items
+
+
+# ReplicaValues sirve en un proceso trabajador los valores calculados que le envía el proceso principal
+# (histórico de CPU, estadísticas de notificaciones). Guarda el valor Python y construye el objeto pysnmp al leerlo.
+class ReplicaValues:
+    def __init__(self): # Constructor de la clase ReplicaValues
+        self.values = {} # oid -> (clase pysnmp, valor)
+        self.index = OidIndex(())
+    
+    def replace(self, items): # Sustituir todos los valores por los de la última difusión
+        values = {oid: (cls, value) for oid, cls, value in items}
+        if values.keys() != self.values.keys():
+            self.index = OidIndex(values)
+        self.values = values
+    
+    def get(self, oid):
+        spec = self.values.get(oid)
+        return spec[0](spec[1]) if spec is not None else None
+    
+    def iter_from(self, oid):
+        for candidate in self.index.iter_from(oid):
+            yield candidate, self.get(candidate)
+
+
+# Modo multiproceso (--workers N): N procesos atienden el mismo puerto UDP con SO_REUSEPORT y el núcleo reparte
+# las peticiones entre ellos. El proceso principal es el único que muestrea la CPU, envía notificaciones y
+# escribe el JSON. WorkerPool le envía a cada trabajador, por una tubería, cada versión nueva del modelo junto
+# con los valores calculados, y el trabajador la publica como propia: cada PDU se responde desde una versión
+# coherente. Los SET se reenvían al principal, que los aplica, difunde la versión resultante y solo entonces
+# confirma; así el gestor lee su cambio en cualquier proceso.
+class WorkerPool:
+    def __init__(self, count): # Constructor de la clase WorkerPool
+        self.count = count # Procesos en total, incluido el principal
+        self.workers = [] # (proceso, conexión con él)
+        self.store = None
+        self.cpu_cache = None
+        self.loop = None
+        self.scheduled = False # Hay una difusión pendiente en el bucle
+        self.sent_version = None # Última versión enviada
+        self.stats = {"broadcasts": 0, "bytes": 0, "sets": 0, "refreshes": 0}
+    
+    def start(self, args, engine_id, usm_keys): # Crear los procesos trabajadores (antes del bucle asyncio y del hilo de registro)
+        mp = multiprocessing.get_context("fork") # Heredan la configuración ya cargada: el fichero del agente no se puede importar por nombre
+        for worker_id in range(1, self.count):
+            conn, child_conn = mp.Pipe()
+            process = mp.Process(target=worker_main, args=(worker_id, args, child_conn, engine_id, usm_keys), daemon=True)
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn))
+    
+    def attach(self, store, cpu_cache, refresh_oids): # Empezar a difundir versiones y a atender a los trabajadores
+        self.store, self.cpu_cache = store, cpu_cache
+        self.loop = asyncio.get_running_loop()
+        self.send_all(("config", refresh_oids))
+        for _, conn in self.workers:
+            self.loop.add_reader(conn.fileno(), self.on_message, conn)
+        store.listeners.append(self.schedule)
+        self.broadcast()
+    
+    def refresh_values(self): # Volver a difundir aunque no haya versión nueva (han cambiado valores calculados); desde cualquier hilo
+        self.sent_version = None
+        self.schedule(None)
+    
+    def schedule(self, snapshot): # Listener de JsonStore: una sola difusión por vuelta del bucle aunque se publiquen varias versiones
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.broadcast)
+    
+    def broadcast(self): # Enviar la versión actual del modelo y los valores calculados a todos los trabajadores
+        self.scheduled = False
+        snap = self.store.snapshot
+        if snap.version == self.sent_version:
+            return
+        self.sent_version = snap.version
+        self.send_all(("state", snap.version, snap.model, export_values(self.store.providers)))
+        self.stats["broadcasts"] += 1
+    
+    def send_all(self, message): # Serializar una vez y enviar a cada trabajador
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        for process, conn in list(self.workers):
+            try:
+                conn.send_bytes(payload)
+                self.stats["bytes"] += len(payload)
+            except OSError:
+                self.drop(process, conn)
+    
+    def drop(self, process, conn): # Olvidar un trabajador que ha terminado
+        log.warning("⚠️  Proceso trabajador con pid %s desconectado", process.pid)
+        self.loop.remove_reader(conn.fileno())
+        conn.close()
+        self.workers.remove((process, conn))
+    
+    def on_message(self, conn): # Atender un mensaje de un trabajador: SET reenviado, petición de muestra de CPU o métricas
+        try:
+            message = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            self.drop(next(worker for worker in self.workers if worker[1] is conn)[0], conn)
+            return
+        if message[0] == "set":
+            _, request_id, values = message
+            try:
+                errStatus, changes = 0, self.store.commit_many(values)
+            except (KeyError, ValueError, TypeError): # El objeto ha desaparecido o el valor ya no encaja: genErr
+                errStatus, changes = 5, None
+            self.stats["sets"] += 1
+            if any(oid in self.store.controls for oid, _ in values): # Un objeto de control no crea versión nueva pero sí cambia valores calculados
+                self.sent_version = None
+            self.broadcast() # La versión con el cambio llega al trabajador antes que la confirmación
+            reply = ("set_done", request_id, errStatus, changes)
+            wal = self.store.wal
+            if not errStatus and wal is not None and wal.group_commit: # Confirmar cuando el cambio esté en disco
+                asyncio.ensure_future(self.reply_durable(conn, reply, wal.appended))
+            else:
+                self.reply(conn, reply)
+        elif message[0] == "metrics": # Métricas de un trabajador: se suman a las del principal al exponerlas
+            METRICS.remote[message[1]] = message[2]
+        elif message[0] == "refresh":
+            self.stats["refreshes"] += 1
+            self.cpu_cache.refresh() # Si la muestra ha caducado se toma otra y la nueva versión se difunde
+    
+    def reply(self, conn, message): # Contestar a un trabajador (si ya no está, se ignora)
+        try:
+            conn.send_bytes(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+    
+    async def reply_durable(self, conn, message, lsn): # Contestar al SET reenviado tras el fsync del WAL
+        try:
+            await self.store.wal.durable(lsn)
+        except OSError as e:
+            log.error("⚠️  Error sincronizando %s: %s", self.store.wal.filepath, e)
+            message = (message[0], message[1], 14, None) # commitFailed
+        self.reply(conn, message)
+    
+    def stop(self): # Terminar los trabajadores
+        for process, conn in self.workers:
+            if self.loop is not None:
+                self.loop.remove_reader(conn.fileno())
+            conn.close()
+            process.terminate()
+        for process, _ in self.workers:
+            process.join(2)
+
+
+# PrimaryLink es el lado del trabajador de la tubería con el proceso principal.
+class PrimaryLink:
+    def __init__(self, conn, store, stop_event): # Constructor de la clase PrimaryLink
+        self.conn = conn
+        self.store = store
+        self.stop_event = stop_event # Se activa si el proceso principal termina
+        self.values = ReplicaValues() # Valores calculados por el principal
+        store.add_provider(self.values)
+        self.pending = {} # id de SET reenviado -> futuro con (errStatus, cambios)
+        self.next_id = 0
+        self.last_refresh = 0.0 # time.monotonic() de la última petición de muestra
+        asyncio.get_running_loop().add_reader(conn.fileno(), self.on_message)
+    
+    def on_message(self): # Mensaje del principal: configuración, versión nueva o confirmación de un SET
+        try:
+            message = pickle.loads(self.conn.recv_bytes())
+        except (EOFError, OSError): # El proceso principal ha terminado: este trabajador también
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.stop_event.set()
+            return
+        if message[0] == "state":
+            _, version, model, values = message
+            self.store.install(version, model)
+            self.values.replace(values)
+        elif message[0] == "config":
+            if message[1]:
+                self.store.add_refresher(message[1], self.request_refresh)
+        elif message[0] == "set_done":
+            _, request_id, errStatus, changes = message
+            future = self.pending.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result((errStatus, changes))
+    
+    async def forward_set(self, values): # Aplicar un SET ya validado en el principal; devuelve (errStatus, cambios)
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.conn.send_bytes(pickle.dumps(("set", request_id, values), pickle.HIGHEST_PROTOCOL))
+            return await asyncio.wait_for(future, WORKER_SET_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+    
+    async def push_metrics(self, worker_id): # Tarea que envía las métricas de este proceso al principal cada METRICS_PUSH_INTERVAL
+        while True:
+            await asyncio.sleep(METRICS_PUSH_INTERVAL)
+            try:
+                self.conn.send_bytes(pickle.dumps(("metrics", worker_id, METRICS.export()), pickle.HIGHEST_PROTOCOL))
+            except OSError:
+                return
+    
+    def request_refresh(self): # Refresco bajo demanda: pedir una muestra al principal sin esperarla (se sirve la última recibida)
+        now = time.monotonic()
+        if now - self.last_refresh < CPU_CACHE_TTL:
+            return
+        self.last_refresh = now
+        try:
+            self.conn.send_bytes(pickle.dumps(("refresh",)))
+        except OSError:
+            pass
+
+
+async def run_worker(worker_id, args, conn, engine_id, usm_keys): # Corrutina de un proceso trabajador: solo atiende peticiones SNMP
+    store = JsonStore(JSON_FILE, SNAPSHOT_FILE) # Versión inicial; el principal envía la suya en cuanto arranca
+    snmpEngine = engine.SnmpEngine(v2c.OctetString(engine_id)) # Mismo engine ID y claves USM que el principal
+    snmpContext = context.SnmpContext(snmpEngine)
+    config.addTransport(snmpEngine, udp.domainName, udp.UdpTransport().openServerMode(sock=open_udp_socket(args.port, True)))
+    configure_security(snmpEngine, usm_keys, args.v2c)
+    
+    stop_event = asyncio.Event()
+    link = PrimaryLink(conn, store, stop_event)
+    JsonGet(snmpEngine, snmpContext, store)
+    JsonGetNext(snmpEngine, snmpContext, store)
+    JsonGetBulk(snmpEngine, snmpContext, store)
+    JsonSet(snmpEngine, snmpContext, store, forward=link.forward_set)
+    register_profile_control(store) # Solo la validación: el perfil se hace en el principal, que es donde llega el SET
+    add_stop_handlers(stop_event, ("SIGTERM",)) # Ctrl+C llega a todo el grupo de procesos: el principal decide cuándo terminar
+    log.info("👷 Proceso trabajador %d (pid %d) atendiendo UDP/%d", worker_id, os.getpid(), args.port)
+    pusher = asyncio.ensure_future(link.push_metrics(worker_id)) # El principal las suma en /metrics y en myAgentStats
+    try:
+        await stop_event.wait()
+    finally:
+        pusher.cancel()
+        snmpEngine.transportDispatcher.closeDispatcher()
+
+
+def worker_main(worker_id, args, conn, engine_id, usm_keys): # Punto de entrada de un proceso trabajador
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # El principal termina a los trabajadores con SIGTERM al apagarse
+    if hasattr(signal, PROFILE_SIGNAL):
+        signal.signal(getattr(signal, PROFILE_SIGNAL), signal.SIG_IGN) # Una señal de perfilado al grupo no debe terminarlos
+    log_listener = setup_logging(args.log_level, args.log_json) # Cada proceso tiene su propio hilo escritor
+    try:
+        asyncio.run(run_worker(worker_id, args, conn, engine_id, usm_keys))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log_listener.stop()
+
+
+def parse_notify_target(text): # "[trap|inform:]host:puerto" -> destino de NOTIFY_TARGETS
+    kind, address = text.split(":", 1) if text.split(":", 1)[0] in ("trap", "inform") else ("trap", text)
+    host, _, port = address.rpartition(":")
+    if kind not in ("trap", "inform") or not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"destino no válido: {text}")
+    return {"name": f"{kind}-{host}-{port}", "host": host, "port": int(port), "type": kind}
+
+
+def parse_args(): # Opciones de línea de comandos del agente
+    parser = argparse.ArgumentParser(description="Mini agente SNMP con MIB en JSON, monitor de CPU y notificaciones")
+    parser.add_argument("--log-level", default=LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Nivel de registro (por defecto %(default)s)")
+    parser.add_argument("--verbose", dest="log_level", action="store_const", const="DEBUG",
+                        help="Modo debug: salida detallada por petición, como la original")
+    parser.add_argument("--quiet", dest="log_level", action="store_const", const="WARNING",
+                        help="Modo producción: solo avisos y errores")
+    parser.add_argument("--log-json", action="store_true", default=LOG_JSON, help="Emitir los registros en formato JSON")
+    parser.add_argument("--no-v2c", dest="v2c", action="store_false", default=SNMP_V2C_ENABLED,
+                        help="Atender solo SNMPv3 (rechazar las peticiones con comunidad)")
+    parser.add_argument("--notify-target", action="append", type=parse_notify_target, metavar="[trap|inform:]HOST:PUERTO",
+                        help="Destino de las notificaciones (repetible; sustituye a NOTIFY_TARGETS)")
+    parser.add_argument("--port", type=int, default=AGENT_PORT, help="Puerto UDP del agente (por defecto %(default)s)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Procesos que atienden el puerto con SO_REUSEPORT (por defecto %(default)s)")
+    parser.add_argument("--shared-mib", default=SHARED_MIB_FILE, metavar="FICHERO",
+                        help="Mantener una copia viva de la MIB en un fichero mapeado en memoria (p. ej. /dev/shm/mib.bin)")
+    parser.add_argument("--dump-shared", action="store_true",
+                        help="Mostrar los valores actuales del fichero de --shared-mib de un agente en marcha y salir")
+    parser.add_argument("--wal-fsync", default=WAL_FSYNC, choices=WAL_POLICIES,
+                        help="Cuándo se fuerza a disco el WAL de cambios (por defecto %(default)s)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, metavar="PUERTO",
+                        help="Servir las métricas en formato OpenMetrics en http://127.0.0.1:PUERTO/metrics")
+    parser.add_argument("--metrics-file", default=METRICS_FILE, metavar="FICHERO",
+                        help=f"Volcar las métricas en FICHERO cada {METRICS_DUMP_INTERVAL} s y al detener el agente")
+    parser.add_argument("--profile-mode", default=PROFILE_MODE, choices=["sample", "cprofile"],
+                        help="Perfilador de los perfiles bajo demanda (por defecto %(default)s)")
+    parser.add_argument("--profile-memory", action="store_true", default=PROFILE_TRACEMALLOC,
+                        help="Añadir a cada perfil la diferencia de memoria de tracemalloc")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, metavar="DIRECTORIO",
+                        help="Directorio de los resultados de los perfiles (por defecto %(default)s)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers debe ser al menos 1")
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers mayor que 1 necesita SO_REUSEPORT (Linux)")
+    if args.dump_shared and not args.shared_mib:
+        parser.error("--dump-shared necesita --shared-mib")
+    return args
+
+
+async def run_agent(args, key_cache, usm_keys, pool=None): # Corrutina principal: transporte UDP, muestreador, notificaciones y persistencia en un único bucle asyncio
+    load_start = time.perf_counter()
+    store = JsonStore(JSON_FILE, SNAPSHOT_FILE) # Crear instancia de JsonStore (desde la instantánea binaria si está al día)
+    replayed = store.attach_wal(WriteAheadLog(WAL_FILE, args.wal_fsync)) # Cambios posteriores a la instantánea
+    load_time = time.perf_counter() - load_start
+    shared = None
+    if args.shared_mib: # Copia viva para otros procesos locales (el módulo solo se carga si se pide)
+        from shared_mib import MMAP_RECORD_SIZE, MmapStore
+        shared = MmapStore.mirror(args.shared_mib, store)
+    snmpEngine = engine.SnmpEngine(v2c.OctetString(key_cache.engine_id())) # Crear motor SNMP con un engine ID estable
+    snmpContext = context.SnmpContext(snmpEngine) # Crear contexto SNMP
     
     config.addTransport(
         snmpEngine, 
         udp.domainName, 
-        udp.UdpTransport().openServerMode(('0.0.0.0', 161)) # Escucha en todas las interfaces por el puerto 161
+        udp.UdpTransport().openServerMode(sock=open_udp_socket(args.port, pool is not None)) # Escucha en todas las interfaces (en el bucle actual)
     ) # Configurar transporte UDP para SNMP
     
-    # Configurar comunidades SNMPv1/v2c
-    config.addV1System(snmpEngine, 'public-area', 'public') 
-    config.addV1System(snmpEngine, 'private-area', 'private') 
-    
-    for secModel in (1, 2): # Para cada comunidad, configurar VACM
-        config.addVacmUser(snmpEngine, secModel, 'public-area', 'noAuthNoPriv', readSubTree=(1,3,6,1), writeSubTree=())
-        config.addVacmUser(snmpEngine, secModel, 'private-area', 'noAuthNoPriv', readSubTree=(1,3,6,1), writeSubTree=(1,3,6,1))
+    # Configurar comunidades SNMPv1/v2c, usuarios SNMPv3 y sus vistas VACM
+    configure_security(snmpEngine, usm_keys, args.v2c)
     
-    config.addTargetParams(snmpEngine, 'trap-target', 'public-area', 'noAuthNoPriv', 1) # Configurar destino de TRAP
-    config.addTargetAddr(snmpEngine, 'trap-target', udp.domainName, ('127.0.0.1', 162), 'trap-target', tagList='trap') # Enviar TRAPs al localhost:162
-    config.addNotificationTarget(snmpEngine, 'trap-target', 'trap-target', 'trap') # Configurar notificación de TRAP
+    trap_sender = TrapSender(snmpEngine, args.notify_target or NOTIFY_TARGETS) # Configurar los destinos de TRAP/INFORM
+    metrics_server = await asyncio.start_server(serve_metrics, "127.0.0.1", args.metrics_port) if args.metrics_port else None # Solo en local: las métricas no llevan autenticación
     
     # Configurar manejadores para operaciones SNMP
     JsonGet(snmpEngine, snmpContext, store) 
     JsonGetNext(snmpEngine, snmpContext, store)
-    JsonSet(snmpEngine, snmpContext, store)
+    JsonGetBulk(snmpEngine, snmpContext, store)
+    JsonSet(snmpEngine, snmpContext, store, on_commit=pool and pool.broadcast) # Con trabajadores, responder cuando ya tienen el cambio
     
     print("\n" + "="*70)
     print("🚀 AGENTE SNMP INICIADO")
     print("="*70)
-    print(f"   Puerto: UDP/161")
-    print(f"   Comunidad lectura: public")
-    print(f"   Comunidad escritura: private")
+    print(f"   Puerto: UDP/{args.port}")
+    if pool is not None:
+        print(f"   Procesos: {args.workers} con SO_REUSEPORT (muestreo, notificaciones y SET en el principal, pid {os.getpid()})")
+    if args.v2c:
+        print(f"   Comunidad lectura: public")
+        print(f"   Comunidad escritura: private")
+    else:
+        print(f"   SNMPv1/v2c: desactivado")
+    for user in SNMP_V3_USERS:
+        print(f"   Usuario SNMPv3: {user['user']} ({usm_security_level(user)}, {user['auth']}/{user['priv']}, {user['view']})")
+    if not SNMP_V3_USERS:
+        print(f"   Usuarios SNMPv3: ninguno (sin contraseñas en el entorno ni en {SNMP_V3_CREDENTIALS_FILE})")
+    print(f"   Engine ID: {bytes(snmpEngine.snmpEngineID).hex()} | claves USM: "
+          f"{key_cache.stats['hits']} de caché, {key_cache.stats['derived']} derivadas ({key_cache.stats['derive_time']*1000:.1f} ms)")
     print(f"   OID base: {store.model['baseoid']}")
-    print(f"   Archivo JSON: {JSON_FILE}")
+    print(f"   Notificaciones: {', '.join(t['type'] + ' ' + t['host'] + ':' + str(t['port']) for t in trap_sender.targets)}")
+    print(f"   Archivo JSON: {JSON_FILE} | instantánea: {SNAPSHOT_FILE}")
+    print(f"   Estado cargado desde: {store.load_source} + {replayed} cambios de {WAL_FILE} "
+          f"({len(store.snapshot.oid_map)} objetos en {load_time*1000:.1f} ms)")
+    print(f"   WAL: fsync {args.wal_fsync}{f' cada {WAL_FSYNC_INTERVAL} s' if args.wal_fsync == 'interval' else ''} | "
+          f"compactación cada {FLUSH_INTERVAL} s o a partir de {WAL_COMPACT_BYTES // 1024} KiB")
+    if shared is not None:
+        print(f"   MIB compartida: {args.shared_mib} ({len(shared.oids)} objetos, {MMAP_RECORD_SIZE} bytes por registro)")
+    print(f"   Perfilado bajo demanda: kill -{PROFILE_SIGNAL[3:]} {os.getpid()} ({PROFILE_SIGNAL_SECONDS} s) o profileSeconds por SNMPv3 | "
+          f"{args.profile_mode}{' + tracemalloc' if args.profile_memory else ''} -> {args.profile_dir}/")
+    if args.metrics_port or args.metrics_file:
+        print(f"   Métricas: {f'http://127.0.0.1:{args.metrics_port}/metrics' if args.metrics_port else ''}"
+              f"{' | ' if args.metrics_port and args.metrics_file else ''}"
+              f"{f'{args.metrics_file} cada {METRICS_DUMP_INTERVAL} s' if args.metrics_file else ''}")
     print(f"   Inicio: {get_timestamp()}")
     print("="*70)
     print("\n📋 OIDs disponibles:")
@@ -659,44 +3304,130 @@ def main(): # Función principal para iniciar el agente SNMP
     for key, obj in store.model["scalars"].items():
         access = "RO" if obj["access"] == "read-only" else "RW"
         print(f"   [{access}] {obj['oid']:<35} {key:<20} = {obj['value']}")
+    for key, table in store.model["tables"].items():
+        print(f"   [RO] {table['oid']:<35} {key:<20} = tabla ({', '.join(table['columns'])})")
     print("="*70)
     print("\n⚡ Presiona Ctrl+C para detener el agente")
     print("="*70 + "\n")
     
-    stop_event = threading.Event() # Evento para detener el Agente con el ctrl+c
-    
-    # Hilo para ejecutar el muestreador de CPU basado en asyncio
-    loop = asyncio.new_event_loop()
-    
-    def run_cpu_monitor():
-        asyncio.set_event_loop(loop)
-        try:
-            # Ejecuta la corrutina cpu_sampler hasta que stop_event se active
-            loop.run_until_complete(cpu_sampler(store, snmpEngine, stop_event))
-        finally:
-            loop.close()
-    
-    cpu_thread = threading.Thread(target=run_cpu_monitor) # Hilo para muestrear CPU
-    cpu_thread.daemon = True # Hilo de fondo. No bloquea la salida del programa
-    cpu_thread.start() # Iniciar hilo de muestreo de CPU basado en asyncio
+    # Todas las tareas comparten el bucle del despachador SNMP: sin hilos extra ni carreras sobre store.model
+    history = CpuHistory() # Búfer circular de muestras y agregados por ventana
+    register_cpu_history(store, history)
+    cpu_cache = CpuSampleCache(store) # Última muestra de CPU, compartida por el muestreador y los GET
+    refresh_oids = [store.cpu_usage_oid, store.table_oid("cpuCoreTable")] if CPU_CACHE_TTL else []
+    if refresh_oids:
+        store.add_refresher(refresh_oids, cpu_cache.refresh)
+    pipeline = NotificationPipeline(snmpEngine, trap_sender=trap_sender) # Cola de alertas y trabajadores de entrega
+    pipeline.start()
+    governor = NotificationGovernor() # Histéresis y tiempo mínimo entre alertas
+    register_notify_stats(store, governor, pipeline)
+    register_agent_stats(store, pipeline, cpu_cache)
+    profiler = Profiler(args.profile_dir, args.profile_mode, args.profile_memory) # Inactivo hasta que se pide un perfil
+    register_profile_control(store, profiler)
+    if pool is not None: # Los trabajadores reciben desde ya cada versión nueva del modelo
+        pool.attach(store, cpu_cache, refresh_oids)
+        profiler.on_change = pool.refresh_values
+    tasks = [
+        asyncio.ensure_future(cpu_sampler(store, cpu_cache, pipeline, governor)), # Comprobación del umbral de CPU
+        asyncio.ensure_future(history_sampler(history, pool.refresh_values if pool is not None else None)), # Histórico a ritmo fijo
+        asyncio.ensure_future(persistence_flusher(store)), # Compactación del WAL en la instantánea
+    ]
+    if args.wal_fsync == "interval":
+        tasks.append(asyncio.ensure_future(wal_syncer(store.wal)))
+    if args.metrics_file:
+        tasks.append(asyncio.ensure_future(metrics_dumper(args.metrics_file)))
     
-    snmpEngine.transportDispatcher.jobStarted(1) # Iniciar el despachador SNMP
+    stop_event = asyncio.Event() # Se activa con Ctrl+C o SIGTERM
+    add_stop_handlers(stop_event)
+    try:
+        asyncio.get_running_loop().add_signal_handler(getattr(signal, PROFILE_SIGNAL), profiler.start, PROFILE_SIGNAL_SECONDS)
+    except (AttributeError, NotImplementedError, RuntimeError): # Sin la señal (Windows) solo se puede lanzar por SNMP
+        pass
     
     try:
-        snmpEngine.transportDispatcher.runDispatcher() # Ejecutar el despachador SNMP es el que escucha y atiende las peticiones
-    except KeyboardInterrupt:
+        await stop_event.wait()
+    finally:
         print(f"\n\n{'='*70}")
         print("🛑 APAGANDO AGENTE")
         print("="*70)
-        stop_event.set()
-        cpu_thread.join(timeout=2)
-        store.save()
-        print(f"   💾 Estado guardado en {JSON_FILE}")
+        for task in tasks: # Cancelación ordenada de todas las tareas del bucle
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if metrics_server is not None:
+            metrics_server.close()
+        profiler.stop() # Un perfil a medias también se guarda
+        if profiler.writing is not None:
+            await profiler.writing
+        await pipeline.stop()
+        if pool is not None:
+            pool.stop()
+        snmpEngine.transportDispatcher.closeDispatcher() # Cerrar el transporte SNMP
+        store.export_json() # Copia legible para las personas; la instantánea se escribe después para que sea la más reciente
+        store.mark_dirty() # Forzar el guardado final aunque no haya cambios pendientes
+        store.flush()
+        store.wal.close()
+        if shared is not None:
+            store.listeners.clear()
+            shared.close()
+            print(f"   📊 MIB compartida: {shared.stats['records_written']} registros escritos en su sitio | "
+                  f"{shared.stats['syncs']} versiones | {shared.stats['rebuilds']} cambios de estructura")
+        stats = store.flush_stats
+        print(f"   💾 Estado guardado en {SNAPSHOT_FILE} y {JSON_FILE}")
+        print(f"   📊 Escrituras: {stats['flushes']} | Bytes: {stats['bytes_written']} | Tiempo: {stats['flush_time']*1000:.1f} ms")
+        wal_stats = store.wal.stats
+        print(f"   📊 WAL: {wal_stats['records']} cambios ({wal_stats['bytes']} bytes) | {wal_stats['fsyncs']} fsync "
+              f"({wal_stats['fsync_time']*1000:.1f} ms) | {wal_stats['replayed']} aplicados al arrancar | {wal_stats['torn']} colas rotas descartadas")
+        print(f"   📊 Caché de valores: {store.cache_stats['hits']} aciertos | {store.cache_stats['misses']} fallos")
+        cpu_stats = cpu_cache.stats
+        print(f"   📊 Muestras de CPU: {cpu_stats['samples']} ({cpu_stats['on_demand']} bajo demanda) | "
+              f"{cpu_stats['hits']} lecturas servidas sin volver a muestrear")
+        print(f"   📊 Alertas: {governor.stats['raised']} generadas | {governor.stats['suppressed']} cruces suprimidos por histéresis")
+        for channel, ch_stats in pipeline.stats.items():
+            delivered = ch_stats["sent"] + ch_stats["failed"]
+            avg_ms = ch_stats["latency_total"] / delivered * 1000 if delivered else 0.0
+            print(f"   📊 Notificaciones {channel}: {ch_stats['sent']} enviadas | {ch_stats['failed']} fallidas | "
+                  f"{ch_stats['dropped']} descartadas | {ch_stats['throttled']} limitadas | "
+                  f"latencia media {avg_ms:.1f} ms (máx {ch_stats['latency_max']*1000:.1f} ms)")
+        for name, t_stats in trap_sender.stats.items():
+            avg_ms = t_stats["latency_total"] / t_stats["sent"] * 1000 if t_stats["sent"] else 0.0
+            print(f"   📊 Destino {name}: {t_stats['sent']} entregadas | {t_stats['failed']} fallidas | "
+                  f"{t_stats['retries']} reenvíos | latencia media {avg_ms:.1f} ms (máx {t_stats['latency_max']*1000:.1f} ms)")
+        if pool is not None:
+            print(f"   📊 Procesos: {pool.stats['broadcasts']} versiones difundidas ({pool.stats['bytes']/1024:.1f} KB) | "
+                  f"{pool.stats['sets']} SET reenviados | {pool.stats['refreshes']} muestras pedidas por los trabajadores")
+        if profiler.stats["runs"]:
+            print(f"   🔬 Perfiles: {profiler.stats['runs']} | último: {profiler.stats['last'] or '-'}")
+        mail_stats = pipeline.mailer.stats
+        print(f"   📊 SMTP: {mail_stats['messages']} mensajes | {mail_stats['connects']} conexiones | {mail_stats['reconnects']} reconexiones")
+        if args.metrics_file:
+            dump_metrics(args.metrics_file) # Último volcado con todo lo atendido
+            print(f"   📊 Métricas volcadas en {args.metrics_file}")
         print(f"   🕐 Hora de cierre: {get_timestamp()}")
         print("="*70)
         print("\n👋 Agente detenido correctamente\n")
+
+
+def main(): # Función principal para iniciar el agente SNMP
+    global SNMP_V3_USERS
+    args = parse_args()
+    if args.dump_shared:
+        from shared_mib import dump_shared
+        dump_shared(args.shared_mib)
+        return
+    SNMP_V3_USERS = load_v3_credentials(SNMP_V3_USERS) # Los trabajadores heredan la lista ya resuelta
+    key_cache = UsmKeyCache() # Engine ID persistente y claves USM localizadas
+    usm_keys = key_cache.localize_users()
+    pool = None
+    if args.workers > 1: # Los trabajadores se crean antes que el bucle y los hilos, y heredan el engine ID y las claves
+        pool = WorkerPool(args.workers)
+        pool.start(args, key_cache.engine_id(), usm_keys)
+    log_listener = setup_logging(args.log_level, args.log_json) # Hilo escritor del registro
+    try:
+        asyncio.run(run_agent(args, key_cache, usm_keys, pool)) # Un único bucle asyncio por proceso
+    except KeyboardInterrupt: # Ctrl+C donde no hay manejadores de señales (Windows): run_agent ya ha hecho el apagado
+        pass
     finally:
-        snmpEngine.transportDispatcher.closeDispatcher() # Cerrar el despachador SNMP
+        log_listener.stop() # Vaciar la cola de registros pendientes
 
 
 if __name__ == '__main__':
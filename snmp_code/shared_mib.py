@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+shared_mib.py - MIB compartida del mini agente SNMP en un fichero mapeado en memoria.
+El agente la importa solo con --shared-mib o --dump-shared. No depende del agente: cualquier herramienta local
+puede importar MmapStore para leer los valores vivos del fichero.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from pysnmp.proto.api import v2c
+
+# Configuración Global
+MMAP_RECORD_SIZE = 512  # Bytes por objeto: cabecera, OID de hasta MMAP_MAX_OID_LEN subidentificadores y valor
+MMAP_MAX_OID_LEN = 32  # Subidentificadores máximos de un OID en el fichero
+MMAP_READ_SPINS = 100  # Vueltas cediendo la CPU mientras el escritor tiene la secuencia en impar, antes de dormir
+MMAP_READ_SLEEP = 0.001  # Segundos entre reintentos a partir de entonces
+MMAP_READ_TIMEOUT = 2.0  # Segundos sin lograr una lectura coherente tras los que se da el escritor por caído
+
+MMAP_TYPES = ["DisplayString", "Integer32", "Counter32", "Gauge32", "TimeTicks", "Counter64"] # Código de tipo -> tipo del modelo
+MMAP_VALUES = { # Tipo del modelo -> constructor del valor pysnmp (como SNMP_TYPES del agente)
+    "DisplayString": lambda value: v2c.OctetString(str(value).encode('utf-8')),
+    "Integer32": v2c.Integer,
+    "Counter32": lambda value: v2c.Counter32(value & 0xFFFFFFFF),
+    "Gauge32": v2c.Gauge32,
+    "TimeTicks": v2c.TimeTicks,
+    "Counter64": lambda value: v2c.Counter64(value & 0xFFFFFFFFFFFFFFFF),
+}
+MMAP_HEADER = struct.Struct("<4sHHIIQ") # Magia, formato, tamaño de registro, número de registros, flags, secuencia (seqlock)
+MMAP_HEADER_SIZE = 64
+MMAP_STATE = struct.Struct("<IQ") # flags y secuencia, leídos juntos
+MMAP_STATE_OFFSET = 12
+MMAP_SEQ = struct.Struct("<Q")
+MMAP_SEQ_OFFSET = 16
+MMAP_RECORD = struct.Struct(f"<BBBxH{MMAP_MAX_OID_LEN}I") # Longitud del OID, tipo, escribible, longitud del valor, OID
+MMAP_FIELDS = struct.Struct("<BBBxH") # Los mismos campos sin el OID
+MMAP_VALUE_SIZE = MMAP_RECORD_SIZE - MMAP_RECORD.size
+MMAP_REPLACED = 1 # Flag: el fichero se ha sustituido por otro con distinta estructura y hay que volver a abrirlo
+
+
+def oid_to_string(oid): # OID en texto ("1.3.6...")
+    return '.'.join(str(x) for x in oid)
+
+
+def write_file(filepath, payload): # Sustituir el fichero de golpe (temporal + renombrado) para que nadie lo vea a medias
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+
+def pack_record(buf, offset, oid, kind, writable, value): # Escribir un registro completo en buf a partir de offset
+    if len(oid) > MMAP_MAX_OID_LEN:
+        raise ValueError(f"OID demasiado largo para la MIB compartida: {oid_to_string(oid)}")
+    payload = str(value).encode('utf-8') if kind == "DisplayString" else struct.pack("<Q" if kind == "Counter64" else "<q", int(value))
+    if len(payload) > MMAP_VALUE_SIZE:
+        raise ValueError(f"Valor demasiado largo para la MIB compartida: {oid_to_string(oid)}")
+    MMAP_RECORD.pack_into(buf, offset, len(oid), MMAP_TYPES.index(kind), writable, len(payload),
+                          *oid, *(0,) * (MMAP_MAX_OID_LEN - len(oid)))
+    buf[offset + MMAP_RECORD.size:offset + MMAP_RECORD.size + len(payload)] = payload
+
+
+def unpack_record(data, offset): # (tipo, escribible, valor Python) del registro que empieza en offset
+    _, code, writable, size = MMAP_FIELDS.unpack_from(data, offset)
+    raw = data[offset + MMAP_RECORD.size:offset + MMAP_RECORD.size + size]
+    kind = MMAP_TYPES[code]
+    if kind == "DisplayString":
+        return kind, writable, bytes(raw).decode('utf-8')
+    return kind, writable, struct.unpack("<Q" if kind == "Counter64" else "<q", raw)[0]
+
+
+sched_yield = getattr(os, "sched_yield", lambda: time.sleep(0)) # Ceder la CPU (os.sched_yield no existe en Windows)
+
+
+# MmapView es una copia coherente de los registros de una MmapStore (lo que devuelve pin()).
+class MmapView:
+    __slots__ = ("oids", "positions", "data")
+    
+    def __init__(self, oids, positions, data): # Constructor de la clase MmapView
+        self.oids = oids # OIDs ordenados del fichero
+        self.positions = positions # OID -> número de registro
+        self.data = data # Bytes de todos los registros, copiados dentro del seqlock
+
+
+# MmapStore guarda los valores de la MIB en un fichero mapeado en memoria con un registro de tamaño fijo por
+# objeto, ordenados por OID: cabecera de 64 bytes y después MMAP_RECORD_SIZE bytes por escalar o celda.
+# Cualquier proceso local puede abrirlo y leer los valores vivos directamente de la memoria compartida, sin
+# llamadas al sistema ni parsear JSON. El escritor (un único proceso) cambia los registros en su sitio dentro de un
+# seqlock: pone la secuencia de la cabecera en impar, escribe y la deja en par. Un lector repite la lectura
+# si la secuencia era impar o ha cambiado, así que nunca ve un SET a medias y nunca toma un cerrojo.
+# Si cambia la estructura (aparecen filas u objetos) se escribe un fichero nuevo, se renombra sobre el
+# anterior y se marca el viejo con MMAP_REPLACED para que sus lectores vuelvan a abrirlo.
+class MmapStore:
+    def __init__(self, filepath, writable=False): # Abrir un fichero ya creado (solo lectura salvo writable)
+        self.filepath = filepath
+        self.writable = writable
+        self.lock = threading.Lock() # Serializa a los escritores del proceso
+        self.holders = {} # OID -> objeto del modelo del que salió el valor escrito (sync)
+        self.stats = {"syncs": 0, "records_written": 0, "rebuilds": 0, "retries": 0}
+        self.map = None
+        self.inode = None # Fichero mapeado, para saber si un escritor nuevo lo ha sustituido
+        self.open()
+    
+    def open(self): # Mapear el fichero y leer su estructura (los OIDs no cambian mientras el fichero exista)
+        with open(self.filepath, "r+b" if self.writable else "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+            inode = os.fstat(f.fileno()).st_ino
+        magic, version, record_size, count, _, _ = MMAP_HEADER.unpack_from(mapped, 0)
+        if magic != b"MIBS" or version != 1 or record_size != MMAP_RECORD_SIZE:
+            mapped.close()
+            raise ValueError(f"{self.filepath} no es un fichero de MIB compartida válido")
+        oids = []
+        for n in range(count):
+            fields = MMAP_RECORD.unpack_from(mapped, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE)
+            oids.append(tuple(fields[4:4 + fields[0]]))
+        if self.map is not None:
+            self.map.close()
+        self.map = mapped
+        self.inode = inode
+        self.oids = oids
+        self.positions = {oid: n for n, oid in enumerate(oids)}
+    
+    @staticmethod
+    def build(filepath, store, snap): # Escribir de forma atómica un fichero con todos los escalares y celdas de la versión snap
+        oids = sorted(snap.oid_map)
+        buf = bytearray(MMAP_HEADER_SIZE + len(oids) * MMAP_RECORD_SIZE)
+        MMAP_HEADER.pack_into(buf, 0, b"MIBS", 1, MMAP_RECORD_SIZE, len(oids), 0, 0)
+        holders = {}
+        for n, oid in enumerate(oids):
+            holder, definition, value = store.resolve(snap, snap.oid_map[oid])
+            pack_record(buf, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE, oid, definition["type"],
+                        definition["access"] == "read-write", value)
+            holders[oid] = holder
+        write_file(filepath, bytes(buf))
+        return holders
+    
+    @classmethod
+    def mirror(cls, filepath, store): # Crear el fichero desde store y mantenerlo al día con cada versión publicada
+        snap = store.pin()
+        holders = cls.build(filepath, store, snap)
+        shared = cls(filepath, writable=True)
+        shared.holders = holders
+        store.listeners.append(lambda published: shared.sync(store, published))
+        return shared
+    
+    def read(self, fn): # Ejecutar fn() dentro del seqlock: repetir si un escritor ha cambiado algo mientras tanto
+        waits, deadline = 0, None
+        while True:
+            flags, seq = MMAP_STATE.unpack_from(self.map, MMAP_STATE_OFFSET)
+            if flags & MMAP_REPLACED: # El escritor ha publicado otra estructura: abrir el fichero nuevo
+                self.open()
+                continue
+            if not seq & 1:
+                result = fn()
+                if MMAP_SEQ.unpack_from(self.map, MMAP_SEQ_OFFSET)[0] == seq:
+                    return result
+                self.stats["retries"] += 1 # Ha habido una escritura durante la lectura: repetirla
+            waits += 1 # Escritura en curso: ceder la CPU y, si dura, dormir entre intentos
+            if waits <= MMAP_READ_SPINS:
+                sched_yield()
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + MMAP_READ_TIMEOUT
+            elif time.monotonic() > deadline: # El escritor murió a mitad de un SET o no deja de escribir
+                if os.stat(self.filepath).st_ino == self.inode:
+                    raise TimeoutError(f"{self.filepath}: sin lectura coherente en {MMAP_READ_TIMEOUT} s (¿escritor caído a mitad de un cambio?)")
+                self.open() # Un agente nuevo ha vuelto a crear el fichero: leer ese
+                waits, deadline = 0, None
+                continue
+            time.sleep(MMAP_READ_SLEEP)
+    
+    def get_many(self, oids): # [(ok, valor)] de varios OIDs leídos en la misma vuelta del seqlock, sin copiar el fichero
+        def lookup():
+            records = []
+            for oid in oids:
+                n = self.positions.get(oid)
+                records.append(None if n is None else unpack_record(self.map, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE))
+            return records
+        return [(False, v2c.NoSuchObject()) if record is None else (True, MMAP_VALUES[record[0]](record[2]))
+                for record in self.read(lookup)]
+    
+    def pin(self): # Copia coherente de todos los registros (como JsonStore.pin; cuesta lo que ocupe el fichero)
+        return self.read(lambda: MmapView(self.oids, self.positions, self.map[MMAP_HEADER_SIZE:]))
+    
+    def value_at(self, data, base, n): # Valor pysnmp del registro n
+        kind, _, value = unpack_record(data, base + n * MMAP_RECORD_SIZE)
+        return MMAP_VALUES[kind](value)
+    
+    def get_exact(self, oid, snap=None): # Obtener el valor exacto para un OID dado (en la copia fijada o en el fichero)
+        if snap is not None:
+            n = snap.positions.get(oid)
+            return (False, v2c.NoSuchObject()) if n is None else (True, self.value_at(snap.data, 0, n))
+        
+        def lookup():
+            n = self.positions.get(oid)
+            return None if n is None else unpack_record(self.map, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE)
+        record = self.read(lookup)
+        if record is None:
+            return False, v2c.NoSuchObject()
+        return True, MMAP_VALUES[record[0]](record[2])
+    
+    def get_next(self, oid, snap=None): # Obtener el siguiente OID y su valor
+        def lookup(oids, data, base):
+            n = bisect.bisect_right(oids, oid)
+            if n == len(oids):
+                return False, None, None
+            return True, oids[n], self.value_at(data, base, n)
+        if snap is not None:
+            return lookup(snap.oids, snap.data, 0)
+        return self.read(lambda: lookup(self.oids, self.map, MMAP_HEADER_SIZE))
+    
+    def walk(self, prefix=(), snap=None): # Recorrer en orden (oid, valor) los objetos bajo prefix, todos de la misma copia
+        snap = snap or self.pin()
+        prefix = tuple(prefix)
+        for n in range(bisect.bisect_left(snap.oids, prefix), len(snap.oids)):
+            if snap.oids[n][:len(prefix)] != prefix:
+                return
+            yield snap.oids[n], self.value_at(snap.data, 0, n)
+    
+    def write(self, records): # Escribir [(n, oid, tipo, escribible, valor)] en su sitio dentro del seqlock
+        seq = MMAP_SEQ.unpack_from(self.map, MMAP_SEQ_OFFSET)[0]
+        MMAP_SEQ.pack_into(self.map, MMAP_SEQ_OFFSET, seq + 1) # Impar: los lectores esperan o repiten
+        try:
+            for n, oid, kind, writable, value in records:
+                pack_record(self.map, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE, oid, kind, writable, value)
+        finally:
+            MMAP_SEQ.pack_into(self.map, MMAP_SEQ_OFFSET, seq + 2)
+        self.stats["records_written"] += len(records)
+    
+    def commit_set(self, oid, snmp_val): # Aplicar un SET ya validado
+        return self.commit_many([(oid, snmp_val)])[0]
+    
+    def commit_many(self, varbinds): # Aplicar varios varbinds de una vez (los lectores ven todos o ninguno)
+        with self.lock:
+            records, changes = [], []
+            for oid, snmp_val in varbinds:
+                n = self.positions[oid]
+                kind, writable, old_value = unpack_record(self.map, MMAP_HEADER_SIZE + n * MMAP_RECORD_SIZE)
+                value = str(snmp_val) if kind == "DisplayString" else int(snmp_val)
+                records.append((n, oid, kind, writable, value))
+                changes.append((old_value, value))
+            self.write(records)
+        return changes
+    
+    def sync(self, store, snap): # Llevar al fichero la versión publicada por store (listener de JsonStore)
+        with self.lock:
+            self.stats["syncs"] += 1
+            if snap.oid_map.keys() != self.positions.keys(): # Otra estructura: fichero nuevo y aviso a los lectores del viejo
+                old_map = self.map
+                self.holders = self.build(self.filepath, store, snap)
+                self.map = None
+                self.open()
+                MMAP_STATE.pack_into(old_map, MMAP_STATE_OFFSET, MMAP_REPLACED, MMAP_SEQ.unpack_from(old_map, MMAP_SEQ_OFFSET)[0])
+                old_map.close()
+                self.stats["rebuilds"] += 1
+                return
+            records = []
+            for oid, n in self.positions.items():
+                holder, definition, value = store.resolve(snap, snap.oid_map[oid])
+                if self.holders.get(oid) is not holder: # Copy-on-write: solo cambian de objeto los valores modificados
+                    records.append((n, oid, definition["type"], definition["access"] == "read-write", value))
+                    self.holders[oid] = holder
+            if records:
+                self.write(records)
+    
+    def close(self): # Liberar el mapeo
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def dump_shared(filepath): # Leer la MIB compartida de un agente en marcha, como haría cualquier herramienta local
+    shared = MmapStore(filepath)
+    try:
+        for oid, val in shared.walk():
+            print(f"{oid_to_string(oid)} = {val.prettyPrint()}")
+    except TimeoutError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    finally:
+        shared.close()
@@ -1,355 +1,409 @@
 #!/usr/bin/env python3
 """
-test_agent_interactivo.py - Script de prueba INTERACTIVO para el mini agente SNMP
-Prueba GET, GETNEXT, SET, WALK y restaura los valores originales al finalizar.
+test.py - Suite de pruebas funcionales del mini agente SNMP, sin interacción.
+Habla SNMP directamente con pysnmp (no necesita net-snmp) y lanza a la vez las pruebas independientes de GET,
+GETNEXT, WALK, SET, casos negativos y CPU. Por defecto arranca su propio agente en un puerto libre de 127.0.0.1
+y en un directorio temporal; con --agent prueba un agente que ya está en marcha. Al terminar restaura los
+valores originales con un único SET de varios varbinds. Después comprueba en este mismo proceso, durante un
+segundo, que las lecturas con versión fijada de JsonStore no se mezclan con SETs y muestras concurrentes (la
+versión larga es `python benchmark.py stress`). Sale con código 1 si falla alguna prueba.
+
+Uso: python test.py [--agent HOST[:PUERTO]] [--workers N]
 """
 
-import subprocess
-import time
-import sys
+import argparse
+import asyncio
 import os
+import sys
+import tempfile
+import threading
+import time
+
+from pysnmp.hlapi.v3arch import asyncio as hlapi
 
-# Configuración Global 
-AGENT_IP = "127.0.0.1"  # IP por defecto, se preguntará al usuario
+from agent_launcher import AGENT_IP, free_port, load_agent, start_agent, stop_agent
+
+# Configuración Global
+AGENT_PORT = 161 # Puerto por defecto de un agente externo (--agent)
 COMMUNITY_RO = "public"
 COMMUNITY_RW = "private"
 BASE_OID = "1.3.6.1.4.1.28308"
+REQUEST_TIMEOUT = 2 # Segundos de timeout de cada petición
+REQUEST_RETRIES = 1
+CONSISTENCY_SECONDS = 1 # Duración de la prueba de lecturas con versión fijada
+CONSISTENCY_READERS = 2 # Hilos lectores simultáneos
 
 # OIDs del Agente
 OID_MANAGER = f"{BASE_OID}.1.1.0"
 OID_EMAIL = f"{BASE_OID}.1.2.0"
 OID_CPU_USAGE = f"{BASE_OID}.1.3.0"
 OID_CPU_THRESHOLD = f"{BASE_OID}.1.4.0"
+OID_CPU_CORE_TABLE = f"{BASE_OID}.1.5"
+OID_MISSING = f"{BASE_OID}.1.99.0" # OID bajo la MIB del agente que no existe
 
 def print_header(title): # Imprime un encabezado de sección bonito
     print(f"\n{'='*60}")
     print(f" {title.upper()} ")
     print(f"{'='*60}")
 
-def pause_for_next_test(test_name): # Espera a que el usuario pulse ENTER para continuar
-    print(f"\n--- Preparado para el Test: {test_name} ---")
-    print("Presiona ENTER para continuar...")
-    input()
 
-def run_snmp_command(cmd): # Ejecuta un comando SNMP y devuelve el resultado
-    try:
-        result = subprocess.run(
-            cmd, 
-            shell=True, 
-            capture_output=True, 
-            text=True, 
-            timeout=10,
-            encoding='utf-8',
-            errors='ignore'
-        ) # Ejecuta el comando con un timeout de 10 segundos
-        return result.returncode == 0, result.stdout.strip(), result.stderr.strip() # Devuelve éxito, salida y error
-    except subprocess.TimeoutExpired:
-        return False, "", "Timeout: La IP del agente no responde"
-    except Exception as e:
-        return False, "", str(e)
+# SnmpSession agrupa el motor pysnmp y el destino que comparten todas las pruebas. Cada método hace una
+# petición y devuelve (error, varbinds), con error None si la respuesta es correcta o un texto con el
+# problema (errorIndication o el nombre del errorStatus).
+class SnmpSession:
+    def __init__(self, host, port, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES): # Constructor de la clase SnmpSession (el destino se crea en open)
+        self.host, self.port = host, port
+        self.timeout, self.retries = timeout, retries
+        self.engine = hlapi.SnmpEngine()
+        self.target = None
+        self.context = hlapi.ContextData()
 
-def get_snmp_value(oid): # Función para obtener solo el valor de un OID
-    cmd = f"snmpget -v2c -c {COMMUNITY_RO} {AGENT_IP} {oid}" # Creamos el comando snmpget
-    success, output, error = run_snmp_command(cmd) # Ejecutamos el comando
-    
-    if success and output and ":" in output:
-        try:
-            value_part = output.rsplit(":", 1)[1].strip() # Dividimos por el ÚLTIMO ':' para aislar el valor
-            
-            if value_part.startswith('"') and value_part.endswith('"'): # Quita las comillas si es un STRING
-                value_part = value_part[1:-1]
-            
-            return value_part
-        except Exception as e:
-            print(f"  (Error parseando valor: {e})")
-            return None
-    elif "No Such Object" in output:
-        print(f"  (Error: El OID {oid} no existe en el agente)")
-        return None
-    else:
-        print(f"  (Error obteniendo valor: {error})")
-        return None
-
-def check_snmp_tools(): # Comprueba si snmpget está disponible
-    print_header("Verificando herramientas SNMP")
-    
-    SNMPGET = "C:\\usr\\bin\\snmpget.exe" 
-    cmd = [SNMPGET, "-v2c", "-c", "public", AGENT_IP, f"{BASE_OID}.1.1.0"]
-    success, output, error = run_snmp_command(cmd)
-    
-    if success or "NET-SNMP" in output or "NET-SNMP" in error: # Si responde o da error de net-snmp
-        print("  ✓ net-snmp encontrado")
-        return True
-    else: # No encontrado
-        print("  ✗ net-snmp NO encontrado")
-        print("\n  Instala net-snmp para Windows desde:")
-        print("  http://www.net-snmp.org/download.html")
-        print("\n  O añade la ruta de net-snmp a PATH")
-        return False
-
-def test_get_operations(): # Test 1: Operaciones GET básicas
-    print_header("TEST 1: Operaciones GET básicas")
-    
+    async def open(self): # Crear el transporte UDP hacia el agente
+        self.target = await hlapi.UdpTransportTarget.create((self.host, self.port), timeout=self.timeout, retries=self.retries)
+        return self
+
+    def close(self): # Cerrar el transporte del cliente
+        self.engine.transportDispatcher.closeDispatcher()
+
+    @staticmethod
+    def result(errorIndication, errorStatus, varBinds): # (error, [(OID en texto, valor)])
+        if errorIndication:
+            return str(errorIndication), []
+        if errorStatus:
+            return errorStatus.prettyPrint(), []
+        return None, [(str(oid), value) for oid, value in varBinds]
+
+    async def get(self, *oids, community=COMMUNITY_RO): # GET de uno o varios OIDs
+        errorIndication, errorStatus, _, varBinds = await hlapi.getCmd(
+            self.engine, hlapi.CommunityData(community), self.target, self.context,
+            *(hlapi.ObjectType(hlapi.ObjectIdentity(oid)) for oid in oids))
+        return self.result(errorIndication, errorStatus, varBinds)
+
+    async def getnext(self, oid): # GETNEXT de un OID
+        errorIndication, errorStatus, _, varBinds = await hlapi.nextCmd(
+            self.engine, hlapi.CommunityData(COMMUNITY_RO), self.target, self.context, hlapi.ObjectType(hlapi.ObjectIdentity(oid)))
+        return self.result(errorIndication, errorStatus, varBinds)
+
+    async def walk(self, prefix): # Recorrido (GETNEXT encadenados) de todo lo que cuelga de prefix
+        found = []
+        async for errorIndication, errorStatus, _, varBinds in hlapi.walkCmd(
+                self.engine, hlapi.CommunityData(COMMUNITY_RO), self.target, self.context,
+                hlapi.ObjectType(hlapi.ObjectIdentity(prefix)), lexicographicMode=False):
+            error, rows = self.result(errorIndication, errorStatus, varBinds)
+            if error:
+                return error, found
+            found.extend(rows)
+        return None, found
+
+    async def set(self, *varbinds, community=COMMUNITY_RW): # SET de uno o varios (OID, valor pysnmp) en una sola PDU
+        errorIndication, errorStatus, _, varBinds = await hlapi.setCmd(
+            self.engine, hlapi.CommunityData(community), self.target, self.context,
+            *(hlapi.ObjectType(hlapi.ObjectIdentity(oid), value) for oid, value in varbinds))
+        return self.result(errorIndication, errorStatus, varBinds)
+
+
+def oid_key(oid): # Clave de orden numérico de un OID en texto
+    return tuple(int(x) for x in oid.split("."))
+
+
+# Cada prueba es una corrutina independiente que devuelve (pasadas, total, líneas de informe). Las pruebas se
+# ejecutan a la vez y sus informes se muestran después en orden, así la salida no se mezcla.
+
+async def test_get_operations(session): # Test 1: Operaciones GET básicas
     tests = [
-        ("Manager", OID_MANAGER),
-        ("Manager Email", OID_EMAIL),
-        ("CPU Usage", OID_CPU_USAGE),
-        ("CPU Threshold", OID_CPU_THRESHOLD)
-    ] # Lista de tests con nombre y OID
-    
-    passed = 0
-    for name, oid in tests: # Iteramos sobre los tests
-        cmd = f"snmpget -v2c -c {COMMUNITY_RO} {AGENT_IP} {oid}"
-        success, output, error = run_snmp_command(cmd)
-        
-        if success and output and "No Such" not in output:
-            print(f"  ✓ {name}: {output}")
-            passed += 1 # Contamos como pasado
+        ("Manager", OID_MANAGER, hlapi.OctetString),
+        ("Manager Email", OID_EMAIL, hlapi.OctetString),
+        ("CPU Usage", OID_CPU_USAGE, hlapi.Integer32),
+        ("CPU Threshold", OID_CPU_THRESHOLD, hlapi.Integer32),
+    ] # Lista de tests con nombre, OID y tipo esperado
+    results = await asyncio.gather(*(session.get(oid) for _, oid, _ in tests)) # Todas las lecturas a la vez
+    lines, passed = [], 0
+    for (name, oid, kind), (error, rows) in zip(tests, results):
+        if error is None and rows and rows[0][0] == oid and isinstance(rows[0][1], kind):
+            lines.append(f"  ✓ {name}: {rows[0][1].prettyPrint()}")
+            passed += 1
         else:
-            print(f"  ✗ {name}: FALLO")
-            if error:
-                print(f"    Error: {error}")
-    
-    print(f"\n  Resultado: {passed}/{len(tests)} tests pasados")
-    return passed == len(tests) # Devuelve True si todos pasaron
-
-def test_getnext_operations(): # Test 2: Operaciones GETNEXT
-    print_header("TEST 2: Operaciones GETNEXT (Walk manual)")
-    
-    current_oid = BASE_OID
-    objects_found = []
-    
+            lines.append(f"  ✗ {name}: {error or rows}")
+    return passed, len(tests), lines
+
+
+async def test_getnext_operations(session): # Test 2: GETNEXT encadenados desde la raíz de la MIB
+    current_oid, lines, steps = BASE_OID, [], 0
     for i in range(5): # Limitar a 5 saltos para evitar loops infinitos
-        cmd = f"snmpgetnext -v2c -c {COMMUNITY_RO} {AGENT_IP} {current_oid}"
-        success, output, error = run_snmp_command(cmd)
-        
-        if success and output and "End of MIB" not in output: # Si hay respuesta válida
-            try:
-                # Extrae el OID de la respuesta para el siguiente salto
-                current_oid = output.split("=")[0].strip().split()[-1]
-                print(f"  ✓ Paso {i+1}: {output}")
-                objects_found.append(output)
-            except Exception:
-                print(f"  ✗ Fallo al parsear la respuesta de GETNEXT: {output}")
-                break
-        else:
-            print(f"  ℹ Fin del MIB en paso {i+1}")
+        error, rows = await session.getnext(current_oid)
+        if error or not rows:
+            lines.append(f"  ✗ Paso {i+1}: {error or 'sin respuesta'}")
             break
-    print(f"\n  Objetos encontrados: {len(objects_found)}")
-    return len(objects_found) >= 4 # Esperamos al menos 4 objetos
+        next_oid, value = rows[0]
+        if not next_oid.startswith(BASE_OID + ".") or oid_key(next_oid) <= oid_key(current_oid):
+            lines.append(f"  ℹ Fin de la MIB del agente en el paso {i+1} ({next_oid})")
+            break
+        lines.append(f"  ✓ Paso {i+1}: {next_oid} = {value.prettyPrint()}")
+        current_oid, steps = next_oid, steps + 1
+    ok = steps >= 4 # Esperamos al menos 4 objetos
+    lines.append(f"\n  Objetos encontrados: {steps}")
+    return int(ok), 1, lines
+
+
+async def test_walk_operation(session): # Test 3: WALK del subárbol completo
+    error, rows = await session.walk(BASE_OID)
+    oids = [oid for oid, _ in rows]
+    checks = [
+        ("sin errores", error is None),
+        ("al menos 4 objetos", len(rows) >= 4),
+        ("los 4 escalares del agente", {OID_MANAGER, OID_EMAIL, OID_CPU_USAGE, OID_CPU_THRESHOLD} <= set(oids)),
+        ("OIDs en orden creciente y sin repetir", all(oid_key(a) < oid_key(b) for a, b in zip(oids, oids[1:]))),
+    ]
+    lines = [f"  {'✓' if ok else '✗'} WALK: {label}" for label, ok in checks]
+    lines.append(f"  ℹ {len(rows)} objetos recorridos{f' (error: {error})' if error else ''}")
+    return sum(ok for _, ok in checks), len(checks), lines
 
-def test_set_operations(): # Test 3: Operaciones SET (Escritura)
-    print_header("TEST 3: Operaciones SET")
-    
-    new_manager = "Enrique"
-    new_email = "871135@unizar.es"
-    new_threshold = "4" # Usamos string, el tipo 'i' lo convierte
 
+async def test_set_operations(session): # Test 4: SET y verificación con GET de cada objeto escribible
     tests = [
-        ("Manager name", OID_MANAGER, "s", new_manager),
-        ("Manager email", OID_EMAIL, "s", new_email),
-        ("CPU Threshold", OID_CPU_THRESHOLD, "i", new_threshold)
-    ] # Lista de tests con nombre, OID, tipo SNMP y nuevo valor
-    
-    passed = 0
-    for name, oid, snmp_type, value in tests: # Iteramos sobre los tests
-        # 1. Operación SET
-        cmd_set = f"snmpset -v2c -c {COMMUNITY_RW} {AGENT_IP} {oid} {snmp_type} \"{value}\""
-        success, output, error = run_snmp_command(cmd_set)
-        
-        if success and output:
-            # 2. Verificar con GET
-            cmd_get = f"snmpget -v2c -c {COMMUNITY_RO} {AGENT_IP} {oid}"
-            success_get, output_get, _ = run_snmp_command(cmd_get)
-            
-            if success_get and value in output_get:
-                print(f"  ✓ {name}: Modificado y verificado = {value}")
-                passed += 1 # Contamos como pasado
-            else:
-                print(f"  ⚠ {name}: SET OK pero verificación falló. Respuesta: {output_get}")
-        else:
-            print(f"  ✗ {name}: FALLO al hacer SET")
-            if error:
-                print(f"    Error: {error}")
-    
-    print(f"\n  Resultado: {passed}/{len(tests)} tests pasados")
-    return passed == len(tests) # Devuelve True si todos pasaron
-
-def test_walk_operation(): # Test 4: WALK del subárbol completo
-    print_header("TEST 4: SNMP WALK del subárbol")
-    
-    cmd = f"snmpwalk -v2c -c {COMMUNITY_RO} {AGENT_IP} {BASE_OID}"
-    success, output, error = run_snmp_command(cmd)
-    
-    if success and output: # Si hay salida válida
-        lines = output.strip().split('\n')
-        print(f"  ✓ WALK exitoso: {len(lines)} objetos encontrados")
-        for line in lines:
-            print(f"    {line}")
-        return len(lines) >= 4 # Esperamos al menos 4 objetos
-    else:
-        print(f"  ✗ WALK falló")
+        ("Manager name", OID_MANAGER, hlapi.OctetString("Enrique")),
+        ("Manager email", OID_EMAIL, hlapi.OctetString("871135@unizar.es")),
+        ("CPU Threshold", OID_CPU_THRESHOLD, hlapi.Integer32(90)),
+    ] # Lista de tests con nombre, OID y nuevo valor
+
+    async def set_and_verify(name, oid, value): # Cada objeto es independiente: los tres van a la vez
+        error, _ = await session.set((oid, value))
         if error:
-            print(f"    Error: {error}")
-        return False # Fallo en WALK
-
-def test_negative_cases(): # Test 5: Casos negativos (errores esperados)
-    print_header("TEST 5: Casos negativos (errores esperados)")
-    passed = 0
-
-    # 1. Intentar escribir en objeto Read-Only (cpuUsage)
-    cmd_ro = f"snmpset -v2c -c {COMMUNITY_RW} {AGENT_IP} {OID_CPU_USAGE} i 50"
-    success_ro, output_ro, error_ro = run_snmp_command(cmd_ro)
-    
-    if not success_ro or "Error" in error_ro or "notWritable" in output_ro or "noAccess" in output_ro:
-        print(f"  ✓ Escritura a objeto READ-ONLY (cpuUsage) bloqueada correctamente")
-        passed += 1 # Contamos como pasado
-    else:
-        print(f"  ✗ FALLO: Se ha permitido escribir en un objeto Read-Only (cpuUsage)")
-
-    # 2. Intentar escribir con comunidad Read-Only (public)
-    cmd_comm = f"snmpset -v2c -c {COMMUNITY_RO} {AGENT_IP} {OID_CPU_THRESHOLD} i 60"
-    success_comm, output_comm, error_comm = run_snmp_command(cmd_comm)
-    
-    if not success_comm or "Error" in error_comm or "notWritable" in output_comm or "noAccess" in output_comm:
-        print(f"  ✓ Escritura con comunidad READ-ONLY (public) bloqueada correctamente")
-        passed += 1 # Contamos como pasado
-    else:
-        print(f"  ✗ FALLO: Se ha permitido escribir con la comunidad 'public'")
-
-    print(f"\n  Resultado: {passed}/2 tests pasados")
-    return passed == 2 # Devuelve True si ambos pasaron
-
-def test_cpu_monitoring(): # Test 6: Monitoreo de CPU (en tiempo real)
-    print_header("TEST 6: Monitoreo de CPU (en tiempo real)")
-    
-    print("  Leyendo CPU 3 veces (intervalo de 5 segundos)...")
-    
-    valores = []
-    for i in range(3): # Leer 3 veces cada 5 segundos
-        valor = get_snmp_value(OID_CPU_USAGE)
-        if valor is not None:
-            print(f"  Lectura {i+1}: {valor}%")
-            valores.append(valor)
+            return False, f"  ✗ {name}: FALLO al hacer SET ({error})"
+        error, rows = await session.get(oid)
+        if error or not rows or rows[0][1] != value:
+            return False, f"  ⚠ {name}: SET OK pero verificación falló ({error or rows[0][1].prettyPrint()})"
+        return True, f"  ✓ {name}: Modificado y verificado = {value.prettyPrint()}"
+
+    results = await asyncio.gather(*(set_and_verify(*test) for test in tests))
+    return sum(ok for ok, _ in results), len(tests), [line for _, line in results]
+
+
+async def test_negative_cases(session): # Test 5: Casos negativos (errores esperados)
+    async def expect_error(label, request):
+        error, rows = await request
+        if error:
+            return True, f"  ✓ {label}: rechazado ({error})"
+        return False, f"  ✗ {label}: se ha aceptado ({rows})"
+
+    async def expect_no_such(label, oid): # GET de un OID inexistente: noSuchObject/noSuchInstance en el varbind
+        error, rows = await session.get(oid)
+        if error is None and rows and rows[0][1].__class__.__name__ in ("NoSuchObject", "NoSuchInstance"):
+            return True, f"  ✓ {label}: {rows[0][1].__class__.__name__}"
+        return False, f"  ✗ {label}: {error or rows}"
+
+    results = await asyncio.gather(
+        expect_error("Escritura a objeto READ-ONLY (cpuUsage)", session.set((OID_CPU_USAGE, hlapi.Integer32(50)))),
+        expect_error("Escritura con comunidad READ-ONLY (public)",
+                     session.set((OID_CPU_THRESHOLD, hlapi.Integer32(60)), community=COMMUNITY_RO)),
+        expect_error("Tipo incorrecto (texto en cpuThreshold)", session.set((OID_CPU_THRESHOLD, hlapi.OctetString("alto")))),
+        expect_error("Escritura a OID inexistente", session.set((OID_MISSING, hlapi.Integer32(1)))),
+        expect_no_such("Lectura de OID inexistente", OID_MISSING),
+    )
+    return sum(ok for ok, _ in results), len(results), [line for _, line in results]
+
+
+async def test_cpu_monitoring(session): # Test 6: Uso de CPU en tiempo real y tabla por núcleo
+    lines, passed = [], 0
+    for i in range(3): # Tres lecturas con la muestra ya caducada entre ellas (CPU_CACHE_TTL = 1 s)
+        if i:
+            await asyncio.sleep(1.1)
+        error, rows = await session.get(OID_CPU_USAGE)
+        value = int(rows[0][1]) if not error and rows and isinstance(rows[0][1], hlapi.Integer32) else None
+        if value is not None and 0 <= value <= 100:
+            lines.append(f"  ✓ Lectura {i+1}: {value}%")
+            passed += 1
         else:
-            print(f"  Lectura {i+1}: FALLO")
-            
-        if i < 2:
-            time.sleep(5)
-    
-    if len(valores) == 3: # Si se leyeron las 3 lecturas correctamente
-        print(f"  ✓ Monitoreo activo completado")
-        return True
+            lines.append(f"  ✗ Lectura {i+1}: {error or rows}")
+    error, rows = await session.walk(OID_CPU_CORE_TABLE)
+    if not error and rows and all(0 <= int(value) <= 100 for _, value in rows):
+        lines.append(f"  ✓ cpuCoreTable: {len(rows)} núcleos")
+        passed += 1
     else:
-        print(f"  ✗ Fallo en el monitoreo")
-        return False
+        lines.append(f"  ✗ cpuCoreTable: {error or 'vacía'}")
+    return passed, 4, lines
+
+
+TESTS = [ # (nombre, prueba): todas independientes entre sí
+    ("GET Operations", test_get_operations),
+    ("GETNEXT Operations", test_getnext_operations),
+    ("WALK Operation", test_walk_operation),
+    ("SET Operations", test_set_operations),
+    ("Negative Tests", test_negative_cases),
+    ("CPU Monitoring", test_cpu_monitoring),
+]
+
+
+async def save_state(session): # Valores originales de los objetos que modifican las pruebas
+    error, rows = await session.get(OID_MANAGER, OID_EMAIL, OID_CPU_THRESHOLD)
+    if error:
+        raise RuntimeError(f"no se pudo leer el estado original: {error}")
+    return rows
+
+
+async def restore_state(session, original): # Restaurar todo con un único SET de varios varbinds y comprobarlo
+    error, _ = await session.set(*original)
+    if error:
+        return False, f"  ✗ No se pudo revertir: {error}"
+    error, rows = await session.get(*(oid for oid, _ in original))
+    if error or [value for _, value in rows] != [value for _, value in original]:
+        return False, f"  ✗ El estado leído tras revertir no coincide: {error or rows}"
+    return True, "  ✓ Revertidos " + ", ".join(f"{oid} = {value.prettyPrint()}" for oid, value in original) + " (un solo SET)"
+
+
+async def run_suite(host, port): # Ejecuta todas las pruebas a la vez y restaura el estado
+    session = await SnmpSession(host, port).open()
+    try:
+        original = await save_state(session)
+        results = await asyncio.gather(*(test(session) for _, test in TESTS), return_exceptions=True)
+        restored = await restore_state(session, original)
+    finally:
+        session.close()
+    return original, results, restored
+
+
+def test_snapshot_consistency(): # Test 7: GETs y recorridos con versión fijada frente a SETs y muestras (en proceso)
+    agent = load_agent()
+    root = oid_key(BASE_OID)
+    with tempfile.TemporaryDirectory() as directory:
+        store = agent.JsonStore(os.path.join(directory, "mib_state.json"))
+        manager_oid, email_oid = oid_key(OID_MANAGER), oid_key(OID_EMAIL)
+        size = sum(1 for _ in store.walk(root, store.pin())) # Los SETs y las muestras no cambian el número de objetos
+        stop = threading.Event()
+        counts = {"gets": 0, "walks": 0, "sets": 0, "samples": 0, "inconsistent": 0}
+        errors = []
+        lock = threading.Lock()
+
+        def guarded(loop): # Una excepción en cualquier hilo es un fallo de la prueba
+            def run():
+                try:
+                    loop()
+                except Exception as e:
+                    errors.append(e)
+            return run
+
+        def setter(): # SET de dos varbinds que siempre deben verse juntos: manager=tN, managerEmail=tN@test
+            while not stop.is_set():
+                counts["sets"] += 1
+                store.commit_many([(manager_oid, agent.v2c.OctetString(f"t{counts['sets']}")),
+                                   (email_oid, agent.v2c.OctetString(f"t{counts['sets']}@test"))])
+
+        def sampler(): # Muestras de CPU tan rápido como sea posible
+            while not stop.is_set():
+                counts["samples"] += 1
+                store.set_cpu_usage_internal(counts["samples"] % 100)
+
+        def reader(): # Un GET de dos varbinds sobre la versión fijada debe ver siempre la pareja completa
+            gets = walks = inconsistent = 0
+            while not stop.is_set():
+                snap = store.pin()
+                manager = str(store.get_exact(manager_oid, snap)[1])
+                email = str(store.get_exact(email_oid, snap)[1])
+                if manager.startswith("t") and email != f"{manager}@test":
+                    inconsistent += 1
+                gets += 1
+                if gets % 50 == 0: # Recorrido completo de la misma versión
+                    if sum(1 for _ in store.walk(root, snap)) != size:
+                        inconsistent += 1
+                    walks += 1
+            with lock:
+                counts["gets"] += gets
+                counts["walks"] += walks
+                counts["inconsistent"] += inconsistent
+
+        previous = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5) # Cambios de hilo muy frecuentes para provocar intercalados
+        threads = [threading.Thread(target=guarded(loop)) for loop in [setter, sampler] + [reader] * CONSISTENCY_READERS]
+        try:
+            for thread in threads:
+                thread.start()
+            time.sleep(CONSISTENCY_SECONDS)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            sys.setswitchinterval(previous)
+
+    checks = [
+        ("sin excepciones", not errors),
+        ("ha habido SETs, muestras y lecturas a la vez", counts["sets"] and counts["samples"] and counts["gets"]),
+        ("todas las lecturas fijadas son coherentes", counts["inconsistent"] == 0),
+    ]
+    lines = [f"  {'✓' if ok else '✗'} {label}" for label, ok in checks]
+    lines += [f"  ✗ Excepción: {type(e).__name__}: {e}" for e in errors[:3]]
+    lines.append(f"  ℹ GETs: {counts['gets']:,} | recorridos: {counts['walks']:,} | SETs: {counts['sets']:,} | "
+                 f"muestras: {counts['samples']:,} | incoherentes: {counts['inconsistent']}")
+    return sum(bool(ok) for _, ok in checks), len(checks), lines
+
+
+def parse_agent(text): # "host[:puerto]" -> (host, puerto)
+    host, _, port = text.rpartition(":") if ":" in text else (text, "", str(AGENT_PORT))
+    return host, int(port)
+
+
+def main(): # Ejecuta la suite y sale con código 1 si algo falla
+    parser = argparse.ArgumentParser(description="Pruebas funcionales del mini agente SNMP")
+    parser.add_argument("--agent", type=parse_agent, metavar="HOST[:PUERTO]",
+                        help="Probar un agente ya en marcha en lugar de arrancar uno en un puerto libre")
+    parser.add_argument("--workers", type=int, default=1, help="Procesos del agente de pruebas (--workers del agente)")
+    args = parser.parse_args()
 
-def revert_changes(manager, email, threshold): # Restaura los valores originales del agente
-    print_header("REVIRTIENDO CAMBIOS a los valores originales")
-    
-    if manager is None or email is None or threshold is None: # Si no se guardaron los originales
-        print("  ✗ No se pudo revertir (valores originales no se guardaron).")
-        print("  Reinicia el agente manualmente para restaurar valores.")
-        return
-
-    # Revertir Manager (string)
-    cmd_man = f"snmpset -v2c -c {COMMUNITY_RW} {AGENT_IP} {OID_MANAGER} s \"{manager}\""
-    success, out, _ = run_snmp_command(cmd_man)
-    print(f"  {'✓' if success else '✗'} Revertido Manager a: {manager}")
-
-    # Revertir Email (string)
-    cmd_email = f"snmpset -v2c -c {COMMUNITY_RW} {AGENT_IP} {OID_EMAIL} s \"{email}\""
-    success, out, _ = run_snmp_command(cmd_email)
-    print(f"  {'✓' if success else '✗'} Revertido Email a: {email}")
-
-    # Revertir Threshold (integer)
-    cmd_thr = f"snmpset -v2c -c {COMMUNITY_RW} {AGENT_IP} {OID_CPU_THRESHOLD} i {threshold}"
-    success, out, _ = run_snmp_command(cmd_thr)
-    print(f"  {'✓' if success else '✗'} Revertido Threshold a: {threshold}")
-
-def main(): # Ejecuta todos los tests de forma interactiva
-    global AGENT_IP # Declaramos que modificaremos la variable global
-    
     print(f"\n╔{'═'*58}╗")
-    print(f"║     SUITE DE PRUEBAS INTERACTIVA - MINI AGENTE SNMP      ║")
+    print(f"║        SUITE DE PRUEBAS FUNCIONALES - MINI AGENTE SNMP   ║")
     print(f"╚{'═'*58}╝")
-    
-    # 1. Pedir la IP del Agente
-    print(f"\n--- Configuración del Agente ---")
-    default_ip = "127.0.0.1"
-    new_ip = input(f"Introduce la IP del agente (o ENTER para {default_ip}): ")
-    if new_ip.strip():
-        AGENT_IP = new_ip.strip()
-    else:
-        AGENT_IP = default_ip
-    print(f"  ✓ Usando IP del agente: {AGENT_IP}")
 
-    # 2. Comprobar Herramientas SNMP
-    if not check_snmp_tools():
-        print("\n⚠ IMPORTANTE: Revisa el error de net-snmp.")
-        sys.exit(1)
-    
-    print(f"\n⚠ IMPORTANTE: Asegúrate de que el agente está corriendo en {AGENT_IP}:")
-    print(f"  python mini_agent(7.1.4).py")
-    
-    # 3. Guardar Valores Originales
-    print_header("Guardando estado original del agente (para revertir)")
-    original_manager = get_snmp_value(OID_MANAGER)
-    original_email = get_snmp_value(OID_EMAIL)
-    original_threshold = get_snmp_value(OID_CPU_THRESHOLD)
-    
-    if original_manager is None or original_email is None or original_threshold is None:
-        print("  ✗ No se pudo obtener el estado original. El 'revert' al final fallará.")
-        print("  Asegúrate de que el agente esté corriendo y la IP sea correcta.")
-        input("Presiona ENTER para salir...")
-        sys.exit(1)
-    else:
-        print(f"  ✓ Guardado Manager: {original_manager}")
-        print(f"  ✓ Guardado Email: {original_email}")
-        print(f"  ✓ Guardado Threshold: {original_threshold}")
-
-    # 4. Ejecutar Tests Interactivamente
-    results = []
-    
-    pause_for_next_test("GET Operations")
-    results.append(("GET Operations", test_get_operations()))
-    
-    pause_for_next_test("GETNEXT Operations")
-    results.append(("GETNEXT Operations", test_getnext_operations()))
-    
-    pause_for_next_test("SET Operations (modificará valores)")
-    results.append(("SET Operations", test_set_operations()))
-    
-    pause_for_next_test("WALK Operation")
-    results.append(("WALK Operation", test_walk_operation()))
-    
-    pause_for_next_test("Negative Tests (errores esperados)")
-    results.append(("Negative Tests", test_negative_cases()))
-    
-    pause_for_next_test("CPU Monitoring (durará 15 seg)")
-    results.append(("CPU Monitoring", test_cpu_monitoring()))
-    
-    # 5. Resultados
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        process = None
+        if args.agent:
+            host, port = args.agent
+            print(f"\n  Agente externo: {host}:{port}")
+        else:
+            host, port = AGENT_IP, free_port()
+            process = start_agent(directory, port, "--workers", str(args.workers)) # Alertas a un puerto local cerrado
+            print(f"\n  Agente de pruebas: {host}:{port} ({args.workers} proceso(s)), arrancado en "
+                  f"{time.perf_counter() - started:.2f} s")
+        try:
+            original, results, (restored, restore_line) = asyncio.run(run_suite(host, port))
+        finally:
+            if process is not None:
+                stop_agent(process)
+
+    print_header("Estado original del agente (para revertir)")
+    for oid, value in original:
+        print(f"  ✓ Guardado {oid} = {value.prettyPrint()}")
+
+    try: # Prueba en proceso sobre JsonStore: no depende del agente arrancado
+        results.append(test_snapshot_consistency())
+    except Exception as e:
+        results.append(e)
+
+    summary = []
+    for index, ((name, _), result) in enumerate(zip(TESTS + [("Snapshot Consistency", None)], results), start=1):
+        print_header(f"TEST {index}: {name}")
+        if isinstance(result, BaseException): # Una prueba que revienta cuenta como fallida sin parar las demás
+            passed, total, lines = 0, 1, [f"  ✗ Excepción: {type(result).__name__}: {result}"]
+        else:
+            passed, total, lines = result
+        print("\n".join(lines))
+        print(f"\n  Resultado: {passed}/{total} tests pasados")
+        summary.append((name, passed == total))
+
+    print_header("REVIRTIENDO CAMBIOS a los valores originales")
+    print(restore_line)
+    summary.append(("Restore", restored))
+
     print_header("RESUMEN DE RESULTADOS")
-    passed = sum(1 for _, result in results if result)
-    total = len(results)
-    
-    for test_name, result in results:
-        status = "✓ PASADO" if result else "✗ FALLADO"
-        print(f"  {status}: {test_name}")
-    
-    print(f"\n  Total: {passed}/{total} tests pasados")
-    
-    if passed == total:
+    for test_name, result in summary:
+        print(f"  {'✓ PASADO' if result else '✗ FALLADO'}: {test_name}")
+    passed = sum(1 for _, result in summary if result)
+    print(f"\n  Total: {passed}/{len(summary)} tests pasados en {time.perf_counter() - started:.2f} s")
+    if passed == len(summary):
         print(f"\n  🎉 ¡Todos los tests pasados!")
     else:
         print(f"\n  ⚠ Revisa los tests fallidos arriba")
-    
-    # 6. Revertir Cambios
-    revert_changes(original_manager, original_email, original_threshold)
-    
-    print(f"\nPresiona ENTER para salir...")
-    input()
+        sys.exit(1)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()